@@ -0,0 +1,95 @@
+# bench/rate_limit.py
+"""测量限速的准确度：实际传输速率与目标速率的偏差，以及令牌桶本身的开销
+
+用法: python -m bench.rate_limit --rates 10M 50M 200M --duration 3
+"""
+import os
+import sys
+import io
+import time
+import argparse
+import tempfile
+import contextlib
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.file_transfer import FileReceiver, FileSender
+from server.rate_limit import RateLimiter
+from bench.server_engines import _free_port, _wait_for_port
+
+
+def _parse_rate(text):
+    """解析 '10M'、'2G' 这样的速率（字节/秒）"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def run_transfer(rate, duration, streams=1):
+    """在本机回环上按 rate 限速发送约 duration 秒的数据，返回实际速率"""
+    port = _free_port()
+    size = int(rate * duration)
+    with tempfile.TemporaryDirectory() as work_dir:
+        source_path = os.path.join(work_dir, 'payload.bin')
+        with open(source_path, 'wb') as f:
+            f.write(os.urandom(size))
+        receiver = FileReceiver('127.0.0.1', port, download_dir=os.path.join(work_dir, 'downloads'))
+        
+        with contextlib.redirect_stdout(io.StringIO()):
+            receiver.start_server()
+            _wait_for_port(port)
+            start_time = time.perf_counter()
+            FileSender().send_file(source_path, '127.0.0.1', port, streams=streams, resume=False,
+                                   delta=False, compress=False, rate_limit=rate)
+            elapsed = time.perf_counter() - start_time
+            receiver.stop_server()
+    return {'target': rate, 'size': size, 'streams': streams, 'elapsed': elapsed, 'achieved': size / elapsed}
+
+
+def run_synthetic(rate, duration, chunk):
+    """不做任何I/O，只按 chunk 大小反复取用令牌，测量限速准确度和每次记账的CPU开销"""
+    throttle = RateLimiter().throttle('127.0.0.1', rate)
+    step = throttle.slice or chunk
+    total = 0
+    start_time = time.perf_counter()
+    start_cpu = time.process_time()
+    while time.perf_counter() - start_time < duration:
+        throttle.consume(step)
+        total += step
+    elapsed = time.perf_counter() - start_time
+    cpu = time.process_time() - start_cpu
+    calls = total // step
+    return {'target': rate, 'achieved': total / elapsed, 'calls': calls,
+            'cpu_us_per_call': cpu / calls * 1e6 if calls else 0.0}
+
+
+def _error(result):
+    """实际速率相对目标速率的偏差（百分比）"""
+    return (result['achieved'] - result['target']) / result['target'] * 100
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="限速准确度基准测试")
+    parser.add_argument('--rates', nargs='+', type=_parse_rate, default=[10 << 20, 50 << 20, 200 << 20],
+                        help="回环传输的目标速率，如 10M 200M")
+    parser.add_argument('--synthetic-rates', nargs='+', type=_parse_rate, default=[1 << 30, 4 << 30],
+                        help="不经过网络的令牌桶测试速率，用于验证高速率下的准确度")
+    parser.add_argument('--duration', type=float, default=3.0, help="每项测试的大约时长（秒）")
+    parser.add_argument('--streams', type=int, default=1, help="回环传输使用的连接数")
+    args = parser.parse_args(argv)
+    
+    print(f"{'transfer':<10}{'target MB/s':>13}{'actual MB/s':>13}{'error %':>9}")
+    for rate in args.rates:
+        result = run_transfer(rate, args.duration, args.streams)
+        print(f"{'loopback':<10}{rate / 2 ** 20:>13.1f}{result['achieved'] / 2 ** 20:>13.1f}{_error(result):>9.2f}")
+    for rate in args.synthetic_rates:
+        result = run_synthetic(rate, args.duration, 1 << 20)
+        print(f"{'synthetic':<10}{rate / 2 ** 20:>13.1f}{result['achieved'] / 2 ** 20:>13.1f}{_error(result):>9.2f}"
+              f"  ({result['cpu_us_per_call']:.1f} us/调用)")
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
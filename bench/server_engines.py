@@ -0,0 +1,132 @@
+# bench/server_engines.py
+"""对比 threaded 与 asyncio 两种接收引擎在大量并发小文件连接下的表现
+
+用法: python -m bench.server_engines --connections 500 --concurrency 64 --size 4096
+"""
+import os
+import sys
+import io
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.file_transfer import FileReceiver, FileSender
+from server.async_receiver import AsyncFileReceiver
+
+
+def _free_port():
+    """获取一个空闲的本地端口"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values, percent):
+    """计算百分位数（values 已排序）"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def _wait_for_port(port, timeout=5):
+    """等待服务器开始监听"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"服务器未在端口 {port} 上启动")
+
+
+def run_engine(engine, connections, concurrency, size, max_concurrent=None, backlog=None):
+    """启动指定引擎，用 concurrency 个线程发送 connections 个小文件，返回统计结果"""
+    port = _free_port()
+    with tempfile.TemporaryDirectory() as work_dir:
+        download_dir = os.path.join(work_dir, 'downloads')
+        source_path = os.path.join(work_dir, 'payload.bin')
+        with open(source_path, 'wb') as f:
+            f.write(os.urandom(size))
+            
+        receiver = FileReceiver('127.0.0.1', port, download_dir=download_dir)
+        if engine == 'asyncio':
+            server = AsyncFileReceiver(receiver, max_concurrent=max_concurrent, backlog=backlog)
+        else:
+            server = receiver
+            
+        latencies = []
+        failures = 0
+        peak_threads = threading.active_count()
+        lock = threading.Lock()
+        
+        def send_one(_):
+            nonlocal failures
+            start = time.perf_counter()
+            try:
+                # 关闭压缩和续传，只测量连接处理开销
+                FileSender().send_file(source_path, '127.0.0.1', port, resume=False, compress=False)
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+            except Exception:
+                with lock:
+                    failures += 1
+        
+        # 服务器和发送方都按文件打印进度，基准测试期间丢弃这些输出
+        with contextlib.redirect_stdout(io.StringIO()):
+            server.start_server()
+            _wait_for_port(port)
+            start_time = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = [executor.submit(send_one, i) for i in range(connections)]
+                while any(not future.done() for future in futures):
+                    peak_threads = max(peak_threads, threading.active_count())
+                    time.sleep(0.01)
+            elapsed = time.perf_counter() - start_time
+            server.stop_server()
+            
+    latencies.sort()
+    return {
+        'engine': engine,
+        'connections': connections,
+        'concurrency': concurrency,
+        'size': size,
+        'elapsed': elapsed,
+        'conns_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p95_ms': _percentile(latencies, 95) * 1000,
+        'p99_ms': _percentile(latencies, 99) * 1000,
+        'failures': failures,
+        'peak_threads': peak_threads,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="接收引擎并发连接基准测试")
+    parser.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'], choices=['threaded', 'asyncio'])
+    parser.add_argument('--connections', type=int, default=500, help="总连接数")
+    parser.add_argument('--concurrency', type=int, default=64, help="同时发起的连接数")
+    parser.add_argument('--size', type=int, default=4096, help="每个文件的字节数")
+    parser.add_argument('--max-concurrent', type=int, default=None, help="asyncio 引擎的并发上限")
+    parser.add_argument('--backlog', type=int, default=None, help="asyncio 引擎的监听队列长度")
+    args = parser.parse_args(argv)
+    
+    print(f"{'engine':<10}{'conn/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'fail':>6}{'threads':>9}")
+    for engine in args.engines:
+        result = run_engine(engine, args.connections, args.concurrency, args.size,
+                            args.max_concurrent, args.backlog)
+        print(f"{result['engine']:<10}{result['conns_per_sec']:>10.1f}{result['p50_ms']:>10.2f}"
+              f"{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}{result['failures']:>6}"
+              f"{result['peak_threads']:>9}")
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,445 @@
+# bench/transfer.py
+"""文件传输基准测试：在本机回环上或经过流量整形代理（模拟延迟、丢包和带宽）运行 FileSender/FileReceiver，
+按 文件大小 × 文件数 × 块大小 × 并发数 × 网络条件 的组合测量吞吐量、每GB的CPU时间、峰值内存、
+首字节时间和单文件延迟，结果写入JSON，可以与之前的结果对比找出性能回退
+
+用法: python -m bench.transfer --sizes 1M 64M --counts 1 16 --chunk-sizes 256K 1M --concurrency 1 4 \
+          --networks lan wan lossy --output results.json
+      python -m bench.transfer --compare baseline.json results.json --threshold 10
+"""
+import os
+import sys
+import io
+import json
+import time
+import queue
+import random
+import socket
+import argparse
+import platform
+import resource
+import tempfile
+import itertools
+import threading
+import contextlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import file_transfer, async_receiver, compression, delta
+from server.file_transfer import FileReceiver, FileSender
+from server.async_receiver import AsyncFileReceiver
+from server.rate_limit import TokenBucket
+from bench.server_engines import _free_port, _percentile, _wait_for_port
+
+# 预设的网络条件 {'名称': (往返延迟秒数, 丢包率, 带宽字节/秒)}，loopback 不经过代理
+NETWORKS = {
+    'loopback': (0.0, 0.0, 0),
+    'lan': (0.001, 0.0, 125 * 1000 * 1000),
+    'wifi': (0.005, 0.001, 40 * 1000 * 1000),
+    'wan': (0.040, 0.0, 12 * 1000 * 1000),
+    'lossy': (0.020, 0.01, 12 * 1000 * 1000),
+}
+
+# 代理每次转发的最大数据量，丢包按以太网报文大小折算
+PROXY_CHUNK = 64 * 1024
+SEGMENT_SIZE = 1448
+# 代理每个方向最多缓存的数据块数，相当于路由器队列
+PROXY_QUEUE_CHUNKS = 256
+# 丢包后重传的最小等待时间（秒）
+LOSS_PENALTY_MIN = 0.01
+
+# 比较结果时用于匹配同一测试项的参数
+CELL_KEYS = ('engine', 'network', 'size', 'count', 'chunk_size', 'concurrency', 'streams')
+
+
+def _parse_size(text):
+    """解析 '64K'、'16M'、'1G' 这样的大小"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+class ShapingProxy:
+    """本机TCP代理，按给定的往返延迟、丢包率和带宽转发两个方向的数据
+    
+    TCP 是可靠传输，用户态代理无法真正丢包：每个“丢失”的报文让该方向后续数据额外等待约一个往返时间，
+    近似快速重传的效果。需要精确模拟时应在真实网卡上使用 tc netem。
+    """
+    
+    def __init__(self, target_port, latency=0.0, loss=0.0, bandwidth=0, seed=None):
+        self.target_port = target_port
+        self.delay = latency / 2
+        self.loss = loss
+        self.penalty = max(latency, LOSS_PENALTY_MIN)
+        self.random = random.Random(seed)
+        self.port = None
+        self.running = False
+        self.server_socket = None
+        self.threads = []
+        self.lock = threading.Lock()
+        self.cpu_time = 0.0
+        # 所有连接共享瓶颈链路，每个方向一个令牌桶
+        self.buckets = (TokenBucket(bandwidth), TokenBucket(bandwidth))
+        
+    def start(self):
+        """开始监听，返回代理端口"""
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind(('127.0.0.1', 0))
+        self.server_socket.listen(128)
+        self.port = self.server_socket.getsockname()[1]
+        self.running = True
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self.port
+        
+    def stop(self):
+        """停止监听，等待转发线程结束"""
+        self.running = False
+        self.server_socket.close()
+        for thread in list(self.threads):
+            thread.join(5)
+        
+    def _accept_loop(self):
+        """为每个连接建立到目标的连接，并启动两个方向的转发"""
+        while self.running:
+            try:
+                client, _ = self.server_socket.accept()
+            except OSError:
+                break
+            upstream = socket.create_connection(('127.0.0.1', self.target_port))
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._start_direction(client, upstream, self.buckets[0])
+            self._start_direction(upstream, client, self.buckets[1])
+        
+    def _start_direction(self, src, dst, bucket):
+        """启动一个方向的接收线程和延迟发送线程"""
+        pending = queue.Queue(maxsize=PROXY_QUEUE_CHUNKS)
+        threads = [threading.Thread(target=self._pump, args=(src, pending, bucket), daemon=True),
+                   threading.Thread(target=self._deliver, args=(dst, pending, src), daemon=True)]
+        with self.lock:
+            self.threads.extend(threads)
+        for thread in threads:
+            thread.start()
+        
+    def _pump(self, src, pending, bucket):
+        """读取数据并计算每块数据的发出时间：带宽排队 + 单向延迟 + 丢包重传"""
+        start_cpu = time.thread_time()
+        last_release = 0.0
+        try:
+            while True:
+                try:
+                    data = src.recv(PROXY_CHUNK)
+                except OSError:
+                    data = b''
+                if not data:
+                    break
+                now = time.monotonic()
+                # 按带宽排队：欠额就是这块数据在瓶颈链路上的排队时间
+                release = now + bucket.reserve(len(data)) + self.delay
+                segments = (len(data) + SEGMENT_SIZE - 1) // SEGMENT_SIZE
+                if self.loss and self.random.random() < 1 - (1 - self.loss) ** segments:
+                    release += self.penalty
+                last_release = max(release, last_release)
+                pending.put((last_release, data))
+        finally:
+            pending.put(None)
+            self._add_cpu(time.thread_time() - start_cpu)
+        
+    def _deliver(self, dst, pending, src):
+        """按发出时间把数据转发给对端，源端关闭后关闭对端的写方向"""
+        start_cpu = time.thread_time()
+        try:
+            while True:
+                item = pending.get()
+                if item is None:
+                    dst.shutdown(socket.SHUT_WR)
+                    break
+                release, data = item
+                wait = release - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                dst.sendall(data)
+        except OSError:
+            # 对端已关闭，让源端的接收线程也结束
+            with contextlib.suppress(OSError):
+                src.shutdown(socket.SHUT_RDWR)
+        finally:
+            self._add_cpu(time.thread_time() - start_cpu)
+        
+    def _add_cpu(self, seconds):
+        """累计代理线程消耗的CPU时间，从测量结果中扣除"""
+        with self.lock:
+            self.cpu_time += seconds
+
+
+class _FileProbe:
+    """一个文件的发送进度回调，记录首字节时间和进度更新的间隔"""
+    
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_byte = None
+        self.elapsed = None
+        self.updates = []
+        
+    def update_progress(self, sent_size, file_size):
+        now = time.perf_counter()
+        self.updates.append(now)
+        if self.first_byte is None and sent_size > 0:
+            self.first_byte = now - self.start
+
+
+def _apply_chunk_size(chunk_size):
+    """修改各传输模块使用的块大小（只在单独运行一个测试项的子进程中调用）"""
+    for module in (file_transfer, async_receiver, compression, delta):
+        module.CHUNK_SIZE = chunk_size
+
+
+def _max_rss_mb():
+    """本进程到目前为止的峰值常驻内存（MB）"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以KB为单位，macOS 以字节为单位
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def _cpu_seconds():
+    """本进程消耗的用户态和内核态CPU时间"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_cell(cell):
+    """运行一个测试项：启动接收方（必要时经过整形代理），并发发送 count 个文件，返回测量结果"""
+    _apply_chunk_size(cell['chunk_size'])
+    latency, loss, bandwidth = NETWORKS[cell['network']]
+    port = _free_port()
+    with tempfile.TemporaryDirectory() as work_dir:
+        paths = []
+        block = os.urandom(min(cell['size'], 1024 * 1024))
+        for i in range(cell['count']):
+            path = os.path.join(work_dir, f'payload_{i}.bin')
+            with open(path, 'wb') as f:
+                for offset in range(0, cell['size'], len(block)):
+                    f.write(block[:cell['size'] - offset])
+                # 每个文件开头不同，避免接收方把它们当成同一个文件
+                f.seek(0)
+                f.write(os.urandom(min(16, cell['size'])))
+            paths.append(path)
+            
+        download_dir = os.path.join(work_dir, 'downloads')
+        receiver = FileReceiver('127.0.0.1', port, download_dir=download_dir)
+        server = AsyncFileReceiver(receiver) if cell['engine'] == 'asyncio' else receiver
+        proxy = None
+        probes = []
+        failures = 0
+        lock = threading.Lock()
+        
+        def send_one(path):
+            nonlocal failures
+            probe = _FileProbe()
+            sender = FileSender()
+            sender.transfer_callback = probe.update_progress
+            try:
+                sender.send_file(path, '127.0.0.1', target_port, streams=cell['streams'], resume=False,
+                                 delta=False, compress=False)
+                probe.elapsed = time.perf_counter() - probe.start
+                with lock:
+                    probes.append(probe)
+            except Exception:
+                with lock:
+                    failures += 1
+            
+        # 发送方和接收方都按文件打印进度，基准测试期间丢弃这些输出
+        with contextlib.redirect_stdout(io.StringIO()):
+            server.start_server()
+            _wait_for_port(port)
+            target_port = port
+            if cell['network'] != 'loopback':
+                proxy = ShapingProxy(port, latency, loss, bandwidth, seed=0)
+                target_port = proxy.start()
+            base_rss = _max_rss_mb()
+            start_cpu = _cpu_seconds()
+            start_time = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=cell['concurrency']) as executor:
+                list(executor.map(send_one, paths))
+            elapsed = time.perf_counter() - start_time
+            if proxy:
+                proxy.stop()
+            cpu = _cpu_seconds() - start_cpu - (proxy.cpu_time if proxy else 0.0)
+            server.stop_server()
+        
+    total_bytes = cell['size'] * len(probes)
+    latencies = sorted(probe.elapsed for probe in probes)
+    first_bytes = sorted(probe.first_byte for probe in probes if probe.first_byte is not None)
+    # 进度回调之间的最大间隔，即界面上传输速度多久更新一次
+    gaps = sorted(b - a for probe in probes for a, b in zip(probe.updates, probe.updates[1:]))
+    result = dict(cell)
+    result.update({
+        'elapsed': elapsed,
+        'throughput_mb_s': total_bytes / elapsed / 2 ** 20 if elapsed else 0.0,
+        'cpu_s_per_gb': cpu / (total_bytes / 2 ** 30) if total_bytes else 0.0,
+        'rss_base_mb': base_rss,
+        'rss_peak_mb': _max_rss_mb(),
+        'ttfb_p50_ms': _percentile(first_bytes, 50) * 1000,
+        'ttfb_p95_ms': _percentile(first_bytes, 95) * 1000,
+        'latency_p50_ms': _percentile(latencies, 50) * 1000,
+        'latency_p95_ms': _percentile(latencies, 95) * 1000,
+        'latency_max_ms': latencies[-1] * 1000 if latencies else 0.0,
+        'progress_gap_p95_ms': _percentile(gaps, 95) * 1000,
+        'failures': failures,
+    })
+    return result
+
+
+def _spawn_cell(cell, timeout):
+    """在独立的子进程中运行一个测试项，使峰值内存、CPU时间和块大小设置互不影响"""
+    command = [sys.executable, '-m', 'bench.transfer', '--run-cell', json.dumps(cell)]
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        completed = subprocess.run(command, cwd=root, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return dict(cell, error=f"超时（{timeout} 秒）")
+    if completed.returncode != 0:
+        return dict(cell, error=completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else
+                    f"退出码 {completed.returncode}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def _git_commit():
+    """当前代码的提交号，不在 git 仓库中时返回 None"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        completed = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, capture_output=True,
+                                   text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return completed.stdout.strip() or None
+
+
+def build_matrix(args):
+    """按命令行参数展开所有测试项"""
+    cells = []
+    for engine, network, size, count, chunk_size, concurrency in itertools.product(
+            args.engines, args.networks, args.sizes, args.counts, args.chunk_sizes, args.concurrency):
+        cells.append({'engine': engine, 'network': network, 'size': size, 'count': count,
+                      'chunk_size': chunk_size, 'concurrency': concurrency, 'streams': args.streams})
+    return cells
+
+
+def run_suite(args):
+    """运行所有测试项，每项重复 repeat 次取吞吐量的中位数，返回完整报告"""
+    results = []
+    for cell in build_matrix(args):
+        runs = [_spawn_cell(cell, args.timeout) for _ in range(args.repeat)]
+        ok = sorted((run for run in runs if 'error' not in run), key=lambda run: run['throughput_mb_s'])
+        result = ok[len(ok) // 2] if ok else runs[-1]
+        results.append(result)
+        _print_result(result)
+    return {
+        'meta': {
+            'commit': _git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'repeat': args.repeat,
+            'networks': {name: NETWORKS[name] for name in args.networks},
+        },
+        'results': results,
+    }
+
+
+def _print_result(result):
+    """打印一个测试项的主要指标"""
+    label = (f"{result['engine']:<9}{result['network']:<9}{result['size'] / 2 ** 20:>8.2f}M x{result['count']:<4}"
+             f"chunk {result['chunk_size'] // 1024:>5}K  c{result['concurrency']:<3}")
+    if 'error' in result:
+        print(f"{label}  失败: {result['error']}")
+        return
+    print(f"{label}{result['throughput_mb_s']:>9.1f} MB/s{result['cpu_s_per_gb']:>8.2f} s/GB"
+          f"{result['rss_peak_mb']:>8.1f} MB  ttfb {result['ttfb_p50_ms']:>7.2f} ms"
+          f"  p95 {result['latency_p95_ms']:>8.1f} ms{'  失败 %d' % result['failures'] if result['failures'] else ''}")
+
+
+def compare(baseline, current, threshold):
+    """对比两份报告中相同的测试项，返回回退的项目列表
+    
+    吞吐量下降或每GB CPU时间、首字节时间、p95 延迟上升超过 threshold 百分比时视为回退。
+    """
+    def key(result):
+        return tuple(result.get(name) for name in CELL_KEYS)
+        
+    # (指标, 越大越好)
+    metrics = (('throughput_mb_s', True), ('cpu_s_per_gb', False), ('ttfb_p50_ms', False), ('latency_p95_ms', False))
+    previous = {key(result): result for result in baseline['results'] if 'error' not in result}
+    regressions = []
+    for result in current['results']:
+        old = previous.get(key(result))
+        if old is None or 'error' in result:
+            continue
+        for metric, higher_is_better in metrics:
+            if not old[metric]:
+                continue
+            change = (result[metric] - old[metric]) / old[metric] * 100
+            worse = -change if higher_is_better else change
+            if worse > threshold:
+                regressions.append({'cell': dict(zip(CELL_KEYS, key(result))), 'metric': metric,
+                                    'baseline': old[metric], 'current': result[metric], 'change_pct': change})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="文件传输基准测试")
+    parser.add_argument('--sizes', nargs='+', type=_parse_size, default=[64 * 1024, 16 * 1024 * 1024],
+                        help="文件大小，如 64K 16M")
+    parser.add_argument('--counts', nargs='+', type=int, default=[1, 16], help="每项测试发送的文件数")
+    parser.add_argument('--chunk-sizes', nargs='+', type=_parse_size, default=[1024 * 1024], help="块大小")
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4], help="同时发送的文件数")
+    parser.add_argument('--networks', nargs='+', default=['loopback'], choices=sorted(NETWORKS),
+                        help="网络条件，loopback 以外的条件经过整形代理")
+    parser.add_argument('--engines', nargs='+', default=['threaded'], choices=['threaded', 'asyncio'])
+    parser.add_argument('--streams', type=int, default=1, help="每个文件的连接数")
+    parser.add_argument('--repeat', type=int, default=1, help="每项重复次数，取吞吐量的中位数")
+    parser.add_argument('--timeout', type=float, default=600, help="每项测试的超时时间（秒）")
+    parser.add_argument('--output', default=None, help="结果写入的JSON文件")
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), default=None,
+                        help="对比两份结果，有回退时返回非零退出码")
+    parser.add_argument('--threshold', type=float, default=10.0, help="视为回退的变化百分比")
+    parser.add_argument('--run-cell', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    
+    if args.run_cell:
+        print(json.dumps(run_cell(json.loads(args.run_cell))))
+        return 0
+        
+    if not args.compare:
+        report = run_suite(args)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            print(f"结果已写入: {args.output}")
+        return 0
+        
+    with open(args.compare[0], 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.compare[1], 'r', encoding='utf-8') as f:
+        current = json.load(f)
+    regressions = compare(baseline, current, args.threshold)
+    print(f"对比 {baseline['meta'].get('commit')} -> {current['meta'].get('commit')}，阈值 {args.threshold}%")
+    for item in regressions:
+        cell = item['cell']
+        print(f"回退: {cell['engine']} {cell['network']} {cell['size']}x{cell['count']} chunk {cell['chunk_size']} "
+              f"c{cell['concurrency']}  {item['metric']} {item['baseline']:.2f} -> {item['current']:.2f} "
+              f"({item['change_pct']:+.1f}%)")
+    if not regressions:
+        print("没有发现性能回退")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
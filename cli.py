@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# LAN File Share System
+# 命令行入口（lan-share），不导入 tkinter，适合无图形界面的服务器
+#
+# 用法:
+#   python cli.py serve [--port 50002] [--dir 下载目录] [--engine asyncio] [--daemon --pid-file lan-share.pid]
+#   python cli.py send 192.168.1.10 文件或目录...
+#   python cli.py send --swarm 192.168.1.10,192.168.1.11,... 文件...
+#   python cli.py discover
+#   python cli.py bench [engines|transfer|rate-limit] [基准测试参数]
+
+import os
+import sys
+import argparse
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# 各子命令只在执行时导入需要的网络模块，保持启动速度
+
+# bench 子命令可选的基准测试 {'名称': 模块}，不指定名称时运行接收引擎基准测试
+BENCHMARKS = {
+    'engines': 'bench.server_engines',
+    'transfer': 'bench.transfer',
+    'rate-limit': 'bench.rate_limit',
+}
+
+
+def parse_target(target, default_port):
+    """解析 ip 或 ip:port"""
+    host, _, port = target.partition(':')
+    return host, int(port) if port else default_port
+
+
+def parse_rate(text):
+    """解析限速，如 '500K'、'20M'、'1G'（字节/秒），也接受不带单位的字节数"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper()
+    text = text[:-2] if text.endswith('/S') else text
+    text = text[:-1] if text.endswith('B') else text
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def cmd_serve(args):
+    """运行文件接收服务"""
+    import signal
+    import threading
+    
+    # 后台运行时工作目录切换到 /，相对路径先按当前目录转换为绝对路径
+    for name in ('pid_file', 'log_file', 'dir'):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    # 在脱离终端之前检查PID文件，服务已在运行时错误信息输出到终端
+    if args.pid_file:
+        _check_pid_file(args.pid_file)
+    if args.daemon:
+        _daemonize(args.log_file)
+    if args.pid_file:
+        _write_pid_file(args.pid_file)
+        
+    from server.server_app import ServerApp
+    
+    server = ServerApp(args.host, args.port, args.dir)
+    if args.limit:
+        server.set_download_limit(args.limit)
+    if args.mmap:
+        server.file_receiver.mmap_receive = True
+    if args.metrics_port:
+        server.start_metrics_server(args.metrics_port)
+    stop_event = threading.Event()
+    
+    def handle_signal(signum, frame):
+        stop_event.set()
+        
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    
+    try:
+        server.start(args.engine)
+        print(f"接收文件保存到: {server.file_receiver.download_dir}", flush=True)
+        # Event.wait 不带超时时无法被信号打断，因此循环等待
+        while not stop_event.wait(1.0):
+            pass
+    finally:
+        server.stop()
+        if args.pid_file:
+            _remove_pid_file(args.pid_file)
+    return 0
+
+
+def cmd_send(args):
+    """向一个或多个设备发送文件和目录"""
+    targets = [parse_target(target, args.port) for target in args.target.split(',')]
+    options = {}
+    if args.streams:
+        options['streams'] = args.streams
+    if args.no_resume:
+        options['resume'] = False
+    if args.delta:
+        options['delta'] = True
+    if args.no_compress:
+        options['compress'] = False
+    if args.limit:
+        options['rate_limit'] = args.limit
+        
+    for path in args.paths:
+        if not os.path.exists(path):
+            print(f"文件不存在: {path}", file=sys.stderr)
+            return 1
+        
+    if args.swarm:
+        return _send_swarm(args.paths, targets)
+    if len(targets) > 1:
+        return _send_to_many(args.paths, targets, options)
+    return _send_to_one(args.paths, targets[0], options)
+
+
+def _send_to_one(paths, target, options):
+    """向一个设备发送：单个文件直接发送，多个文件使用会话，目录使用目录传输"""
+    from server.file_transfer import FileSender
+    
+    ip, port = target
+    sender = FileSender()
+    failed = []
+    files = [path for path in paths if not os.path.isdir(path)]
+    folders = [path for path in paths if os.path.isdir(path)]
+    
+    if len(files) == 1:
+        try:
+            sender.send_file(files[0], ip, port, **options)
+        except Exception as e:
+            failed.append(f"{files[0]} ({e})")
+    elif files:
+        from server.session import SessionSender
+        session = SessionSender(sender, ip, port)
+        try:
+            results = session.send_files(files)
+        finally:
+            session.close()
+        failed.extend(path for path, ok in results.items() if not ok)
+        
+    if folders:
+        from server.tree_transfer import TreeSender
+        for folder in folders:
+            try:
+                summary = TreeSender(sender).send_tree(folder, ip, port)
+                failed.extend(os.path.join(folder, path) for path in summary['failed'])
+            except Exception as e:
+                failed.append(f"{folder} ({e})")
+        
+    return _report_failures(failed)
+
+
+def _send_to_many(paths, targets, options):
+    """通过调度器并发发送到多个设备"""
+    from client.client_app import ClientApp
+    
+    client = ClientApp()
+    scheduler = client.get_scheduler()
+    tasks = [scheduler.submit(path, ip, port, **options) for ip, port in targets for path in paths]
+    try:
+        scheduler.wait()
+    finally:
+        client.stop()
+    failed = [f"{task['file_path']} -> {task['target_ip']}:{task['target_port']} ({task['error']})"
+              for task in tasks if task['status'] != 'completed']
+    return _report_failures(failed)
+
+
+def _send_swarm(paths, targets):
+    """把每个文件分发到所有设备，接收方之间互相转发分片"""
+    from server.file_transfer import FileSender
+    from server.swarm import SwarmSender
+    
+    sender = SwarmSender(FileSender())
+    failed = []
+    for path in paths:
+        if os.path.isdir(path):
+            failed.append(f"{path} (分发模式不支持目录)")
+            continue
+        try:
+            results = sender.send_file(path, targets)
+        except Exception as e:
+            failed.append(f"{path} ({e})")
+            continue
+        failed.extend(f"{path} -> {ip}:{port}" for (ip, port), ok in results.items() if not ok)
+    return _report_failures(failed)
+
+
+def _report_failures(failed):
+    """输出失败列表并返回退出码"""
+    if failed:
+        print(f"\n{len(failed)} 项发送失败:", file=sys.stderr)
+        for item in failed:
+            print(f"  {item}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def cmd_discover(args):
+    """发现局域网内的设备"""
+    from client.discovery import DeviceDiscovery
+    
+    devices = DeviceDiscovery().discover_devices()
+    if not devices:
+        print("未发现设备")
+        return 1
+    for device in devices:
+        print(f"{device['ip']:<16}{device.get('listen_port', 50002):<8}{device['hostname']}")
+    return 0
+
+
+def cmd_bench(args):
+    """运行基准测试，第一个参数可以是基准测试名称，其余参数原样传给基准测试"""
+    import importlib
+    
+    bench_args = args.bench_args
+    name = 'engines'
+    if bench_args and bench_args[0] in BENCHMARKS:
+        name, bench_args = bench_args[0], bench_args[1:]
+    module = importlib.import_module(BENCHMARKS[name])
+    return module.main(bench_args) or 0
+
+
+def _daemonize(log_file):
+    """脱离终端在后台运行（POSIX 两次 fork），标准输出和错误重定向到日志文件"""
+    if not hasattr(os, 'fork'):
+        raise SystemExit("当前平台不支持后台运行")
+    # 日志文件在 fork 之前打开，无法打开时错误信息输出到终端
+    log = open(log_file or os.devnull, 'ab')
+    if os.fork() > 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+        
+    os.chdir('/')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with open(os.devnull, 'rb') as devnull:
+        os.dup2(devnull.fileno(), sys.stdin.fileno())
+    with log:
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+
+
+def _check_pid_file(pid_file):
+    """PID文件中记录的进程仍在运行时退出"""
+    try:
+        with open(pid_file, 'r') as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+    except (OSError, ValueError):
+        pass
+    else:
+        raise SystemExit(f"服务已在运行 (PID {pid}): {pid_file}")
+        
+
+def _write_pid_file(pid_file):
+    """写入PID文件，已有进程在运行时退出"""
+    _check_pid_file(pid_file)
+    temp_path = f"{pid_file}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(f"{os.getpid()}\n")
+    os.replace(temp_path, pid_file)
+
+
+def _remove_pid_file(pid_file):
+    """删除属于本进程的PID文件"""
+    try:
+        with open(pid_file, 'r') as f:
+            if int(f.read().strip()) != os.getpid():
+                return
+        os.remove(pid_file)
+    except (OSError, ValueError):
+        pass
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='lan-share', description="局域网文件共享命令行工具")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    
+    serve = subparsers.add_parser('serve', help="运行文件接收服务")
+    serve.add_argument('--host', default='0.0.0.0', help="监听地址")
+    serve.add_argument('--port', type=int, default=50002, help="监听端口")
+    serve.add_argument('--dir', default=None, help="下载目录，默认 ~/Downloads/LANFileShare")
+    serve.add_argument('--engine', choices=['threaded', 'asyncio'], default=None, help="接收引擎，默认使用配置")
+    serve.add_argument('--daemon', action='store_true', help="在后台运行")
+    serve.add_argument('--pid-file', default=None, help="PID文件路径")
+    serve.add_argument('--log-file', default=None, help="后台运行时的日志文件")
+    serve.add_argument('--limit', type=parse_rate, default=None, help="接收限速，如 20M（字节/秒）")
+    serve.add_argument('--mmap', action='store_true', help="大文件使用内存映射接收，确认前数据已落盘")
+    serve.add_argument('--metrics-port', type=int, default=None,
+                       help="在本机该端口提供指标接口（/metrics、/metrics.json）")
+    serve.set_defaults(func=cmd_serve)
+    
+    send = subparsers.add_parser('send', help="发送文件或目录")
+    send.add_argument('target', help="目标设备 ip[:port]，多个设备用逗号分隔")
+    send.add_argument('paths', nargs='+', help="要发送的文件或目录")
+    send.add_argument('--port', type=int, default=50002, help="目标端口（target 未指定端口时使用）")
+    send.add_argument('--streams', type=int, default=None, help="大文件使用的并发连接数")
+    send.add_argument('--no-resume', action='store_true', help="不使用断点续传")
+    send.add_argument('--delta', action='store_true', help="只发送与接收方同名文件不同的部分")
+    send.add_argument('--no-compress', action='store_true', help="不使用压缩")
+    send.add_argument('--limit', type=parse_rate, default=None, help="每个文件传输的限速，如 20M（字节/秒）")
+    send.add_argument('--swarm', action='store_true', help="分发模式：接收方之间互相转发分片，适合把大文件发往很多设备")
+    send.set_defaults(func=cmd_send)
+    
+    discover = subparsers.add_parser('discover', help="发现局域网内的设备")
+    discover.set_defaults(func=cmd_discover)
+    
+    bench = subparsers.add_parser('bench', help="运行基准测试（engines/transfer/rate-limit），其余参数原样传给对应的 bench 模块", add_help=False)
+    bench.set_defaults(func=cmd_bench)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    # bench 的参数原样传给基准测试，其他子命令不接受未知参数
+    args, extra = parser.parse_known_args(argv)
+    if args.command == 'bench':
+        args.bench_args = extra
+    elif extra:
+        parser.error(f"无法识别的参数: {' '.join(extra)}")
+    try:
+        return args.func(args)
+    except KeyboardInterrupt:
+        print("\n已取消", file=sys.stderr)
+        return 130
+
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -7,15 +7,53 @@ from datetime import datetime
 # 添加项目根目录到系统路径
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from config import RATE_LIMIT_UPLOAD, RATE_LIMIT_PEERS, RATE_LIMIT_SCHEDULE
 from client.discovery import DeviceDiscovery
 from server.file_transfer import FileSender
+from server.rate_limit import RateLimiter
+from server.session import SessionSender
+from server.swarm import SwarmSender
+from server.tree_transfer import TreeSender
+from utils.concurrent_utils import TransferScheduler
+from utils.metrics import registry, queue_depth
+
+
+class _TaskProgress:
+    """调度任务的进度回调：更新任务字典中的进度，并把取消请求作为中断标志提供给 FileSender"""
+    
+    def __init__(self, task, progress_callback=None):
+        self.task = task
+        self.progress_callback = progress_callback
+        
+    @property
+    def interrupted(self):
+        return self.task.get('cancel_requested', False)
+        
+    def update_progress(self, sent_size, total_size):
+        self.task['progress'] = (sent_size / total_size) * 100 if total_size else 100.0
+        if self.progress_callback:
+            self.progress_callback(self.task, sent_size, total_size)
 
 
 class ClientApp:
-    def __init__(self):
-        self.device_discovery = DeviceDiscovery()
-        self.file_sender = FileSender()
+    def __init__(self, peer_table=None, listen_port=None, on_peer_joined=None, on_peer_left=None,
+                 on_peer_updated=None):
+        # peer_table 可以与 ServerApp 共用，两边发现的设备记录在同一张表中
+        # on_peer_joined/on_peer_left/on_peer_updated 在设备加入/离开/信息变化时立即调用，调用发生在后台线程
+        self.device_discovery = DeviceDiscovery(peer_table, listen_port, on_peer_joined, on_peer_left,
+                                                on_peer_updated)
+        # 所有发送共用的限速设置（全局、每个对端、按时段）
+        self.rate_limiter = RateLimiter(RATE_LIMIT_UPLOAD, RATE_LIMIT_PEERS, RATE_LIMIT_SCHEDULE)
+        self.file_sender = FileSender(self.device_discovery.peer_table, self.rate_limiter)
         self.progress_tracker = None
+        # 与各个对端保持的批量传输会话 {(ip, port): SessionSender}
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        # 并发传输调度器，首次使用时创建
+        self.scheduler = None
+        self.scheduled_progress_callback = None
+        # 正在执行的调度任务使用的 FileSender {任务ID: FileSender}，用于运行时修改单个传输的限速
+        self.task_senders = {}
         self.is_running = False
         
     def start(self):
@@ -27,13 +65,42 @@ class ClientApp:
         """停止客户端应用"""
         self.is_running = False
         self.device_discovery.stop_discovery()
+        with self.sessions_lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+        if self.scheduler:
+            self.scheduler.shutdown(wait=False)
+            self.scheduler = None
         
     def discover_devices(self):
         """发现局域网内的设备"""
         return self.device_discovery.discover_devices()
         
-    def send_file_to_device(self, file_path, target_ip, target_port=50002, progress_callback=None):
-        """向指定设备发送文件"""
+    def get_metrics(self):
+        """发送方向的指标快照：字节数和速率、I/O调用次数、块延迟直方图、进行中的传输数等"""
+        return registry.snapshot(direction='send')
+        
+    def set_upload_limit(self, rate, peer_ip=None):
+        """修改发送限速（字节/秒，0 表示不限速），peer_ip 为空时修改全局限速，正在进行的传输立即生效"""
+        if peer_ip is None:
+            self.rate_limiter.set_global_limit(rate)
+        else:
+            self.rate_limiter.set_peer_limit(peer_ip, rate)
+        
+    def set_upload_schedule(self, schedule):
+        """修改按时段的全局发送限速 [('09:00', '18:00', 速率), ...]"""
+        self.rate_limiter.set_schedule(schedule)
+        
+    def set_task_rate_limit(self, task, rate):
+        """修改一个调度任务的限速，任务正在执行时立即生效，重试时沿用"""
+        task['options']['rate_limit'] = rate
+        sender = self.task_senders.get(task['id'])
+        if sender is not None:
+            sender.set_rate_limit(rate)
+        
+    def send_file_to_device(self, file_path, target_ip, target_port=50002, progress_callback=None, **options):
+        """向指定设备发送文件，options 为传输选项（streams/resume/delta/compress/rate_limit），参见 FileSender.send_file"""
         try:
             # 设置进度回调
             if progress_callback:
@@ -41,9 +108,89 @@ class ClientApp:
                 self.file_sender.transfer_callback = progress_callback.update_progress
             
             # 启动文件发送
-            self.file_sender.send_file(file_path, target_ip, target_port)
+            self.file_sender.send_file(file_path, target_ip, target_port, **options)
             print(f"文件 {file_path} 已成功发送到 {target_ip}:{target_port}")
             return True
         except Exception as e:
             print(f"发送文件失败: {e}")
-            raise
\ No newline at end of file
+            raise
+            
+    def send_files_to_device(self, file_paths, target_ip, target_port=50002, progress_callback=None):
+        """通过与设备保持的持久会话批量发送文件，返回 {文件路径: 是否发送成功}"""
+        # 设置进度回调
+        if progress_callback:
+            self.progress_tracker = progress_callback
+            self.file_sender.transfer_callback = progress_callback.update_progress
+            
+        with self.sessions_lock:
+            session = self.sessions.get((target_ip, target_port))
+            if session is None:
+                session = SessionSender(self.file_sender, target_ip, target_port)
+                self.sessions[(target_ip, target_port)] = session
+                
+        try:
+            return session.send_files(file_paths)
+        except Exception as e:
+            print(f"批量发送文件失败: {e}")
+            raise
+            
+    def send_directory_to_device(self, dir_path, target_ip, target_port=50002, progress_callback=None):
+        """向指定设备发送整个目录，返回接收方的汇总 {'root', 'files', 'failed'}"""
+        # 设置进度回调
+        if progress_callback:
+            self.progress_tracker = progress_callback
+            self.file_sender.transfer_callback = progress_callback.update_progress
+            
+        try:
+            return TreeSender(self.file_sender).send_tree(dir_path, target_ip, target_port)
+        except Exception as e:
+            print(f"发送目录失败: {e}")
+            raise
+            
+    def send_file_swarm(self, file_path, targets=None):
+        """把一个文件分发到多个设备，接收方之间互相转发分片，源端通常只需上传约一份数据
+        
+        targets 为 [(ip, port), ...]，为空时发往发现到的所有支持分发的设备；返回 {(ip, port): 是否成功}
+        """
+        if targets is None:
+            targets = [(peer['ip'], peer['listen_port'])
+                       for peer in self.device_discovery.peer_table.find_by_capability('swarm')]
+        try:
+            return SwarmSender(self.file_sender).send_file(file_path, targets)
+        except Exception as e:
+            print(f"分发文件失败: {e}")
+            raise
+        
+    def get_scheduler(self, on_task_done=None, progress_callback=None):
+        """获取传输调度器；progress_callback(task, sent, total) 和 on_task_done(task) 在工作线程中调用
+        
+        传入的回调替换之前设置的回调，之后提交的任务使用新的回调
+        """
+        if self.scheduler is None:
+            self.scheduler = TransferScheduler(self._run_scheduled_transfer)
+            queue_depth('scheduler').set_function(self.scheduler.transfer_queue.get_queue_size)
+        if on_task_done:
+            self.scheduler.on_task_done = on_task_done
+        if progress_callback:
+            self.scheduled_progress_callback = progress_callback
+        return self.scheduler
+        
+    def send_file_to_devices(self, file_path, targets, priority=0, wait=True, **options):
+        """把一个文件并发发送到多个设备，targets 为 [(ip, port), ...]，返回任务列表"""
+        scheduler = self.get_scheduler()
+        tasks = [scheduler.submit(file_path, ip, port, priority=priority, **options) for ip, port in targets]
+        if wait:
+            scheduler.wait()
+        return tasks
+        
+    def _run_scheduled_transfer(self, task):
+        """调度器工作线程中执行一次传输，每个任务使用独立的 FileSender 以免进度回调互相干扰"""
+        sender = FileSender(self.device_discovery.peer_table, self.rate_limiter)
+        sender.transfer_callback = _TaskProgress(task, self.scheduled_progress_callback).update_progress
+        if os.path.isdir(task['file_path']):
+            return TreeSender(sender).send_tree(task['file_path'], task['target_ip'], task['target_port'])
+        self.task_senders[task['id']] = sender
+        try:
+            return sender.send_file(task['file_path'], task['target_ip'], task['target_port'], **task['options'])
+        finally:
+            self.task_senders.pop(task['id'], None)
\ No newline at end of file
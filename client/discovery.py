@@ -1,146 +1,290 @@
 # client/discovery.py
 import socket
-import json
+import ipaddress
+import random
+import selectors
 import threading
 import time
 import sys
 import os
-from datetime import datetime
 
 # 添加项目根目录到系统路径
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from utils.network_utils import create_udp_socket, receive_broadcast_messages, get_local_ip
-from config import UDP_PORT, UDP_BROADCAST_ADDR, LOCAL_HOSTNAME
+from utils.network_utils import (drain_datagrams, get_local_ip, set_multicast_options, send_multicast,
+                                 INSTANCE_ID)
+from utils.interfaces import list_interfaces
+from utils.dnssd import dnssd_enabled, DnsSdBrowser
+from utils.peer_table import PeerTable
+from utils.wire import encode_datagram
+from config import (WIRE_FORMAT, UDP_PORT, UDP_BROADCAST_ADDR, LOCAL_HOSTNAME, DISCOVERY_REPLY_WINDOW, DISCOVERY_PEER_TTL,
+                    DISCOVERY_ANNOUNCE_MIN, DISCOVERY_ANNOUNCE_MAX, DISCOVERY_ANNOUNCE_JITTER, DISCOVERY_TRANSPORTS,
+                    DISCOVERY_MULTICAST_GROUP, DISCOVERY_MULTICAST_GROUP6, DISCOVERY_MULTICAST_TTL)
 
 class DeviceDiscovery:
-    def __init__(self):
-        self.devices = {}  # 存储发现的设备 {'ip': {'hostname': ..., 'last_seen': ...}}
+    """设备发现：事件驱动的发现循环
+    
+    发现线程阻塞在 selectors 上，只在收到应答、到了下一次发送发现请求的时间、
+    有设备到期或被 stop/discover_devices 唤醒时才运行。发现请求的间隔从
+    DISCOVERY_ANNOUNCE_MIN 开始每次翻倍，直到 DISCOVERY_ANNOUNCE_MAX，并加入随机抖动；
+    手动刷新或网卡变化时重新从最短间隔开始。设备加入、离开或信息变化时立即调用
+    on_peer_joined(peer) / on_peer_left(peer) / on_peer_updated(peer)。
+    
+    每轮按 DISCOVERY_TRANSPORTS 在每块网卡上各发一个包：IPv4/IPv6 组播只有加入了组播组的设备会收到，
+    子网定向广播用于屏蔽了组播的网络；安装了 zeroconf 时同时浏览 DNS-SD 服务。
+    """
+    
+    def __init__(self, peer_table=None, listen_port=None, on_peer_joined=None, on_peer_left=None,
+                 on_peer_updated=None):
+        # 发现的设备记录在设备表中，可以与接收端的发现应答服务共用
+        self.peer_table = peer_table if peer_table is not None else PeerTable()
+        # 本机接收文件的端口，随发现请求告知对端
+        self.listen_port = listen_port
+        self.on_peer_joined = on_peer_joined
+        self.on_peer_left = on_peer_left
+        self.on_peer_updated = on_peer_updated
+        self.peer_table.subscribe(self._on_peer_change)
         self.local_ip = get_local_ip()
         self.running = False
         self.discovery_thread = None
+        # 发送请求、接收应答的套接字 [IPv4, IPv6(可选)]
+        self.sockets = []
+        # 上一轮发送时使用的网卡地址，网卡变化时重新开始快速发现
+        self.interfaces = []
+        self.browser = None
+        # 用于从其他线程唤醒发现循环的套接字对
+        self.wakeup_reader = None
+        self.wakeup_writer = None
+        self.announce_requested = False
+        
+    @property
+    def devices(self):
+        """当前发现的设备 {'ip': 设备信息}"""
+        return {peer['ip']: peer for peer in self.peer_table.get_peers()}
         
     def start_discovery(self):
         """启动设备发现服务"""
+        self.sockets = self._create_sockets()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
         self.running = True
         self.discovery_thread = threading.Thread(target=self._discovery_loop, daemon=True)
         self.discovery_thread.start()
+        if dnssd_enabled():
+            try:
+                self.browser = DnsSdBrowser(self.peer_table, INSTANCE_ID)
+                self.browser.start()
+            except Exception as e:
+                print(f"DNS-SD 浏览启动失败: {e}")
+                self.browser = None
         
     def stop_discovery(self):
         """停止设备发现服务"""
         self.running = False
+        if self.browser:
+            self.browser.stop()
+            self.browser = None
         if self.discovery_thread:
+            self._wakeup()
             self.discovery_thread.join(timeout=2)
+            self.discovery_thread = None
+            self.wakeup_reader.close()
+            self.wakeup_writer.close()
             
+    def _create_sockets(self):
+        """创建发送发现请求的非阻塞套接字，应答以单播发回这些套接字绑定的端口"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        set_multicast_options(sock, socket.AF_INET, DISCOVERY_MULTICAST_TTL)
+        sock.bind(('', 0))
+        sock.setblocking(False)
+        sockets = [sock]
+        
+        if 'multicast6' in DISCOVERY_TRANSPORTS and socket.has_ipv6:
+            try:
+                sock6 = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+                set_multicast_options(sock6, socket.AF_INET6, DISCOVERY_MULTICAST_TTL)
+                sock6.bind(('::', 0))
+                sock6.setblocking(False)
+                sockets.append(sock6)
+            except OSError as e:
+                print(f"IPv6 发现不可用: {e}")
+        return sockets
+        
+    def _wakeup(self):
+        """唤醒阻塞在 select 上的发现线程"""
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            pass
+        
     def _discovery_loop(self):
         """设备发现主循环"""
-        discovery_sock = create_udp_socket()
-        broadcast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        broadcast_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        selector = selectors.DefaultSelector()
+        for sock in self.sockets:
+            selector.register(sock, selectors.EVENT_READ)
+        selector.register(self.wakeup_reader, selectors.EVENT_READ)
+        interval = DISCOVERY_ANNOUNCE_MIN
+        next_announce = time.monotonic()
         
-        while self.running:
-            try:
-                # 发送发现广播
-                self._send_discovery_broadcast(broadcast_sock)
-                
-                # 接收响应
-                responses = receive_broadcast_messages(discovery_sock, timeout=1.0)
-                
-                # 处理收到的消息
-                for msg, addr in responses:
-                    if msg.get('type') == 'discovery':
-                        self._handle_discovery_message(msg, addr)
-                    elif msg.get('type') == 'response':
-                        self._handle_response_message(msg, addr)
+        try:
+            while self.running:
+                if self.announce_requested:
+                    # 手动刷新：立即发送并从最短间隔重新开始退避
+                    self.announce_requested = False
+                    interval = DISCOVERY_ANNOUNCE_MIN
+                    next_announce = time.monotonic()
+                    
+                now = time.monotonic()
+                if now >= next_announce:
+                    if self._announce(self.sockets):
+                        # 网卡变化（接入了新网络），重新开始快速发现
+                        interval = DISCOVERY_ANNOUNCE_MIN
+                    jitter = random.uniform(1 - DISCOVERY_ANNOUNCE_JITTER, 1 + DISCOVERY_ANNOUNCE_JITTER)
+                    next_announce = now + interval * jitter
+                    interval = min(interval * 2, DISCOVERY_ANNOUNCE_MAX)
+                    
+                timeout = next_announce - now
+                expiry = self.peer_table.next_expiry(DISCOVERY_PEER_TTL)
+                if expiry is not None:
+                    # 多等一点，保证醒来时最早的设备已经过期
+                    timeout = min(timeout, expiry + 0.01)
+                    
+                for key, _ in selector.select(max(0.0, timeout)):
+                    if key.fileobj is self.wakeup_reader:
+                        self._drain_wakeup()
+                    else:
+                        self._handle_responses(key.fileobj, drain_datagrams(key.fileobj))
                 
                 # 清理过期设备
                 self._cleanup_expired_devices()
+        except Exception as e:
+            print(f"设备发现循环中出现错误: {e}")
+        finally:
+            selector.close()
+            for sock in self.sockets:
+                sock.close()
+            self.sockets = []
                 
-            except Exception as e:
-                print(f"设备发现循环中出现错误: {e}")
-            
-            # 等待一段时间再继续
-            time.sleep(5)  # 每5秒发送一次发现请求
+    def _drain_wakeup(self):
+        """清空唤醒套接字"""
+        try:
+            while self.wakeup_reader.recv(64):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
             
-        discovery_sock.close()
-        broadcast_sock.close()
+    def _handle_responses(self, sock, responses):
+        """处理收到的应答，忽略本进程自己的消息"""
+        for msg, addr in responses:
+            if msg.get('type') == 'response' and msg.get('instance') != INSTANCE_ID:
+                self._handle_response_message(sock, msg, addr)
         
-    def _send_discovery_broadcast(self, sock):
-        """发送设备发现广播"""
+    def _announce(self, sockets):
+        """在每块网卡上按配置的方式各发送一次发现请求，返回网卡地址是否与上一轮不同"""
+        interfaces = list_interfaces()
+        changed = [item['address'] for item in interfaces] != [item['address'] for item in self.interfaces]
+        self.interfaces = interfaces
         discovery_msg = {
             'type': 'discovery',
             'hostname': LOCAL_HOSTNAME,
             'ip': self.local_ip,
-            'timestamp': datetime.now().isoformat()
+            'listen_port': self.listen_port,
+            'instance': INSTANCE_ID
         }
-        message = json.dumps(discovery_msg).encode('utf-8')
-        sock.sendto(message, (UDP_BROADCAST_ADDR, UDP_PORT))
+        # 旧版本的应答方只能解析JSON，局域网中还有旧版本时把 WIRE_FORMAT 设为 'json'
+        message = encode_datagram(discovery_msg, WIRE_FORMAT == 'binary')
+        ipv4 = [item for item in interfaces if item['family'] == socket.AF_INET]
         
-    def _handle_discovery_message(self, msg, addr):
-        """处理收到的发现消息"""
-        sender_ip = msg.get('ip', addr[0])
-        sender_hostname = msg.get('hostname', 'Unknown')
+        if 'multicast' in DISCOVERY_TRANSPORTS:
+            for interface in ipv4:
+                self._send(send_multicast, sockets[0], message, DISCOVERY_MULTICAST_GROUP, UDP_PORT, interface)
+        if 'multicast6' in DISCOVERY_TRANSPORTS and len(sockets) > 1:
+            # 每块网卡只发一次，不管网卡上有几个IPv6地址
+            by_index = {item['index']: item for item in interfaces if item['family'] == socket.AF_INET6}
+            for interface in by_index.values():
+                self._send(send_multicast, sockets[1], message, DISCOVERY_MULTICAST_GROUP6, UDP_PORT, interface)
+        if 'broadcast' in DISCOVERY_TRANSPORTS:
+            # 子网定向广播，不知道子网时退回到受限广播
+            targets = {item['broadcast'] for item in ipv4 if item['broadcast']} or {UDP_BROADCAST_ADDR}
+            for target in targets:
+                self._send(sockets[0].sendto, message, (target, UDP_PORT))
+        return changed
         
-        # 更新设备列表
-        self.devices[sender_ip] = {
-            'hostname': sender_hostname,
-            'last_seen': datetime.now(),
-            'ip': sender_ip
-        }
+    def _send(self, send, *args):
+        """发送一个数据包，个别网卡发送失败不影响其他网卡"""
+        try:
+            send(*args)
+        except OSError as e:
+            print(f"发送发现请求失败: {e}")
         
-    def _handle_response_message(self, msg, addr):
+    def _handle_response_message(self, sock, msg, addr):
         """处理收到的响应消息"""
-        sender_ip = msg.get('ip', addr[0])
-        sender_hostname = msg.get('hostname', 'Unknown')
+        if sock.family == socket.AF_INET:
+            # 以数据包的来源地址为准，对端自报的IP可能是其他网卡的地址
+            ip = addr[0]
+        else:
+            # 文件传输走IPv4，通过IPv6收到的应答从对端的IPv4地址中选择
+            ip = self._select_ipv4(msg.get('addresses') or [], msg.get('ip'))
+            if not ip:
+                return
+        self.peer_table.update(ip, msg.get('hostname', 'Unknown'), msg.get('listen_port', 50002),
+                               msg.get('capabilities'))
+    
+    def _select_ipv4(self, addresses, default):
+        """优先选择与本机某块网卡在同一子网的对端地址"""
+        for interface in self.interfaces:
+            if interface['family'] != socket.AF_INET or not interface['netmask']:
+                continue
+            network = ipaddress.IPv4Network(f"{interface['address']}/{interface['netmask']}", strict=False)
+            for address in addresses:
+                try:
+                    if ipaddress.IPv4Address(address) in network:
+                        return address
+                except ValueError:
+                    continue
+        return default
         
-        # 更新设备列表
-        self.devices[sender_ip] = {
-            'hostname': sender_hostname,
-            'last_seen': datetime.now(),
-            'ip': sender_ip,
-            'listen_port': msg.get('listen_port', 50002)
-        }
+    def _on_peer_change(self, event, peer):
+        """设备表变化时转发给回调"""
+        callback = {'joined': self.on_peer_joined, 'left': self.on_peer_left,
+                    'updated': self.on_peer_updated}.get(event)
+        if callback:
+            callback(peer)
         
     def _cleanup_expired_devices(self):
-        """清理过期的设备（超过60秒未响应）"""
-        current_time = datetime.now()
-        expired_ips = []
-        
-        for ip, device_info in self.devices.items():
-            if (current_time - device_info['last_seen']).seconds > 60:
-                expired_ips.append(ip)
-                
-        for ip in expired_ips:
-            del self.devices[ip]
+        """清理过期的设备（超过 DISCOVERY_PEER_TTL 秒未响应）"""
+        self.peer_table.expire(DISCOVERY_PEER_TTL)
             
     def discover_devices(self):
-        """主动发现设备"""
-        # 发送一次发现广播并等待响应
-        discovery_sock = create_udp_socket()
-        broadcast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        broadcast_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        
-        # 发送发现请求
-        self._send_discovery_broadcast(broadcast_sock)
-        
-        # 等待响应
-        responses = receive_broadcast_messages(discovery_sock, timeout=2.0)
-        
-        # 处理响应
-        for msg, addr in responses:
-            if msg.get('type') == 'discovery':
-                self._handle_discovery_message(msg, addr)
-            elif msg.get('type') == 'response':
-                self._handle_response_message(msg, addr)
-        
-        discovery_sock.close()
-        broadcast_sock.close()
-        
-        # 返回当前已知的所有设备
-        return list(self.devices.values())
+        """主动发现设备：立即发送一次发现请求，等待一个应答窗口后返回当前已知的所有设备"""
+        if self.discovery_thread:
+            # 发现循环正在运行，由它发送请求并接收应答
+            self.announce_requested = True
+            self._wakeup()
+            time.sleep(DISCOVERY_REPLY_WINDOW)
+            return self.get_devices()
+            
+        sockets = self._create_sockets()
+        try:
+            self._announce(sockets)
+            deadline = time.monotonic() + DISCOVERY_REPLY_WINDOW
+            with selectors.DefaultSelector() as selector:
+                for sock in sockets:
+                    selector.register(sock, selectors.EVENT_READ)
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    for key, _ in selector.select(remaining):
+                        self._handle_responses(key.fileobj, drain_datagrams(key.fileobj))
+        finally:
+            for sock in sockets:
+                sock.close()
+        return self.get_devices()
         
     def get_devices(self):
         """获取当前发现的设备列表"""
         # 清理过期设备
         self._cleanup_expired_devices()
-        return list(self.devices.values())
\ No newline at end of file
+        return self.peer_table.get_peers()
\ No newline at end of file
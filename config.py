@@ -5,14 +5,166 @@ import socket
 UDP_PORT = 50001  # 设备发现端口
 UDP_BROADCAST_ADDR = '<broadcast>'
 UDP_TIMEOUT = 5  # 秒
+DISCOVERY_REPLY_WINDOW = 0.5  # 发出发现请求后等待单播应答的时间（秒）
+DISCOVERY_REPLY_INTERVAL = 1.0  # 应答服务对同一来源的最小回复间隔（秒）
+DISCOVERY_MAX_REPLIES_PER_SEC = 50  # 应答服务每秒最多回复次数
+DISCOVERY_PEER_TTL = 60  # 超过此时间（秒）未出现的设备从设备表中移除
+DISCOVERY_MAX_DATAGRAM = 65535  # 接收发现消息的缓冲区大小，避免截断
+DISCOVERY_ANNOUNCE_MIN = 0.5  # 启动或手动刷新后第一次重发发现请求的间隔（秒），之后每次翻倍
+DISCOVERY_ANNOUNCE_MAX = 30.0  # 发现请求间隔的上限（秒），应小于 DISCOVERY_PEER_TTL
+DISCOVERY_ANNOUNCE_JITTER = 0.25  # 发现请求间隔的随机抖动比例，避免多台设备同时广播
+# 发现请求的发送方式：'multicast'（IPv4组播）、'multicast6'（IPv6链路本地组播）、
+# 'broadcast'（每块网卡的子网定向广播，用于屏蔽了组播的网络）；每种方式每块网卡每轮只发一个包
+DISCOVERY_TRANSPORTS = ('multicast', 'multicast6')
+DISCOVERY_MULTICAST_GROUP = '239.255.50.1'  # IPv4组播组（组织本地范围）
+DISCOVERY_MULTICAST_GROUP6 = 'ff02::4c53:1'  # IPv6链路本地组播组
+DISCOVERY_MULTICAST_TTL = 1  # 组播TTL/跳数限制，1表示不经过路由器
+DISCOVERY_DNSSD = True  # 安装了 zeroconf 时同时通过 DNS-SD(mDNS) 发布和浏览服务
+DISCOVERY_DNSSD_SERVICE = '_lanshare._tcp.local.'  # DNS-SD 服务类型
 
 # TCP 文件传输相关配置
 TCP_PORT_RANGE_START = 50002  # TCP 传输端口范围起始
 TCP_PORT_RANGE_END = 50100    # TCP 传输端口范围结束
+TCP_LISTEN_BACKLOG = 128  # 监听队列长度，避免突发连接被拒绝
+MAX_CONTROL_MESSAGE = 16 * 1024 * 1024  # 控制消息（传输头、回复）的最大长度，超过时断开连接
+
+# 控制消息格式：'binary' 对支持的对端使用二进制帧（struct 定长布局 + TLV 扩展字段），
+# 'json' 为兼容模式，所有消息都使用JSON（局域网中还有旧版本时使用，旧版本只能解析JSON的发现请求）；
+# 接收方总是同时接受两种格式，并按请求的格式回复
+WIRE_FORMAT = 'binary'
 
 # 设备信息
 LOCAL_HOSTNAME = socket.gethostname()
-LOCAL_IP = socket.gethostbyname(socket.gethostname())
 
 # 文件传输相关配置
-CHUNK_SIZE = 1024 * 1024  # 1MB chunks
\ No newline at end of file
+CHUNK_SIZE = 1024 * 1024  # 1MB chunks
+USE_SENDFILE = True  # 优先使用 os.sendfile 零拷贝发送，不可用时自动回退
+PROGRESS_GRANULARITY = 4 * 1024 * 1024  # 每传输 4MB 回调一次进度并检查中断
+PROGRESS_PRINT_INTERVAL = 0.5  # 终端进度输出的最小间隔（秒）
+
+# 连接调优相关配置
+TUNING_ENABLED = True  # 按测得的往返时间和吞吐量为每个连接选择块大小，必要时放大套接字缓冲区
+TCP_NODELAY_ENABLED = True  # 关闭 Nagle 算法，控制消息和小文件不等待合并
+SOCKET_BUFFER_MAX = 16 * 1024 * 1024  # 套接字发送/接收缓冲区的上限
+CHUNK_SIZE_MIN = 64 * 1024  # 自动选择的块大小下限
+CHUNK_SIZE_MAX = 4 * 1024 * 1024  # 自动选择的块大小上限
+TUNING_CHUNK_TIME = 0.02  # 每块数据大约对应的传输时间（秒）
+TUNING_DEFAULT_BANDWIDTH = 125 * 1000 * 1000  # 没有测量记录时假定的带宽（字节/秒，千兆以太网）
+TUNING_SMOOTHING = 0.3  # 对端往返时间和吞吐量的指数平滑系数
+TUNING_MIN_SAMPLE = 4 * 1024 * 1024  # 至少传输这么多数据才记录吞吐量
+
+# 接收端缓冲相关配置
+RECV_BUFFER_POOL_SIZE = 32  # 接收缓冲池最多预分配的 CHUNK_SIZE 缓冲区数量
+RECV_BUFFERS_PER_CONN = 4  # 每个连接占用的缓冲区数量，填满后一次写出
+USE_WRITEV = True  # 使用 os.writev 一次系统调用写出多个缓冲区
+PREALLOCATE_FILES = True  # 接收前使用 posix_fallocate 预分配文件空间
+
+# 内存映射接收相关配置
+MMAP_RECEIVE_ENABLED = False  # 大文件映射到内存后直接 recv_into，后台线程刷盘，确认前数据已落盘
+MMAP_MIN_SIZE = 256 * 1024 * 1024  # 至少这么大的数据才使用内存映射接收
+MMAP_FLUSH_WATERMARK = 64 * 1024 * 1024  # 每写入这么多数据请求后台线程 msync 一次
+MMAP_MAX_DIRTY = 256 * 1024 * 1024  # 未刷盘的数据超过此值时接收方等待刷盘，限制页面缓存占用
+
+# 落盘相关配置
+DURABLE_COMMIT = True  # 重命名为最终文件前 fsync 数据，重命名后 fsync 所在目录，确认时文件已经持久化
+COMMIT_FSYNC_WORKERS = 8  # 一批小文件并发 fsync 的线程数，文件系统会把并发的 fsync 合并到同一次日志提交
+
+# 多连接分段传输相关配置
+DEFAULT_STREAMS = 1  # 单个文件默认使用的连接数，大于1时启用分段传输
+MAX_STREAMS_PER_TRANSFER = 8  # 接收端允许单个文件使用的最大连接数
+STRIPE_MIN_SIZE = 64 * 1024 * 1024  # 小于此大小的文件始终使用单连接
+STRIPE_FINALIZE_TIMEOUT = 300  # 等待所有分段到齐的最长时间（秒）
+
+# 断点续传相关配置
+RESUME_ENABLED = True  # 发送时与接收方协商断点，只发送缺失部分
+RESUME_JOURNAL_INTERVAL = 64 * 1024 * 1024  # 每接收 64MB 刷盘并更新一次断点日志
+RESUME_VERIFY_SIZE = 1024 * 1024  # 续传前校验断点之前最后 1MB 数据
+
+# 增量同步相关配置
+DELTA_ENABLED = False  # 默认是否使用增量传输（只发送与接收方同名文件不同的部分）
+DELTA_MIN_BLOCK = 8 * 1024  # 签名块大小下限
+DELTA_MAX_BLOCK = 1024 * 1024  # 签名块大小上限
+DELTA_ROLL_GIVEUP_BLOCKS = 4  # 连续多少块找不到匹配后停止逐字节滚动查找
+DELTA_MAX_LITERAL = 4 * 1024 * 1024  # 单个原样数据操作的最大长度
+
+# 流式压缩相关配置
+COMPRESSION_ENABLED = True  # 采样判断可压缩时启用压缩
+COMPRESSION_CODECS = ['zstd', 'lz4', 'zlib']  # 按优先级排列，zstd/lz4 需要安装对应的第三方库，可加入 'lzma'
+COMPRESSION_MIN_SIZE = 64 * 1024  # 小于此大小的文件不压缩
+COMPRESSION_SAMPLE_SIZE = 256 * 1024  # 采样的数据量
+COMPRESSION_MAX_RATIO = 0.9  # 采样压缩后不超过原大小的 90% 才启用压缩
+COMPRESSION_QUEUE_SIZE = 8  # 压缩线程与发送线程之间的队列长度（数据块数）
+COMPRESSION_STARVE_RATIO = 0.25  # 发送线程等待压缩的时间超过此比例时停止压缩
+
+# 完整性校验相关配置（单连接和分段传输）
+INTEGRITY_ENABLED = True  # 双方在后台线程中计算分块摘要，接收方请求重发不一致的块，最终确认携带整个文件的摘要
+# 摘要算法按优先级排列：有 SHA 指令扩展的CPU上 sha256 比 blake2b 快；可加入 'xxh3'（需要安装 xxhash，非加密哈希，速度更快）
+INTEGRITY_ALGORITHMS = ['sha256', 'blake2b']
+INTEGRITY_CHUNK_SIZE = 1024 * 1024  # 每个分块摘要覆盖的数据量，也是重发的最小单位
+INTEGRITY_MAX_ROUNDS = 3  # 最多请求重发的轮数，之后仍不一致则传输失败
+
+# 限速相关配置（字节/秒，0 表示不限速），运行时可以通过 ClientApp/ServerApp 修改
+RATE_LIMIT_UPLOAD = 0  # 全局发送限速
+RATE_LIMIT_DOWNLOAD = 0  # 全局接收限速
+RATE_LIMIT_PEERS = {}  # 发往各个对端的限速，如 {'192.168.1.10': 10 * 1024 * 1024}
+# 按时段的全局发送限速，命中时覆盖 RATE_LIMIT_UPLOAD，结束早于开始的时段跨越零点
+# 如 [('09:00', '18:00', 20 * 1024 * 1024), ('22:00', '06:00', 0)]
+RATE_LIMIT_SCHEDULE = []
+RATE_LIMIT_BURST = 0.05  # 令牌桶容量（秒），空闲后允许的突发量为速率乘以此值
+RATE_LIMIT_SLICE = 0.02  # 限速时每次发送/接收约此时长的数据量（秒）
+RATE_LIMIT_MIN_SLEEP = 0.002  # 欠额不足此时长（秒）时不休眠，累积到之后一起等待
+
+# 接收服务器引擎相关配置
+SERVER_ENGINE = 'threaded'  # 'threaded': 每个连接一个线程；'asyncio': 事件循环 + 有界并发
+ASYNC_MAX_CONCURRENT = 256  # asyncio 引擎同时处理的最大连接数
+ASYNC_IO_WORKERS = 4  # asyncio 引擎写文件使用的线程数
+ASYNC_HANDOFF_WORKERS = 64  # asyncio 引擎处理分段/增量/压缩等同步流程使用的线程数
+
+# 批量传输会话相关配置
+SESSION_CONNECTIONS = 2  # 每个对端会话使用的持久连接数
+SESSION_WINDOW = 32  # 每条连接允许未确认的帧数
+SESSION_MAX_WINDOW = 256  # 接收端允许的最大窗口
+SESSION_COALESCE_SIZE = 64 * 1024  # 小于此大小的文件合并到批量帧中发送
+SESSION_BATCH_BYTES = 1024 * 1024  # 单个批量帧的最大数据量
+SESSION_BATCH_FILES = 256  # 单个批量帧的最大文件数
+SESSION_ACK_TIMEOUT = 60  # 批量发送结束后等待剩余确认的最长时间（秒）
+
+# 目录传输相关配置（小文件合并规则与批量传输会话相同）
+TREE_PACK_WORKERS = 4  # 预先读取小文件的线程数
+TREE_PREFETCH_FRAMES = 16  # 发送时最多预读的帧数
+
+# 多设备分发相关配置（一个文件发往多个设备时，接收方之间互相转发分片）
+SWARM_PIECE_SIZE = 4 * 1024 * 1024  # 分片大小，每个分片按清单中的摘要单独校验
+SWARM_DOWNLOAD_WORKERS = 4  # 每个接收方同时下载的分片数（每个对端同一时间一个请求）
+SWARM_MAX_PEERS = 8  # 每个接收方最多从多少个其他接收方下载（随机选取）
+SWARM_REFRESH_INTERVAL = 0.5  # 重新获取对端分片位图的间隔（秒）
+SWARM_SEED_RESERVE_TIME = 5.0  # 源端发出一个分片后，这段时间内不再提供给其他接收方（秒）
+SWARM_MAX_BAD_PIECES = 3  # 对端发来多少个校验失败的分片后不再从它下载
+SWARM_STALL_TIMEOUT = 60  # 没有任何分片下载完成的最长时间，超过则放弃（秒）
+SWARM_LINGER_TIMEOUT = 600  # 下载完成后等待其他接收方完成、继续提供分片的最长时间（秒）
+
+# 传输调度相关配置
+SCHEDULER_MAX_CONCURRENT = 8  # 同时进行的传输数上限
+SCHEDULER_PER_PEER = 2  # 单个目标设备同时进行的传输数上限
+SCHEDULER_MAX_RETRIES = 3  # 失败后最多重试次数
+SCHEDULER_BACKOFF_BASE = 1.0  # 第一次重试前的等待时间（秒），之后每次翻倍
+SCHEDULER_BACKOFF_MAX = 30.0  # 重试等待时间上限（秒）
+TASK_HISTORY_LIMIT = 1000  # TaskManager 保留的已完成任务数
+
+# 指标相关配置
+METRICS_HTTP_HOST = '127.0.0.1'  # 指标 HTTP 接口（/metrics、/metrics.json）只监听本机
+METRICS_HTTP_PORT = 0  # 指标 HTTP 接口端口，0 表示不启动
+METRICS_RATE_WINDOW = 1.0  # 快照中计算每秒速率的最小采样间隔（秒）
+
+# 界面相关配置
+UI_FRAME_RATE = 30  # 界面每秒处理传输事件（进度、状态）的次数
+
+
+def __getattr__(name):
+    """LOCAL_IP 在首次使用时才解析：主机名解析可能很慢，在无DNS记录的服务器上还会失败"""
+    if name == 'LOCAL_IP':
+        try:
+            return socket.gethostbyname(LOCAL_HOSTNAME)
+        except OSError:
+            return '127.0.0.1'
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
@@ -6,12 +6,19 @@ import sys
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import socket
+import threading
+import bisect
+import ipaddress
 
 # 添加项目根目录到系统路径
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+from config import UI_FRAME_RATE
 from client.client_app import ClientApp
 from server.server_app import ServerApp
+from server.file_transfer import InterruptedError as TransferInterruptedError
+from utils.event_bus import UIEventBus
+from utils.peer_table import PeerTable
 
 import time
 
@@ -33,7 +40,12 @@ class ProgressTracker:
         self.interrupted = False
         
     def update_progress(self, sent_size, total_size):
-        """更新进度条和传输速度"""
+        """传输线程调用：发布进度事件，界面线程每帧只处理最新的一条"""
+        self.app.event_bus.publish('progress', coalesce_key=id(self), transfer=id(self),
+                                   sent_size=sent_size, total_size=total_size)
+        
+    def render(self, sent_size, total_size):
+        """界面线程调用：更新进度条和传输速度"""
         current_time = time.time()
         
         if self.start_time is None:
@@ -56,8 +68,6 @@ class ProgressTracker:
                 
                 self.last_update_time = current_time
                 self.last_sent_size = sent_size
-            
-            self.app.root.update_idletasks()
 
 
 class LANFileShareApp:
@@ -102,9 +112,28 @@ class LANFileShareApp:
         # 设置窗口背景色
         self.root.configure(bg=self.colors['secondary'])
         
+        # 传输在工作线程中进行，通过事件总线把进度和结果交给界面线程；
+        # 服务端启动后发现应答就会更新设备表，事件总线必须先于服务端和客户端创建，事件在 attach 之前先排队
+        self.event_bus = UIEventBus()
+        self.transfer_progress = {}
+        self.event_bus.subscribe('progress', self.on_transfer_progress)
+        self.event_bus.subscribe('status', self.on_transfer_status)
+        self.event_bus.subscribe('finished', self.on_transfer_finished)
+        self.event_bus.subscribe('peer_joined', self.on_peer_joined)
+        self.event_bus.subscribe('peer_left', self.on_peer_left)
+        self.event_bus.subscribe('peer_updated', self.on_peer_updated)
+        
         # 初始化客户端和服务端
-        self.client = ClientApp()
-        self.server = ServerApp()
+        # 客户端主动发现和服务端应答发现请求共用一张设备表
+        self.peer_table = PeerTable()
+        self.server = ServerApp(peer_table=self.peer_table)
+        self.client = ClientApp(self.peer_table, self.server.file_receiver.port,
+                                on_peer_joined=lambda peer: self.event_bus.publish('peer_joined', peer=peer),
+                                on_peer_left=lambda peer: self.event_bus.publish('peer_left', peer=peer),
+                                on_peer_updated=lambda peer: self.event_bus.publish(
+                                    'peer_updated', coalesce_key=peer['ip'], peer=peer))
+        # 设备列表的行按IP排序，device_rows 与列表框的行一一对应，用二分查找定位行
+        self.device_rows = []
         
         # 启动服务端（文件接收）
         self.server.start()
@@ -113,6 +142,10 @@ class LANFileShareApp:
         self.transfer_history = []
         
         self.setup_ui()
+        self.event_bus.attach(self.root, UI_FRAME_RATE)
+        
+        # 启动后台设备发现，设备加入/离开时通过事件总线更新设备列表
+        self.client.start()
         
         # 初始化状态信息（在UI组件创建后）
         self.update_status_info()
@@ -266,7 +299,7 @@ class LANFileShareApp:
         self.manual_connect_btn.pack(side=tk.LEFT, padx=(5, 0))
         
         # 设备列表
-        self.device_listbox = tk.Listbox(discovery_frame, height=8, font=('Consolas', 10))
+        self.device_listbox = tk.Listbox(discovery_frame, height=8, font=('Consolas', 10), selectmode=tk.EXTENDED)
         self.device_listbox.grid(row=1, column=0, columnspan=2, sticky=(tk.W, tk.E, tk.N, tk.S), pady=(5, 0))
         
         # 添加滚动条
@@ -323,6 +356,9 @@ class LANFileShareApp:
         self.select_file_btn = ttk.Button(control_buttons_frame, text="📁 选择文件", command=self.select_file)
         self.select_file_btn.pack(side=tk.LEFT, padx=(0, 10))
         
+        self.select_folder_btn = ttk.Button(control_buttons_frame, text="📂 选择文件夹", command=self.select_folder)
+        self.select_folder_btn.pack(side=tk.LEFT, padx=(0, 10))
+        
         self.clear_file_btn = ttk.Button(control_buttons_frame, text="🗑️ 清除文件", command=self.clear_selected_files)
         self.clear_file_btn.pack(side=tk.LEFT, padx=(0, 10))
         
@@ -395,12 +431,41 @@ class LANFileShareApp:
         transfer_frame.rowconfigure(1, weight=1)
         progress_frame.columnconfigure(0, weight=1)
     
-    def refresh_devices(self):
-        """刷新设备列表"""
-        devices = self.client.discover_devices()
-        self.device_listbox.delete(0, tk.END)
-        for device in devices:
-            self.device_listbox.insert(tk.END, f"{device['ip']} - {device['hostname']}")
+    def _device_row(self, ip):
+        """返回 (设备在列表中的行号, 是否已存在, 排序键)"""
+        address = ipaddress.ip_address(ip)
+        key = (address.version, int(address))
+        index = bisect.bisect_left(self.device_rows, key)
+        return index, index < len(self.device_rows) and self.device_rows[index] == key, key
+    
+    def on_peer_joined(self, peer):
+        """发现新设备时按IP顺序插入一行（界面线程）"""
+        index, exists, key = self._device_row(peer['ip'])
+        if exists:
+            self.on_peer_updated(peer)
+            return
+        self.device_rows.insert(index, key)
+        self.device_listbox.insert(index, f"{peer['ip']} - {peer['hostname']}")
+        self.update_status_info()
+    
+    def on_peer_updated(self, peer):
+        """设备信息变化时只重写对应的一行，保留选中状态（界面线程）"""
+        index, exists, _ = self._device_row(peer['ip'])
+        if not exists:
+            return
+        selected = self.device_listbox.selection_includes(index)
+        self.device_listbox.delete(index)
+        self.device_listbox.insert(index, f"{peer['ip']} - {peer['hostname']}")
+        if selected:
+            self.device_listbox.selection_set(index)
+    
+    def on_peer_left(self, peer):
+        """设备离线时删除对应的一行（界面线程）"""
+        index, exists, _ = self._device_row(peer['ip'])
+        if exists:
+            del self.device_rows[index]
+            self.device_listbox.delete(index)
+        self.update_status_info()
     
     def add_manual_device(self):
         """手动添加设备"""
@@ -408,25 +473,17 @@ class LANFileShareApp:
         if ip_address:
             # 验证IP地址格式
             try:
-                parts = ip_address.split('.')
-                if len(parts) == 4 and all(part.isdigit() and 0 <= int(part) <= 255 for part in parts):
-                    # 检查是否已存在
-                    device_exists = False
-                    for i in range(self.device_listbox.size()):
-                        if self.device_listbox.get(i).startswith(ip_address + " - "):
-                            device_exists = True
-                            break
-                    
-                    if not device_exists:
-                        self.device_listbox.insert(tk.END, f"{ip_address} - 手动添加")
-                        self.manual_ip_entry.delete(0, tk.END)
-                        messagebox.showinfo("提示", f"已添加设备: {ip_address}")
-                    else:
-                        messagebox.showwarning("警告", "该设备已存在于列表中")
-                else:
-                    messagebox.showerror("错误", "请输入有效的IP地址")
-            except:
+                ipaddress.IPv4Address(ip_address)
+            except ValueError:
                 messagebox.showerror("错误", "请输入有效的IP地址")
+                return
+            
+            # 设备表按IP索引，已存在的设备（包括自动发现的）不重复添加；新行由 peer_joined 事件插入
+            if self.peer_table.add_manual(ip_address, "手动添加"):
+                self.manual_ip_entry.delete(0, tk.END)
+                messagebox.showinfo("提示", f"已添加设备: {ip_address}")
+            else:
+                messagebox.showwarning("警告", "该设备已存在于列表中")
         else:
             messagebox.showwarning("警告", "请输入IP地址")
     
@@ -524,11 +581,8 @@ class LANFileShareApp:
         self.root.after(1000, self.update_status_periodically)
     
     def refresh_devices(self):
-        """刷新设备列表"""
-        devices = self.client.discover_devices()
-        self.device_listbox.delete(0, tk.END)
-        for device in devices:
-            self.device_listbox.insert(tk.END, f"{device['ip']} - {device['hostname']}")
+        """刷新设备列表：立即发送一次发现请求，设备列表随设备表的变化逐行更新"""
+        threading.Thread(target=self.client.discover_devices, daemon=True).start()
         # 更新状态信息
         self.update_status_info()
     
@@ -540,21 +594,35 @@ class LANFileShareApp:
         # 弹出文件选择对话框
         new_filenames = filedialog.askopenfilenames(title="选择要发送的文件")
         if new_filenames:
-            # 将新选择的文件添加到现有文件列表中（去重）
-            all_filenames = existing_files + list(new_filenames)
-            # 去重但保持顺序
-            unique_filenames = []
-            for f in all_filenames:
-                if f not in unique_filenames:
-                    unique_filenames.append(f)
-            
-            self.selected_files = unique_filenames
-            self.file_listbox.delete(0, tk.END)
-            for filename in unique_filenames:
-                file_size = os.path.getsize(filename)
-                display_name = f"{os.path.basename(filename)} ({round(file_size / (1024*1024), 2)} MB)"
-                self.file_listbox.insert(tk.END, display_name)
-            self.send_file_btn.config(state=tk.NORMAL)
+            self._add_selected_paths(existing_files + list(new_filenames))
+
+    def select_folder(self):
+        """选择要发送的文件夹，整个目录树会被发送"""
+        existing_files = getattr(self, 'selected_files', [])
+        
+        folder = filedialog.askdirectory(title="选择要发送的文件夹")
+        if folder:
+            self._add_selected_paths(existing_files + [folder])
+
+    def _add_selected_paths(self, all_filenames):
+        """更新已选择的文件和文件夹列表（去重但保持顺序）"""
+        unique_filenames = []
+        for f in all_filenames:
+            if f not in unique_filenames:
+                unique_filenames.append(f)
+                
+        self.selected_files = unique_filenames
+        self.file_listbox.delete(0, tk.END)
+        for filename in unique_filenames:
+            self.file_listbox.insert(tk.END, self._display_name(filename))
+        self.send_file_btn.config(state=tk.NORMAL)
+
+    def _display_name(self, path):
+        """文件列表中显示的名称"""
+        if os.path.isdir(path):
+            return f"{os.path.basename(path)}/ (文件夹)"
+        file_size = os.path.getsize(path)
+        return f"{os.path.basename(path)} ({round(file_size / (1024*1024), 2)} MB)"
 
     def clear_selected_files(self):
         """清除已选择的文件"""
@@ -597,9 +665,7 @@ class LANFileShareApp:
                 # 重新填充列表（因为删除项后索引可能变化）
                 self.file_listbox.delete(0, tk.END)
                 for filename in self.selected_files:
-                    file_size = os.path.getsize(filename)
-                    display_name = f"{os.path.basename(filename)} ({round(file_size / (1024*1024), 2)} MB)"
-                    self.file_listbox.insert(tk.END, display_name)
+                    self.file_listbox.insert(tk.END, self._display_name(filename))
             else:
                 self.send_file_btn.config(state=tk.DISABLED)
 
@@ -621,83 +687,148 @@ class LANFileShareApp:
             messagebox.showwarning("警告", "请选择目标设备")
             return
         
-        # 获取选中设备信息
-        device_info = self.device_listbox.get(selection[0])
-        target_ip = device_info.split(' - ')[0]  # 提取IP地址
+        # 获取选中设备信息，可以同时选择多个设备
+        targets = [self.device_listbox.get(index).split(' - ')[0] for index in selection]  # 提取IP地址
+        target_text = targets[0] if len(targets) == 1 else f"{len(targets)} 台设备"
         
         # 确认发送操作
-        confirm = messagebox.askyesno("确认发送", f"确定要向设备 {target_ip} 发送 {len(self.selected_files)} 个文件吗？\n\n{', '.join([os.path.basename(f) for f in self.selected_files[:3]])}{'...' if len(self.selected_files) > 3 else ''}")
+        confirm = messagebox.askyesno("确认发送", f"确定要向{'设备 ' if len(targets) == 1 else ''}{target_text} 发送 {len(self.selected_files)} 个文件吗？\n\n{', '.join([os.path.basename(f) for f in self.selected_files[:3]])}{'...' if len(self.selected_files) > 3 else ''}")
         if not confirm:
             return
         
         # 创建进度跟踪器
         self.current_progress_tracker = ProgressTracker(self)
+        self.transfer_progress = {}
         
-        # 启用终止传输按钮
+        # 启用终止传输按钮，传输期间禁止再次发送
         self.interrupt_transfer_btn.config(state=tk.NORMAL)
+        self.send_file_btn.config(state=tk.DISABLED)
+        self.progress_bar['value'] = 0  # 重置进度条
+        self.speed_label.config(text="速度: -- KB/s")
         
         # 设置传输活动状态
         self.transfer_activity = True
         
-        # 开始批量文件传输
+        # 在工作线程中开始批量文件传输，界面保持响应
+        paths = list(self.selected_files)
+        worker = threading.Thread(target=self.transfer_worker,
+                                  args=(paths, targets, self.current_progress_tracker), daemon=True)
+        worker.start()
+        
+    def transfer_worker(self, paths, targets, tracker):
+        """传输线程：执行传输，不直接操作界面，结果通过事件总线发布"""
+        try:
+            if len(targets) == 1:
+                results = self.send_to_device(paths, targets[0], tracker)
+            else:
+                results = self.send_to_devices(paths, targets, tracker)
+            self.event_bus.publish('finished', paths=paths, targets=targets, results=results)
+        except Exception as e:
+            self.event_bus.publish('finished', paths=paths, targets=targets, error=e)
+            
+    def send_to_device(self, paths, target_ip, tracker):
+        """传输线程：向一个设备发送文件和文件夹，返回 {(路径, 设备IP): 是否成功}"""
+        folders = [path for path in paths if os.path.isdir(path)]
+        files = [path for path in paths if not os.path.isdir(path)]
+        results = {}
+        if len(files) == 1:
+            file_path = files[0]
+            self.event_bus.publish('status', text=f"正在发送: {os.path.basename(file_path)}")
+            results[file_path] = self.client.send_file_to_device(file_path, target_ip, progress_callback=tracker)
+        elif files:
+            # 多个文件通过持久会话流水线发送，小文件合并成批
+            self.event_bus.publish('status', text=f"正在发送 {len(files)} 个文件")
+            results.update(self.client.send_files_to_device(files, target_ip, progress_callback=tracker))
+        for folder in folders:
+            self.event_bus.publish('status', text=f"正在发送文件夹: {os.path.basename(folder)}")
+            summary = self.client.send_directory_to_device(folder, target_ip, progress_callback=tracker)
+            results[folder] = not summary['failed']
+        return {(path, target_ip): ok for path, ok in results.items()}
+        
+    def send_to_devices(self, paths, targets, tracker):
+        """传输线程：通过调度器把文件并发发送到多个设备，返回 {(路径, 设备IP): 是否成功}"""
+        def on_progress(task, sent_size, total_size):
+            self.event_bus.publish('progress', coalesce_key=task['id'], transfer=task['id'],
+                                   sent_size=sent_size, total_size=total_size)
+        
+        scheduler = self.client.get_scheduler(progress_callback=on_progress)
+        self.event_bus.publish('status', text=f"正在向 {len(targets)} 台设备发送 {len(paths)} 个文件")
+        tasks = [scheduler.submit(path, target_ip) for target_ip in targets for path in paths]
+        while not all(task['status'] in ('completed', 'failed', 'cancelled') for task in tasks):
+            if tracker.interrupted:
+                for task in tasks:
+                    scheduler.cancel(task)
+            time.sleep(0.2)
+        if tracker.interrupted:
+            raise TransferInterruptedError("传输被用户中断")
+        return {(task['file_path'], task['target_ip']): task['status'] == 'completed' for task in tasks}
+        
+    def on_transfer_status(self, text):
+        """界面线程：显示传输状态"""
+        self.progress_label.config(text=text)
+        
+    def on_transfer_progress(self, transfer, sent_size, total_size):
+        """界面线程：多个传输同时进行时显示总进度"""
+        self.transfer_progress[transfer] = (sent_size, total_size)
+        if hasattr(self, 'current_progress_tracker'):
+            self.current_progress_tracker.render(sum(sent for sent, _ in self.transfer_progress.values()),
+                                                 sum(total for _, total in self.transfer_progress.values()))
+        
+    def on_transfer_finished(self, paths, targets, results=None, error=None):
+        """界面线程：传输结束后更新历史记录并提示用户"""
+        target_text = targets[0] if len(targets) == 1 else f"{len(targets)} 台设备"
         try:
-            for i, file_path in enumerate(self.selected_files):
-                self.progress_label.config(text=f"正在发送 ({i+1}/{len(self.selected_files)}): {os.path.basename(file_path)}")
-                self.progress_bar['value'] = 0  # 重置进度条
+            if error is None:
+                failed = []
+                for (file_path, target_ip), ok in results.items():
+                    if ok:
+                        # 添加成功记录到历史
+                        self.add_to_history(file_path, target_ip, "发送成功")
+                    else:
+                        # 添加失败记录到历史
+                        self.add_to_history(file_path, target_ip, "发送失败")
+                        failed.append(os.path.basename(file_path))
+                        
+                # 重置进度条和速度显示
+                self.progress_bar['value'] = 0
                 self.speed_label.config(text="速度: -- KB/s")
-                
-                success = self.client.send_file_to_device(file_path, target_ip, progress_callback=self.current_progress_tracker)
-                if success:
-                    self.progress_label.config(text=f"发送完成 ({i+1}/{len(self.selected_files)}): {os.path.basename(file_path)}")
-                    self.progress_bar['value'] = 100
-                    # 添加成功记录到历史
-                    self.add_to_history(file_path, target_ip, "发送成功")
+                if failed:
+                    self.progress_label.config(text=f"发送失败 {len(failed)}/{len(results)} 个文件")
+                    messagebox.showerror("错误", f"以下文件发送失败！\n\n{', '.join(failed[:10])}{'...' if len(failed) > 10 else ''}")
                 else:
-                    self.progress_label.config(text=f"发送失败 ({i+1}/{len(self.selected_files)}): {os.path.basename(file_path)}")
-                    # 添加失败记录到历史
-                    self.add_to_history(file_path, target_ip, "发送失败")
-                    messagebox.showerror("错误", f"文件 {os.path.basename(file_path)} 发送失败！")
-            
-            messagebox.showinfo("成功", f"{len(self.selected_files)} 个文件全部发送完成！")
-            
-            # 重置进度条和速度显示
-            self.progress_bar['value'] = 0
-            self.speed_label.config(text="速度: -- KB/s")
-            
-            # 更新状态信息
-            self.update_status_info()
+                    self.progress_label.config(text=f"发送完成 ({len(results)}/{len(results)})")
+                    messagebox.showinfo("成功", f"{len(paths)} 个文件全部发送完成！")
+                
+                # 更新状态信息
+                self.update_status_info()
+                return
             
-        except InterruptedError:
-            self.progress_label.config(text="传输被用户中断")
-            self.progress_bar['value'] = 0
-            self.speed_label.config(text="速度: -- KB/s")
-            messagebox.showinfo("提示", "文件传输已被用户中断")
-        except FileNotFoundError as fnf_error:
-            self.progress_label.config(text="文件未找到")
-            self.progress_bar['value'] = 0
-            self.speed_label.config(text="速度: -- KB/s")
-            messagebox.showerror("错误", f"找不到文件: {fnf_error}")
-        except ConnectionRefusedError:
-            self.progress_label.config(text="连接被拒绝")
             self.progress_bar['value'] = 0
             self.speed_label.config(text="速度: -- KB/s")
-            messagebox.showerror("错误", f"无法连接到目标设备 {target_ip}，可能设备不在线或防火墙阻止了连接。")
-        except TimeoutError:
-            self.progress_label.config(text="连接超时")
-            self.progress_bar['value'] = 0
-            self.speed_label.config(text="速度: -- KB/s")
-            messagebox.showerror("错误", f"连接到目标设备 {target_ip} 超时，请检查网络连接。")
-        except Exception as e:
-            self.progress_label.config(text="发送失败")
-            self.progress_bar['value'] = 0
-            self.speed_label.config(text="速度: -- KB/s")
-            # 添加错误记录到历史
-            for file_path in self.selected_files:
-                self.add_to_history(file_path, target_ip, "发送错误")
-            messagebox.showerror("错误", f"发送过程中出现错误: {str(e)}")
+            if isinstance(error, (InterruptedError, TransferInterruptedError)):
+                self.progress_label.config(text="传输被用户中断")
+                messagebox.showinfo("提示", "文件传输已被用户中断")
+            elif isinstance(error, FileNotFoundError):
+                self.progress_label.config(text="文件未找到")
+                messagebox.showerror("错误", f"找不到文件: {error}")
+            elif isinstance(error, ConnectionRefusedError):
+                self.progress_label.config(text="连接被拒绝")
+                messagebox.showerror("错误", f"无法连接到目标设备 {target_text}，可能设备不在线或防火墙阻止了连接。")
+            elif isinstance(error, (TimeoutError, socket.timeout)):
+                self.progress_label.config(text="连接超时")
+                messagebox.showerror("错误", f"连接到目标设备 {target_text} 超时，请检查网络连接。")
+            else:
+                self.progress_label.config(text="发送失败")
+                # 添加错误记录到历史
+                for file_path in paths:
+                    for target_ip in targets:
+                        self.add_to_history(file_path, target_ip, "发送错误")
+                messagebox.showerror("错误", f"发送过程中出现错误: {str(error)}")
         finally:
             # 禁用终止传输按钮
             self.interrupt_transfer_btn.config(state=tk.DISABLED)
+            if hasattr(self, 'selected_files'):
+                self.send_file_btn.config(state=tk.NORMAL)
             # 重置进度跟踪器
             if hasattr(self, 'current_progress_tracker'):
                 self.current_progress_tracker.reset()
@@ -710,6 +841,7 @@ class LANFileShareApp:
     
     def on_closing(self):
         """关闭窗口时的清理操作"""
+        self.event_bus.detach()
         self.client.stop()
         self.server.stop()
         self.root.destroy()
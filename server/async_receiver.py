@@ -0,0 +1,264 @@
+# server/async_receiver.py
+import asyncio
+import json
+import os
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import (PREALLOCATE_FILES, TCP_LISTEN_BACKLOG, ASYNC_MAX_CONCURRENT,
+                    ASYNC_IO_WORKERS, ASYNC_HANDOFF_WORKERS, RATE_LIMIT_MIN_SLEEP)
+from utils.network_utils import create_tcp_server_socket, check_message_length, RECV_EXACT_STEP
+from utils.wire import (MAGIC, FRAME, WireVersionError, parse_frame_header, decode_payload, encode_reply,
+                        encode_version_error)
+from utils.io_utils import preallocate_file, write_buffers
+from utils.metrics import transfer_metrics, active_connections
+from utils.tuning import configure_socket, tune_connection, record_transfer
+
+
+class AsyncFileReceiver:
+    """基于 asyncio 的文件接收服务器引擎
+    
+    一个事件循环线程处理所有连接的协议读写，用信号量限制同时处理的连接数，
+    文件写入交给小型线程池；分段、增量和压缩传输交给 FileReceiver 的同步实现在线程池中执行。
+    """
+    
+    def __init__(self, receiver, max_concurrent=None, backlog=None):
+        self.receiver = receiver
+        self.max_concurrent = max_concurrent or ASYNC_MAX_CONCURRENT
+        self.backlog = backlog or TCP_LISTEN_BACKLOG
+        self.running = False
+        self.loop = None
+        self.serve_task = None
+        self.receive_thread = None
+        self.io_executor = None
+        self.handoff_executor = None
+        self.active_connections = 0
+        
+    def start_server(self):
+        """启动文件接收服务器"""
+        self.running = True
+        self.loop = asyncio.new_event_loop()
+        self.io_executor = ThreadPoolExecutor(max_workers=ASYNC_IO_WORKERS, thread_name_prefix='async-io')
+        self.handoff_executor = ThreadPoolExecutor(max_workers=ASYNC_HANDOFF_WORKERS,
+                                                   thread_name_prefix='async-handoff')
+        self.receive_thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.receive_thread.start()
+        
+    def stop_server(self):
+        """停止文件接收服务器"""
+        self.running = False
+        if self.loop and self.serve_task:
+            self.loop.call_soon_threadsafe(self.serve_task.cancel)
+            
+    def _run_loop(self):
+        """事件循环线程"""
+        asyncio.set_event_loop(self.loop)
+        self.serve_task = self.loop.create_task(self._serve())
+        try:
+            self.loop.run_until_complete(self.serve_task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.io_executor.shutdown(wait=False)
+            self.handoff_executor.shutdown(wait=False)
+            self.loop.close()
+            
+    async def _serve(self):
+        """接受连接：先获取信号量再 accept，超出并发上限的连接在内核监听队列中等待"""
+        loop = asyncio.get_running_loop()
+        server_socket = create_tcp_server_socket(self.receiver.host, self.receiver.port, self.backlog)
+        server_socket.setblocking(False)
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+        
+        print(f"文件接收服务器(asyncio)启动于 {self.receiver.host}:{self.receiver.port}")
+        
+        try:
+            while self.running:
+                await semaphore.acquire()
+                try:
+                    conn, addr = await loop.sock_accept(server_socket)
+                    configure_socket(conn)
+                except OSError as e:
+                    semaphore.release()
+                    print(f"接收连接时发生错误: {e}")
+                    continue
+                loop.create_task(self._handle_connection(conn, addr, semaphore))
+        finally:
+            server_socket.close()
+            
+    async def _handle_connection(self, conn, addr, semaphore):
+        """处理一个连接：读取文件头，普通传输在事件循环中完成，其他模式交给同步实现"""
+        loop = asyncio.get_running_loop()
+        self.active_connections += 1
+        connections_gauge = active_connections('receive')
+        connections_gauge.inc()
+        handed_off = False
+        try:
+            file_info = await self._recv_header(conn)
+            if file_info is None:
+                print(f"无法接收文件头信息来自: {addr}")
+                return
+            
+            if file_info.get('mode', 'single') == 'single':
+                handed_off = await self._receive_single(conn, addr, file_info)
+            else:
+                handed_off = True
+                conn.setblocking(True)
+                await loop.run_in_executor(self.handoff_executor, self.receiver._handle_client,
+                                           conn, addr, file_info)
+        except WireVersionError as e:
+            print(f"接收到了无法解析的二进制帧来自: {addr}, {e}")
+            try:
+                await loop.sock_sendall(conn, encode_version_error(e))
+            except OSError:
+                pass
+        except json.JSONDecodeError:
+            print(f"接收到了无效的JSON数据来自: {addr}")
+        except ValueError as e:
+            print(f"接收到了无效的文件头来自: {addr}, {e}")
+        except Exception as e:
+            print(f"处理客户端连接时出错: {e}")
+        finally:
+            if not handed_off:
+                conn.close()
+            self.active_connections -= 1
+            connections_gauge.dec()
+            semaphore.release()
+            
+    async def _receive_single(self, conn, addr, file_info):
+        """在事件循环中接收单连接传输，返回连接是否已交给同步实现处理"""
+        loop = asyncio.get_running_loop()
+        transfer, reply = await loop.run_in_executor(self.io_executor, self.receiver._begin_single,
+                                                     addr, file_info)
+        if reply is not None:
+            try:
+                await loop.sock_sendall(conn, encode_reply(file_info, reply))
+            except Exception:
+                await loop.run_in_executor(self.io_executor, transfer.abort)
+                raise
+            
+        remaining = transfer.file_size - transfer.offset
+        if transfer.codec or self.receiver._use_mmap(remaining):
+            # 解压是CPU密集型操作，内存映射接收会阻塞在缺页和刷盘上，都交给同步实现
+            conn.setblocking(True)
+            await loop.run_in_executor(self.handoff_executor, self._run_sync,
+                                       self.receiver._receive_single_body, conn, transfer)
+            return True
+            
+        offset = transfer.offset
+        fd = transfer.partial.fd
+        if PREALLOCATE_FILES and offset == 0:
+            await loop.run_in_executor(self.io_executor, preallocate_file, fd, transfer.file_size)
+            
+        # 双缓冲：一个缓冲区在线程池中写盘的同时，另一个继续接收网络数据；缓冲区大小由连接调优选择
+        buffer_size = max(1, min(tune_connection(conn, remaining, 'receive'), remaining))
+        start_time = time.perf_counter()
+        buffers = [bytearray(buffer_size), bytearray(buffer_size)]
+        current = 0
+        pending_write = None
+        throttle = transfer.throttle
+        metrics = transfer_metrics('receive', conn)
+        recv_calls = metrics.io_calls('recv')
+        try:
+            while remaining > 0:
+                chunk_start = time.perf_counter()
+                # 限速时每轮只接收一小段，等待令牌时让出事件循环
+                step = throttle.slice if throttle is not None else None
+                view = memoryview(buffers[current])[:min(buffer_size, remaining, step or buffer_size)]
+                filled = 0
+                calls = 0
+                while filled < len(view):
+                    n = await loop.sock_recv_into(conn, view[filled:])
+                    calls += 1
+                    if n == 0:
+                        break
+                    filled += n
+                recv_calls.inc(calls)
+                metrics.bytes.inc(filled)
+                if throttle is not None and filled:
+                    delay = throttle.reserve(filled)
+                    if delay > RATE_LIMIT_MIN_SLEEP:
+                        await asyncio.sleep(delay)
+                if pending_write:
+                    await pending_write
+                    pending_write = None
+                if filled == 0:
+                    break
+                pending_write = loop.run_in_executor(self.io_executor, self._write_chunk,
+                                                     transfer, view[:filled], offset, metrics)
+                metrics.chunk_seconds.observe(time.perf_counter() - chunk_start)
+                offset += filled
+                remaining -= filled
+                current ^= 1
+                if filled < len(view):
+                    break
+            if pending_write:
+                await pending_write
+            if throttle is None or throttle.slice is None:
+                record_transfer(conn, offset - transfer.offset, time.perf_counter() - start_time)
+        except Exception:
+            if pending_write:
+                await asyncio.gather(pending_write, return_exceptions=True)
+            await loop.run_in_executor(self.io_executor, transfer.abort)
+            raise
+            
+        if transfer.hasher is not None:
+            # 完整性校验可能需要多轮请求重发，交给同步实现
+            conn.setblocking(True)
+            await loop.run_in_executor(self.handoff_executor, self._run_sync,
+                                       self.receiver._complete_single, conn, transfer)
+            return True
+        if await loop.run_in_executor(self.io_executor, self.receiver._finish_single, transfer):
+            await loop.sock_sendall(conn, b"OK")
+        return False
+        
+    def _run_sync(self, func, conn, transfer):
+        """在线程池中执行同步接收流程 func(conn, transfer)，结束后关闭连接"""
+        try:
+            func(conn, transfer)
+        except Exception as e:
+            print(f"处理客户端连接时出错: {e}")
+        finally:
+            conn.close()
+            
+    def _write_chunk(self, transfer, view, offset, metrics):
+        """在线程池中把一块数据写入 .part 文件"""
+        write_buffers(transfer.partial.fd, [view], offset=offset, calls=metrics.io_calls('write'))
+        transfer.on_written(offset + len(view))
+        
+    async def _recv_header(self, conn):
+        """异步接收文件头，自动识别JSON和二进制帧，连接提前关闭时返回None"""
+        header = await self._recv_exact(conn, 4)
+        if header is None:
+            return None
+        if header[:2] == MAGIC:
+            rest = await self._recv_exact(conn, FRAME.size - 4)
+            if rest is None:
+                return None
+            _, msg_type, length = parse_frame_header(header + rest)
+            payload = await self._recv_exact(conn, check_message_length(length))
+            return decode_payload(msg_type, payload) if payload is not None else None
+        payload = await self._recv_exact(conn, check_message_length(int.from_bytes(header, 'big')))
+        if payload is None:
+            return None
+        return json.loads(payload.decode('utf-8'))
+        
+    async def _recv_exact(self, conn, size):
+        """异步接收指定大小的数据，连接提前关闭时返回None；缓冲区随数据到达成倍扩大"""
+        loop = asyncio.get_running_loop()
+        data = bytearray()
+        received = 0
+        while received < size:
+            if received == len(data):
+                data.extend(bytes(min(size - received, max(received, RECV_EXACT_STEP))))
+            with memoryview(data) as view:
+                n = await loop.sock_recv_into(conn, view[received:])
+            if n == 0:
+                return None
+            received += n
+        return bytes(data)
\ No newline at end of file
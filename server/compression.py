@@ -0,0 +1,220 @@
+# server/compression.py
+import os
+import sys
+import time
+import zlib
+import lzma
+import queue
+import struct
+import threading
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import (CHUNK_SIZE, COMPRESSION_CODECS, COMPRESSION_SAMPLE_SIZE, COMPRESSION_MAX_RATIO,
+                    COMPRESSION_MIN_SIZE, COMPRESSION_QUEUE_SIZE, COMPRESSION_STARVE_RATIO)
+from utils.network_utils import recv_exact
+from utils.io_utils import write_buffers
+from utils.metrics import transfer_metrics, queue_depth
+
+# 压缩数据帧: 标志(1字节, 0=原样 1=压缩) + 载荷长度(4字节) + 原始长度(4字节) + 载荷
+FRAME_HEADER = struct.Struct('>BII')
+FRAME_RAW = 0
+FRAME_COMPRESSED = 1
+
+
+def _limited(factory):
+    """用流式解压对象实现有上限的解压函数：最多解压出 max_length + 1 字节，超过上限由调用方按长度不一致处理"""
+    def decompress(payload, max_length):
+        decompressor = factory()
+        data = decompressor.decompress(payload, max_length + 1)
+        if len(data) <= max_length and not decompressor.eof:
+            raise ValueError("压缩数据帧不完整")
+        return data
+    return decompress
+
+
+# 可用的编解码器 {'名称': (压缩函数, 解压函数)}，解压函数为 decompress(载荷, 最大长度)，
+# 对端发来的小数据帧可能解压出远超声明长度的数据，解压时必须限制输出大小
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 1), _limited(zlib.decompressobj)),
+    'lzma': (lambda data: lzma.compress(data, preset=0), _limited(lzma.LZMADecompressor)),
+}
+
+# 可选的第三方编解码器，安装了才启用
+try:
+    import zstandard
+    _zstd_compressor = zstandard.ZstdCompressor(level=3)
+    _zstd_decompressor = zstandard.ZstdDecompressor()
+    
+    def _zstd_decompress(payload, max_length):
+        """帧头中声明了原始长度时 zstandard 按声明的长度分配输出，需要先检查"""
+        if zstandard.frame_content_size(payload) > max_length:
+            raise ValueError("压缩数据帧声明的长度超过上限")
+        try:
+            return _zstd_decompressor.decompress(payload, max_output_size=max_length)
+        except zstandard.ZstdError as e:
+            raise ValueError(f"压缩数据帧解压失败: {e}")
+        
+    CODECS['zstd'] = (_zstd_compressor.compress, _zstd_decompress)
+except ImportError:
+    pass
+
+try:
+    import lz4.frame
+    CODECS['lz4'] = (lz4.frame.compress, _limited(lz4.frame.LZ4FrameDecompressor))
+except ImportError:
+    pass
+
+
+def available_codecs():
+    """按配置的优先级返回本机可用的编解码器"""
+    return [name for name in COMPRESSION_CODECS if name in CODECS]
+
+
+def negotiate_codec(offered):
+    """接收方从发送方提供的列表中选择第一个本机支持的编解码器"""
+    for name in offered or []:
+        if name in CODECS:
+            return name
+    return None
+
+
+def select_codecs(file_path, offset, count):
+    """采样文件开头的数据，返回压缩收益足够的编解码器列表（按优先级）"""
+    if count < COMPRESSION_MIN_SIZE:
+        return []
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        sample = f.read(min(COMPRESSION_SAMPLE_SIZE, count))
+    if not sample:
+        return []
+        
+    selected = []
+    for name in available_codecs():
+        compress = CODECS[name][0]
+        if len(compress(sample)) <= len(sample) * COMPRESSION_MAX_RATIO:
+            selected.append(name)
+    return selected
+
+
+class CompressedSender:
+    """在工作线程中读取并压缩文件数据，主线程只负责发送，使压缩与网络I/O重叠
+    
+    如果发送线程经常等待压缩结果（压缩速度跟不上网络），后续数据块改为原样发送，
+    保证吞吐量不低于不压缩的情况。
+    """
+    
+    def __init__(self, codec):
+        self.compress = CODECS[codec][0]
+        self.codec = codec
+        self.raw_mode = False
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        
+    def send(self, sock, f, offset, count, checkpoint, granularity, throttle=None):
+        """发送 [offset, offset+count) 区间的数据，返回发送的原始字节数；throttle 按实际发送的字节数限速"""
+        frames = queue.Queue(maxsize=COMPRESSION_QUEUE_SIZE)
+        stop_event = threading.Event()
+        worker = threading.Thread(target=self._produce, args=(f, offset, count, frames, stop_event), daemon=True)
+        worker.start()
+        
+        sent_size = 0
+        next_report = granularity
+        waited = 0.0
+        start_time = time.monotonic()
+        metrics = transfer_metrics('send', sock)
+        send_calls = metrics.io_calls('send')
+        depth = queue_depth('compression')
+        checkpoint(0)
+        try:
+            while sent_size < count:
+                wait_start = time.monotonic()
+                depth.set(frames.qsize())
+                frame = frames.get()
+                waited += time.monotonic() - wait_start
+                if isinstance(frame, Exception):
+                    raise frame
+                header, payload, raw_length = frame
+                sock.sendall(header)
+                sock.sendall(payload)
+                send_calls.inc(2)
+                metrics.bytes.inc(len(header) + len(payload))
+                metrics.chunk_seconds.observe(time.monotonic() - wait_start)
+                sent_size += raw_length
+                if throttle is not None:
+                    throttle.consume(len(header) + len(payload))
+                
+                # 发送线程空等时间过长，说明压缩成了瓶颈
+                elapsed = time.monotonic() - start_time
+                if not self.raw_mode and elapsed > 0.5 and waited > elapsed * COMPRESSION_STARVE_RATIO:
+                    print("\n压缩速度跟不上网络，后续数据不再压缩")
+                    self.raw_mode = True
+                    
+                if sent_size >= next_report or sent_size >= count:
+                    checkpoint(sent_size)
+                    next_report = sent_size + granularity
+        finally:
+            stop_event.set()
+            # 唤醒可能阻塞在队列上的工作线程
+            while worker.is_alive():
+                try:
+                    frames.get_nowait()
+                except queue.Empty:
+                    worker.join(0.05)
+        return sent_size
+        
+    def _produce(self, f, offset, count, frames, stop_event):
+        """工作线程：读取文件块并压缩，压缩后不更小的块原样发送"""
+        try:
+            f.seek(offset)
+            remaining = count
+            while remaining > 0 and not stop_event.is_set():
+                data = f.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    raise IOError("文件读取提前结束")
+                remaining -= len(data)
+                
+                payload = data
+                flag = FRAME_RAW
+                if not self.raw_mode:
+                    compressed = self.compress(data)
+                    if len(compressed) < len(data):
+                        payload = compressed
+                        flag = FRAME_COMPRESSED
+                self.raw_bytes += len(data)
+                self.compressed_bytes += len(payload)
+                frames.put((FRAME_HEADER.pack(flag, len(payload), len(data)), payload, len(data)))
+        except Exception as e:
+            frames.put(e)
+
+
+def receive_compressed(conn, fd, codec, offset, length, on_written=None, throttle=None):
+    """接收压缩数据帧，解压后从 offset 开始写入文件，返回写入的原始字节数；throttle 按接收的字节数限速"""
+    decompress = CODECS[codec][1]
+    received_size = 0
+    metrics = transfer_metrics('receive', conn)
+    while received_size < length:
+        chunk_start = time.perf_counter()
+        header = recv_exact(conn, FRAME_HEADER.size)
+        if header is None:
+            break
+        flag, payload_length, raw_length = FRAME_HEADER.unpack(header)
+        # 长度来自对端：发送方每帧最多读取 CHUNK_SIZE 字节，压缩后更小才发送压缩帧，所以载荷不会超过原始长度
+        if raw_length > CHUNK_SIZE or payload_length > raw_length or received_size + raw_length > length:
+            raise ValueError(f"压缩数据帧长度无效: 载荷 {payload_length}, 原始 {raw_length}")
+        payload = recv_exact(conn, payload_length)
+        if payload is None:
+            break
+        metrics.bytes.inc(FRAME_HEADER.size + payload_length)
+        if throttle is not None:
+            throttle.consume(FRAME_HEADER.size + payload_length)
+        data = decompress(payload, raw_length) if flag == FRAME_COMPRESSED else payload
+        if len(data) != raw_length:
+            raise ValueError("压缩数据帧长度不一致")
+        write_buffers(fd, [data], offset=offset + received_size, calls=metrics.io_calls('write'))
+        metrics.chunk_seconds.observe(time.perf_counter() - chunk_start)
+        received_size += raw_length
+        if on_written:
+            on_written(offset + received_size)
+    return received_size
\ No newline at end of file
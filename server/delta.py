@@ -0,0 +1,293 @@
+# server/delta.py
+import os
+import sys
+import zlib
+import struct
+import sqlite3
+import hashlib
+import threading
+from contextlib import closing
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import CHUNK_SIZE, DELTA_MIN_BLOCK, DELTA_MAX_BLOCK, DELTA_ROLL_GIVEUP_BLOCKS, DELTA_MAX_LITERAL
+from utils.network_utils import recv_exact
+from utils.io_utils import recv_into_exact, write_buffers
+from utils.metrics import transfer_metrics
+
+# 增量数据流中的操作类型
+OP_COPY = b'C'     # 复制基准文件中连续的若干块: 块序号(4字节) + 块数(4字节)
+OP_LITERAL = b'L'  # 原样数据: 长度(4字节) + 数据
+OP_END = b'E'      # 结束: 文件总大小(8字节) + BLAKE2b 摘要(32字节)
+
+SIGNATURE_ENTRY = struct.Struct('>I16s')  # 每块的弱校验和(adler32) + 强校验和(BLAKE2b-128)
+COPY_OP = struct.Struct('>II')
+LITERAL_OP = struct.Struct('>I')
+END_OP = struct.Struct('>Q32s')
+
+_ADLER_MOD = 65521
+
+
+def choose_block_size(file_size):
+    """按 rsync 的经验取 sqrt(文件大小)，并对齐到2的幂"""
+    block_size = DELTA_MIN_BLOCK
+    while block_size * block_size < file_size and block_size < DELTA_MAX_BLOCK:
+        block_size *= 2
+    return block_size
+
+
+def strong_hash(data):
+    """块的强校验和"""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def compute_signature(file_path, block_size):
+    """计算文件每个块的弱/强校验和，返回打包后的签名数据"""
+    entries = []
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            entries.append(SIGNATURE_ENTRY.pack(zlib.adler32(block), strong_hash(block)))
+    return b''.join(entries)
+
+
+def parse_signature(signature):
+    """把签名数据解析为 {弱校验和: [(强校验和, 块序号), ...]}"""
+    index = {}
+    for block_index, (weak, strong) in enumerate(SIGNATURE_ENTRY.iter_unpack(signature)):
+        index.setdefault(weak, []).append((strong, block_index))
+    return index
+
+
+def generate_delta(f, block_size, signature):
+    """对比基准文件签名，生成增量操作序列
+    
+    依次产生 (OP_COPY, 块序号, 块数) 或 (OP_LITERAL, 数据)。
+    先用 zlib.adler32 按块对齐检查，未命中时逐字节滚动查找插入/删除后的新对齐位置；
+    连续 DELTA_ROLL_GIVEUP_BLOCKS 个块都找不到匹配时，认为是全新内容，暂停逐字节滚动。
+    """
+    index = parse_signature(signature)
+    window = max(block_size * 64, DELTA_MAX_LITERAL)
+    buf = f.read(window)
+    eof = len(buf) < window
+    pos = 0
+    literal_start = 0
+    pending_copy = None
+    rolling = None
+    rolled = 0
+    
+    while True:
+        # 剩余数据不足一块时补充缓冲区，丢弃已经处理过的部分
+        if len(buf) - pos < block_size and not eof:
+            more = f.read(window)
+            eof = len(more) < window
+            buf = buf[literal_start:] + more
+            pos -= literal_start
+            literal_start = 0
+            continue
+        if len(buf) - pos < block_size:
+            break
+            
+        if rolling is None:
+            weak = zlib.adler32(buf[pos:pos + block_size])
+            rolling = (weak & 0xffff, weak >> 16)
+        else:
+            weak = (rolling[1] << 16) | rolling[0]
+            
+        match = None
+        candidates = index.get(weak)
+        if candidates:
+            strong = strong_hash(buf[pos:pos + block_size])
+            for candidate_strong, block_index in candidates:
+                if candidate_strong == strong:
+                    match = block_index
+                    break
+                    
+        if match is not None:
+            if pos > literal_start:
+                if pending_copy:
+                    yield pending_copy
+                    pending_copy = None
+                yield (OP_LITERAL, buf[literal_start:pos])
+            # 合并连续的复制操作
+            if pending_copy and pending_copy[1] + pending_copy[2] == match:
+                pending_copy = (OP_COPY, pending_copy[1], pending_copy[2] + 1)
+            else:
+                if pending_copy:
+                    yield pending_copy
+                pending_copy = (OP_COPY, match, 1)
+            pos += block_size
+            literal_start = pos
+            rolling = None
+            rolled = 0
+            continue
+            
+        if rolled < block_size * DELTA_ROLL_GIVEUP_BLOCKS:
+            # 逐字节滚动：移出 buf[pos]，移入 buf[pos + block_size]
+            if pos + block_size < len(buf):
+                out_byte = buf[pos]
+                in_byte = buf[pos + block_size]
+                a = (rolling[0] - out_byte + in_byte) % _ADLER_MOD
+                b = (rolling[1] + a - 1 - block_size * out_byte) % _ADLER_MOD
+                rolling = (a, b)
+            else:
+                rolling = None
+            pos += 1
+            rolled += 1
+        else:
+            # 全新内容，按块跳过，命中后恢复逐字节滚动
+            pos += block_size
+            rolling = None
+            
+        if pos - literal_start >= DELTA_MAX_LITERAL:
+            if pending_copy:
+                yield pending_copy
+                pending_copy = None
+            yield (OP_LITERAL, buf[literal_start:pos])
+            literal_start = pos
+            
+    if pending_copy:
+        yield pending_copy
+    if len(buf) > literal_start:
+        yield (OP_LITERAL, buf[literal_start:])
+
+
+def literal_ops(f):
+    """接收方没有基准文件时，把整个文件作为原样数据发送"""
+    while True:
+        data = f.read(DELTA_MAX_LITERAL)
+        if not data:
+            break
+        yield (OP_LITERAL, data)
+
+
+class HashingReader:
+    """读取文件的同时计算整个文件的摘要并统计已读取的字节数"""
+    
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.blake2b(digest_size=32)
+        self.consumed = 0
+        
+    def read(self, size):
+        data = self.f.read(size)
+        self.digest.update(data)
+        self.consumed += len(data)
+        return data
+
+
+def encode_op(op):
+    """把增量操作编码为线路格式，返回 (操作头, 数据)"""
+    if op[0] == OP_COPY:
+        return OP_COPY + COPY_OP.pack(op[1], op[2]), b''
+    return OP_LITERAL + LITERAL_OP.pack(len(op[1])), op[1]
+
+
+def apply_delta(conn, out_fd, basis_fd, block_size, basis_blocks):
+    """从连接读取增量操作并顺序写出重建后的文件
+    
+    返回 (写入字节数, 发送方声明的大小, 发送方摘要, 实际摘要)，连接提前关闭时抛出 ConnectionError
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    written = 0
+    metrics = transfer_metrics('receive', conn)
+    
+    while True:
+        op = recv_exact(conn, 1)
+        if op is None:
+            raise ConnectionError("增量数据流提前结束")
+            
+        if op == OP_COPY:
+            payload = recv_exact(conn, COPY_OP.size)
+            if payload is None:
+                raise ConnectionError("增量数据流提前结束")
+            block_index, count = COPY_OP.unpack(payload)
+            if basis_fd is None or block_index + count > basis_blocks:
+                raise ValueError(f"无效的块引用: {block_index}+{count}")
+            for i in range(block_index, block_index + count):
+                data = os.pread(basis_fd, block_size, i * block_size)
+                write_buffers(out_fd, [data])
+                digest.update(data)
+                written += len(data)
+                
+        elif op == OP_LITERAL:
+            header = recv_exact(conn, LITERAL_OP.size)
+            if header is None:
+                raise ConnectionError("增量数据流提前结束")
+            remaining = LITERAL_OP.unpack(header)[0]
+            while remaining:
+                chunk = view[:min(remaining, len(view))]
+                if recv_into_exact(conn, chunk, metrics.io_calls('recv')) < len(chunk):
+                    raise ConnectionError("增量数据流提前结束")
+                metrics.bytes.inc(len(chunk))
+                write_buffers(out_fd, [chunk], calls=metrics.io_calls('write'))
+                digest.update(chunk)
+                written += len(chunk)
+                remaining -= len(chunk)
+                
+        elif op == OP_END:
+            trailer = recv_exact(conn, END_OP.size)
+            if trailer is None:
+                raise ConnectionError("增量数据流提前结束")
+            expected_size, expected_digest = END_OP.unpack(trailer)
+            return written, expected_size, expected_digest, digest.digest()
+            
+        else:
+            raise ValueError(f"未知的增量操作: {op!r}")
+
+
+class ChunkIndex:
+    """持久化的块签名索引，缓存下载目录中文件的签名，避免每次传输重新计算"""
+    
+    def __init__(self, directory):
+        self.directory = directory
+        index_dir = os.path.join(directory, '.lanshare')
+        os.makedirs(index_dir, exist_ok=True)
+        self.db_path = os.path.join(index_dir, 'chunk_index.db')
+        self.lock = threading.Lock()
+        with closing(self._connect()) as db, db:
+            db.execute("""CREATE TABLE IF NOT EXISTS signatures (
+                              path TEXT NOT NULL,
+                              block_size INTEGER NOT NULL,
+                              size INTEGER NOT NULL,
+                              mtime_ns INTEGER NOT NULL,
+                              signature BLOB NOT NULL,
+                              PRIMARY KEY (path, block_size))""")
+                              
+    def get_signature(self, file_path, block_size):
+        """获取文件签名，文件未变化时直接使用缓存"""
+        stat = os.stat(file_path)
+        name = os.path.relpath(file_path, self.directory)
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT size, mtime_ns, signature FROM signatures WHERE path = ? AND block_size = ?",
+                             (name, block_size)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+            
+        signature = compute_signature(file_path, block_size)
+        with self.lock, closing(self._connect()) as db, db:
+            db.execute("INSERT OR REPLACE INTO signatures VALUES (?, ?, ?, ?, ?)",
+                       (name, block_size, stat.st_size, stat.st_mtime_ns, signature))
+        return signature
+        
+    def warm_up(self, file_path):
+        """在后台为新接收的文件建立签名，下次增量传输时可直接使用"""
+        block_size = choose_block_size(os.path.getsize(file_path))
+        thread = threading.Thread(target=self._warm_up, args=(file_path, block_size), daemon=True)
+        thread.start()
+        
+    def _warm_up(self, file_path, block_size):
+        """后台计算签名"""
+        try:
+            self.get_signature(file_path, block_size)
+        except Exception as e:
+            print(f"建立块索引失败: {e}")
+            
+    def _connect(self):
+        """打开数据库连接（sqlite3 连接不能跨线程共享，每次操作单独打开）"""
+        return sqlite3.connect(self.db_path, timeout=30)
\ No newline at end of file
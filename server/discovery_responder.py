@@ -0,0 +1,195 @@
+# server/discovery_responder.py
+import os
+import sys
+import time
+import socket
+import selectors
+import threading
+import collections
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import (UDP_PORT, LOCAL_HOSTNAME, DISCOVERY_REPLY_INTERVAL, DISCOVERY_MAX_REPLIES_PER_SEC,
+                    DISCOVERY_MULTICAST_GROUP, DISCOVERY_MULTICAST_GROUP6)
+from utils.network_utils import (get_local_ip, get_local_ips, send_discovery_response, drain_datagrams,
+                                 join_multicast_group, INSTANCE_ID)
+from utils.interfaces import list_interfaces
+from utils.dnssd import dnssd_enabled, DnsSdAdvertiser
+from utils.wire import WIRE_CAPABILITY
+
+try:
+    from server.compression import available_codecs
+    from server.integrity import available_algorithms
+except ImportError:
+    from .compression import available_codecs  # 尝试相对导入
+    from .integrity import available_algorithms
+
+# 本机接收端支持的传输模式
+TRANSFER_CAPABILITIES = ['single', 'striped', 'resume', 'delta', 'session', 'tree', 'swarm']
+
+
+def local_capabilities():
+    """本机接收端的能力列表：传输模式、可用的压缩和摘要算法，以及二进制控制消息的版本"""
+    return (TRANSFER_CAPABILITIES + [f"codec:{name}" for name in available_codecs()]
+            + [f"integrity:{name}" for name in available_algorithms()] + [WIRE_CAPABILITY])
+
+
+class DiscoveryResponder:
+    """设备发现应答服务：监听 UDP_PORT 上的发现请求，以单播回复本机的主机名、监听端口和能力
+    
+    同时接收广播、IPv4组播和IPv6组播的请求：在每块网卡上加入两个组播组；
+    安装了 zeroconf 时还通过 DNS-SD 发布服务。
+    
+    同一来源每 DISCOVERY_REPLY_INTERVAL 秒最多回复一次，全局每秒最多回复
+    DISCOVERY_MAX_REPLIES_PER_SEC 次；发现请求中携带的对端信息记录到共享的设备表中。
+    """
+    
+    def __init__(self, listen_port, peer_table=None, port=UDP_PORT):
+        self.listen_port = listen_port
+        self.peer_table = peer_table
+        self.port = port
+        self.local_ip = get_local_ip()
+        self.capabilities = local_capabilities()
+        self.running = False
+        # 监听的UDP套接字：IPv4，以及系统支持时的IPv6
+        self.sockets = []
+        self.advertiser = None
+        self.thread = None
+        # 用于唤醒应答线程的套接字对，停止时不必等待超时
+        self.wakeup_reader = None
+        self.wakeup_writer = None
+        # 每个来源IP上次回复的时间
+        self.last_reply = {}
+        # 最近一秒内的回复时间，用于全局限速
+        self.recent_replies = collections.deque()
+        
+    def start(self):
+        """绑定端口、加入组播组并启动应答线程；IPv4 端口绑定失败时抛出 OSError"""
+        interfaces = list_interfaces()
+        self.sockets.append(self._create_socket(socket.AF_INET, ('', self.port)))
+        self._join_groups(self.sockets[0], DISCOVERY_MULTICAST_GROUP,
+                          [item for item in interfaces if item['family'] == socket.AF_INET])
+        if socket.has_ipv6:
+            try:
+                sock6 = self._create_socket(socket.AF_INET6, ('::', self.port))
+            except OSError as e:
+                print(f"IPv6 发现端口不可用: {e}")
+            else:
+                self.sockets.append(sock6)
+                # 每块网卡只需加入一次
+                by_index = {item['index']: item for item in interfaces if item['family'] == socket.AF_INET6}
+                self._join_groups(sock6, DISCOVERY_MULTICAST_GROUP6, by_index.values())
+            
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.running = True
+        self.thread = threading.Thread(target=self._respond_loop, daemon=True)
+        self.thread.start()
+        print(f"设备发现应答服务启动于 UDP {self.port}")
+        
+        if dnssd_enabled():
+            try:
+                self.advertiser = DnsSdAdvertiser(self.listen_port, get_local_ips(), self.capabilities, INSTANCE_ID)
+                self.advertiser.start()
+            except Exception as e:
+                print(f"DNS-SD 服务发布失败: {e}")
+                self.advertiser = None
+        
+    def _create_socket(self, family, address):
+        """创建并绑定监听发现请求的非阻塞UDP套接字"""
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                # 同一台机器上的图形界面和命令行服务可以同时监听
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if family == socket.AF_INET6:
+                # IPv4 请求由单独的套接字接收
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            sock.bind(address)
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+        
+    def _join_groups(self, sock, group, interfaces):
+        """在每块网卡上加入组播组，个别网卡不支持组播时跳过"""
+        for interface in interfaces:
+            try:
+                join_multicast_group(sock, group, interface)
+            except OSError as e:
+                print(f"网卡 {interface['name']} 加入组播组 {group} 失败: {e}")
+        
+    def stop(self):
+        """停止应答服务"""
+        self.running = False
+        if self.advertiser:
+            self.advertiser.stop()
+            self.advertiser = None
+        if self.thread:
+            self.wakeup_writer.send(b'\0')
+            self.thread.join(timeout=2)
+            self.thread = None
+            self.wakeup_reader.close()
+            self.wakeup_writer.close()
+        for sock in self.sockets:
+            sock.close()
+        self.sockets = []
+        
+    def _respond_loop(self):
+        """应答线程主循环：阻塞在 select 上，只在收到数据报或被 stop 唤醒时运行"""
+        with selectors.DefaultSelector() as selector:
+            for sock in self.sockets:
+                selector.register(sock, selectors.EVENT_READ)
+            selector.register(self.wakeup_reader, selectors.EVENT_READ)
+            while self.running:
+                try:
+                    events = selector.select()
+                except OSError:
+                    break
+                for key, _ in events:
+                    if key.fileobj is self.wakeup_reader:
+                        continue
+                    for message, addr in drain_datagrams(key.fileobj):
+                        if message.get('type') != 'discovery':
+                            continue
+                        if message.get('instance') == INSTANCE_ID:
+                            # 本进程自己发出的请求
+                            continue
+                        self._handle_request(key.fileobj, message, addr)
+        
+    def _handle_request(self, sock, message, addr):
+        """记录发出请求的对端，并在限速允许时从收到请求的套接字单播回复"""
+        # 文件传输走IPv4，通过IPv6收到的请求以对端自报的IPv4地址记录
+        peer_ip = addr[0] if sock.family == socket.AF_INET else message.get('ip')
+        if self.peer_table is not None and message.get('listen_port') and peer_ip:
+            self.peer_table.update(peer_ip, message.get('hostname', 'Unknown'), message['listen_port'],
+                                   message.get('capabilities'))
+        
+        if not self._allow_reply(addr[0]):
+            return
+        try:
+            # 按请求的格式回复，旧版本的发现方只能解析JSON
+            send_discovery_response(sock, addr, LOCAL_HOSTNAME, self.local_ip, self.listen_port,
+                                    self.capabilities, getattr(message, 'binary', False))
+        except OSError as e:
+            print(f"发送发现应答失败: {e}")
+        
+    def _allow_reply(self, ip):
+        """回复限速：同一来源最小间隔和全局每秒上限"""
+        now = time.monotonic()
+        if now - self.last_reply.get(ip, float('-inf')) < DISCOVERY_REPLY_INTERVAL:
+            return False
+        while self.recent_replies and now - self.recent_replies[0] >= 1.0:
+            self.recent_replies.popleft()
+        if len(self.recent_replies) >= DISCOVERY_MAX_REPLIES_PER_SEC:
+            return False
+            
+        self.recent_replies.append(now)
+        self.last_reply[ip] = now
+        if len(self.last_reply) > 4096:
+            # 丢弃早已过了限速间隔的记录
+            self.last_reply = {key: value for key, value in self.last_reply.items()
+                               if now - value < DISCOVERY_REPLY_INTERVAL}
+        return True
\ No newline at end of file
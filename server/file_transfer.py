@@ -4,6 +4,13 @@ import threading
 import os
 import sys
 import os
+import mmap
+import time
+import errno
+import select
+import json
+import re
+import uuid
 from datetime import datetime
 
 # 自定义异常类
@@ -11,19 +18,139 @@ class InterruptedError(Exception):
     """传输被中断异常"""
     pass
 
+class _SendfileUnavailable(Exception):
+    """当前平台或文件不支持零拷贝发送"""
+    pass
+
 # 添加项目根目录到系统路径
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from config import CHUNK_SIZE
-from utils.network_utils import create_tcp_server_socket, create_tcp_client_socket
+from config import (CHUNK_SIZE, USE_SENDFILE, PROGRESS_GRANULARITY, RECV_BUFFER_POOL_SIZE,
+                    RECV_BUFFERS_PER_CONN, USE_WRITEV, PREALLOCATE_FILES, MMAP_RECEIVE_ENABLED,
+                    MMAP_MIN_SIZE, MMAP_FLUSH_WATERMARK, MMAP_MAX_DIRTY, DEFAULT_STREAMS,
+                    MAX_STREAMS_PER_TRANSFER, STRIPE_MIN_SIZE, STRIPE_FINALIZE_TIMEOUT,
+                    RESUME_ENABLED, RESUME_JOURNAL_INTERVAL, DURABLE_COMMIT, DELTA_ENABLED,
+                    COMPRESSION_ENABLED, INTEGRITY_ENABLED, INTEGRITY_CHUNK_SIZE, WIRE_FORMAT, RATE_LIMIT_UPLOAD,
+                    RATE_LIMIT_DOWNLOAD, RATE_LIMIT_PEERS, RATE_LIMIT_SCHEDULE)
+from utils.network_utils import (create_tcp_server_socket, create_tcp_client_socket,
+                                 send_json_message, send_reply_message, recv_json_message, recv_exact)
+from utils.wire import WIRE_VERSION, WIRE_CAPABILITY, WireVersionError, encode_version_error, negotiated
+from utils.io_utils import (BufferPool, MappedWriter, recv_into_exact, preallocate_file, write_buffers,
+                            sync_directory)
+from utils.metrics import (registry, transfer_metrics, active_connections, active_transfers, files_total,
+                           ProgressPrinter)
+from utils.tuning import configure_socket, tune_connection, record_transfer
+
+try:
+    from server.resume import PartialFile, compute_fingerprint, save_names
+    from server.delta import (ChunkIndex, HashingReader, choose_block_size, generate_delta, apply_delta,
+                              literal_ops, encode_op, SIGNATURE_ENTRY, OP_END, END_OP)
+    from server.compression import CompressedSender, select_codecs, negotiate_codec, receive_compressed
+    from server.integrity import (ChunkHasher, available_algorithms, negotiate_integrity, merkle_root,
+                                  send_verification, receive_verification)
+    from server.rate_limit import RateLimiter
+    from server.session import receive_session
+    from server.tree_transfer import receive_tree
+    from server.swarm import receive_swarm, serve_swarm_peer
+except ImportError:
+    from .resume import PartialFile, compute_fingerprint, save_names  # 尝试相对导入
+    from .delta import (ChunkIndex, HashingReader, choose_block_size, generate_delta, apply_delta,
+                        literal_ops, encode_op, SIGNATURE_ENTRY, OP_END, END_OP)
+    from .compression import CompressedSender, select_codecs, negotiate_codec, receive_compressed
+    from .integrity import (ChunkHasher, available_algorithms, negotiate_integrity, merkle_root,
+                            send_verification, receive_verification)
+    from .rate_limit import RateLimiter
+    from .session import receive_session
+    from .tree_transfer import receive_tree
+    from .swarm import receive_swarm, serve_swarm_peer
+
+
+class _StripedTransfer:
+    """一个多连接分段传输的接收状态"""
+    
+    def __init__(self, transfer_id, file_name, file_size, streams, temp_path, integrity=None, binary=False,
+                 chunk_size=None):
+        self.transfer_id = transfer_id
+        self.file_name = file_name
+        self.file_size = file_size
+        self.streams = streams
+        self.temp_path = temp_path
+        self.fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+        self.completed_ranges = set()
+        self.completed_bytes = 0
+        self.failed = False
+        self.save_path = None
+        # 完整性校验算法和发送方的数据块大小，各分段校验通过后的根摘要 {分段序号: 摘要}，以及整个文件的根摘要
+        self.integrity = integrity
+        self.chunk_size = chunk_size
+        self.binary = binary
+        self.range_roots = {}
+        self.digest = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+
+class _SingleTransfer:
+    """一个单连接传输的接收状态，线程引擎和 asyncio 引擎共用"""
+    
+    def __init__(self, partial, file_name, file_size, offset, codec, hasher=None, binary=False, throttle=None):
+        self.partial = partial
+        self.file_name = file_name
+        self.file_size = file_size
+        self.offset = offset
+        self.codec = codec
+        self.checkpoint_offset = offset
+        self.written = offset
+        # 完整性校验：后台计算整个文件（包括续传之前已有的部分）的数据块摘要
+        self.hasher = hasher
+        self.binary = binary
+        self.digest = None
+        self.throttle = throttle
+        
+    def on_written(self, written):
+        """记录写入进度，每隔 RESUME_JOURNAL_INTERVAL 字节刷盘并更新断点"""
+        self.written = written
+        if self.hasher is not None:
+            self.hasher.advance(written)
+        if written - self.checkpoint_offset >= RESUME_JOURNAL_INTERVAL:
+            self.partial.checkpoint(written)
+            self.checkpoint_offset = written
+            
+    def abort(self):
+        """传输出错，只保留最近一次写入日志的断点
+        
+        出错前最后收到的数据没有经过校验，可能不完整或被错误解析，不能记入断点
+        """
+        if self.hasher is not None:
+            self.hasher.close()
+        self.partial.suspend(self.checkpoint_offset)
+
 
 class FileReceiver:
-    def __init__(self, host='0.0.0.0', port=50002):
+    def __init__(self, host='0.0.0.0', port=50002, download_dir=None):
         self.host = host
         self.port = port
         self.running = False
         self.receive_thread = None
-        self.download_dir = os.path.join(os.path.expanduser("~"), "Downloads", "LANFileShare")
+        self.download_dir = download_dir or os.path.join(os.path.expanduser("~"), "Downloads", "LANFileShare")
+        # 所有连接共享的接收缓冲池，限制并发接收时的内存占用
+        self.buffer_pool = BufferPool(CHUNK_SIZE, RECV_BUFFER_POOL_SIZE)
+        # 大文件是否使用内存映射接收
+        self.mmap_receive = MMAP_RECEIVE_ENABLED
+        pool = self.buffer_pool
+        registry.gauge('lanshare_buffers_in_use', "接收缓冲池中正在使用的缓冲区数").set_function(
+            lambda: pool.created_count - len(pool.free_buffers))
+        # 进行中的分段传输 {'transfer_id': _StripedTransfer}
+        self.striped_transfers = {}
+        self.striped_lock = threading.Lock()
+        # 参与中的多设备分发 {'swarm_id': PieceSource}，其他接收方通过分片连接从这里获取分片
+        self.swarms = {}
+        self.swarms_lock = threading.Lock()
+        # 增量传输使用的块签名索引，首次使用时创建
+        self.chunk_index = None
+        self.chunk_index_lock = threading.Lock()
+        # 接收限速（全局和每个对端），可在运行时修改
+        self.rate_limiter = RateLimiter(RATE_LIMIT_DOWNLOAD)
         
         # 确保下载目录存在
         os.makedirs(self.download_dir, exist_ok=True)
@@ -47,11 +174,12 @@ class FileReceiver:
         while self.running:
             try:
                 conn, addr = server_socket.accept()
+                configure_socket(conn)
                 print(f"收到连接来自: {addr}")
                 
                 # 为每个连接创建新线程处理
                 client_thread = threading.Thread(
-                    target=self._handle_client,
+                    target=self._handle_connection,
                     args=(conn, addr),
                     daemon=True
                 )
@@ -66,61 +194,29 @@ class FileReceiver:
                 
         server_socket.close()
         
-    def _handle_client(self, conn, addr):
-        """处理客户端连接"""
+    def _handle_connection(self, conn, addr):
+        """连接处理线程，统计活动连接数"""
+        with active_connections('receive').track():
+            self._handle_client(conn, addr)
+        
+    def _handle_client(self, conn, addr, file_info=None):
+        """处理客户端连接，file_info 不为空时表示文件头已经由调用方读取"""
         try:
             # 首先接收文件信息（大小和名称）
-            header_data = self._recv_all(conn, 4)
-            if not header_data:
+            if file_info is None:
+                file_info = recv_json_message(conn)
+            if not file_info:
                 print(f"无法接收文件头信息来自: {addr}")
                 return
                 
-            header_size = int.from_bytes(header_data, 'big')
-            header_json = self._recv_all(conn, header_size).decode('utf-8')
+            self._dispatch(conn, addr, file_info)
                 
-            import json
-            file_info = json.loads(header_json)
-            file_name = file_info['name']
-            file_size = file_info['size']
-                
-            print(f"开始接收文件: {file_name}, 大小: {file_size} bytes, 来自: {addr}")
-                
-            # 构建保存路径
-            save_path = os.path.join(self.download_dir, file_name)
-                
-            # 如果文件已存在，添加数字后缀
-            counter = 1
-            base_name, ext = os.path.splitext(save_path)
-            while os.path.exists(save_path):
-                save_path = f"{base_name}_{counter}{ext}"
-                counter += 1
-                
-            # 接收文件内容
-            received_size = 0
-            with open(save_path, 'wb') as f:
-                while received_size < file_size:
-                    chunk_size = min(CHUNK_SIZE, file_size - received_size)
-                    chunk = conn.recv(chunk_size)
-                        
-                    if not chunk:
-                        print(f"文件传输中断: {file_name}, 接收了 {received_size}/{file_size} 字节")
-                        break
-                            
-                    f.write(chunk)
-                    received_size += len(chunk)
-                        
-                    # 计算进度
-                    progress = (received_size / file_size) * 100
-                    print(f"\r接收进度: {progress:.1f}% ({received_size}/{file_size})", end='', flush=True)
-                
-            print(f"\n文件接收完成: {save_path}")
-                
-            # 发送确认消息
+        except WireVersionError as e:
+            print(f"接收到了无法解析的二进制帧来自: {addr}, {e}")
             try:
-                conn.sendall(b"OK")
-            except socket.error as se:
-                print(f"发送确认消息失败: {se}")
-                
+                conn.sendall(encode_version_error(e))
+            except OSError:
+                pass
         except json.JSONDecodeError:
             print(f"接收到了无效的JSON数据来自: {addr}")
         except Exception as e:
@@ -128,26 +224,527 @@ class FileReceiver:
         finally:
             conn.close()
             
-    def _recv_all(self, conn, size):
-        """接收指定大小的数据"""
-        data = b''
-        while len(data) < size:
-            packet = conn.recv(size - len(data))
-            if not packet:
-                return None
-            data += packet
-        return data
-
+    def _dispatch(self, conn, addr, file_info):
+        """按传输模式分发到对应的接收流程"""
+        mode = file_info.get('mode', 'single')
+        if mode == 'striped':
+            self._receive_striped(conn, addr, file_info)
+        elif mode == 'range':
+            self._receive_additional_range(conn, addr, file_info)
+        elif mode == 'delta':
+            self._receive_delta(conn, addr, file_info)
+        elif mode == 'session':
+            receive_session(self, conn, addr, file_info)
+        elif mode == 'tree':
+            receive_tree(self, conn, addr, file_info)
+        elif mode == 'swarm':
+            receive_swarm(self, conn, addr, file_info)
+        elif mode == 'swarm_peer':
+            serve_swarm_peer(self, conn, addr, file_info)
+        else:
+            self._receive_single(conn, addr, file_info)
+            
+            
+    def _receive_single(self, conn, addr, file_info):
+        """通过单个连接接收整个文件，先写入 .part 文件，完成后再重命名"""
+        transfer, reply = self._begin_single(addr, file_info)
+        if reply is not None:
+            # 告知发送方从哪个偏移开始发送，以及选定的压缩算法
+            try:
+                send_reply_message(conn, file_info, reply)
+            except Exception:
+                transfer.abort()
+                raise
+        self._receive_single_body(conn, transfer)
+        
+    def _receive_single_body(self, conn, transfer):
+        """接收单连接传输的文件内容，完成后发送确认"""
+        # 接收文件内容
+        try:
+            length = transfer.file_size - transfer.offset
+            if transfer.codec:
+                receive_compressed(conn, transfer.partial.fd, transfer.codec, transfer.offset, length,
+                                   on_written=transfer.on_written, throttle=transfer.throttle)
+            else:
+                self._receive_file_content(conn, transfer.partial.fd, length, offset=transfer.offset,
+                                           preallocate=transfer.offset == 0, on_written=transfer.on_written,
+                                           throttle=transfer.throttle)
+        except Exception:
+            transfer.abort()
+            raise
+        self._complete_single(conn, transfer)
+        
+    def _complete_single(self, conn, transfer):
+        """数据接收结束后的流程：完整性校验、重命名为最终文件，然后发送确认"""
+        if transfer.hasher is not None and transfer.written == transfer.file_size:
+            if not self._verify_single(conn, transfer):
+                return
+            
+        if not self._finish_single(transfer):
+            return
+            
+        # 发送确认消息，启用完整性校验时确认中携带整个文件的根摘要
+        try:
+            if transfer.hasher is not None:
+                send_json_message(conn, {'ok': True, 'digest': transfer.digest.hex()}, transfer.binary)
+            else:
+                conn.sendall(b"OK")
+        except socket.error as se:
+            print(f"发送确认消息失败: {se}")
+        
+    def _verify_single(self, conn, transfer):
+        """对比发送方的数据块摘要并重收不一致的块，最终仍不一致时丢弃数据并返回 False"""
+        fd = transfer.partial.fd
+        
+        def receive_range(offset, length):
+            return self._receive_file_content(conn, fd, length, offset=offset, preallocate=False)
+            
+        try:
+            ok, transfer.digest = receive_verification(conn, transfer.hasher, receive_range, transfer.binary)
+        except Exception:
+            transfer.abort()
+            raise
+        if ok:
+            return True
+            
+        print(f"\n文件校验失败: {transfer.file_name}")
+        files_total('receive', 'failed').inc()
+        # 数据已确认损坏，不保留断点
+        transfer.partial.suspend(0)
+        try:
+            send_json_message(conn, {'ok': False, 'digest': transfer.digest.hex()}, transfer.binary)
+        except socket.error as se:
+            print(f"发送确认消息失败: {se}")
+        return False
+            
+    def _begin_single(self, addr, file_info):
+        """打开 .part 文件并协商续传偏移和压缩算法，返回 (传输状态, 需要回复给发送方的消息或None)"""
+        file_name = os.path.basename(file_info['name'])
+        file_size = file_info['size']
+        resume = file_info.get('resume', False)
+        
+        partial = PartialFile(self.download_dir, file_name, file_size,
+                              file_info.get('fingerprint') if resume else None)
+        offset = partial.open()
+        codec = negotiate_codec(file_info.get('codecs'))
+        algorithm, chunk_size = negotiate_integrity(file_info)
+        hasher = None
+        if algorithm:
+            hasher = ChunkHasher(partial.fd, algorithm, 0, file_size, available=offset,
+                                 chunk_size=chunk_size).start_hashing()
+        reply = None
+        if resume or 'codecs' in file_info or 'integrity' in file_info:
+            reply = {'offset': offset, 'codec': codec}
+            if 'integrity' in file_info:
+                reply['integrity'] = algorithm
+            
+        if offset:
+            print(f"断点续传文件: {file_name}, 从 {offset}/{file_size} 字节继续, 来自: {addr}")
+        else:
+            print(f"开始接收文件: {file_name}, 大小: {file_size} bytes, 来自: {addr}")
+        return _SingleTransfer(partial, file_name, file_size, offset, codec, hasher, negotiated(file_info),
+                               self.rate_limiter.throttle(addr[0])), reply
+            
+    def _finish_single(self, transfer):
+        """数据接收结束：完整时重命名为最终文件并返回 True，不完整时保留断点并返回 False"""
+        if transfer.written < transfer.file_size:
+            print(f"文件传输中断: {transfer.file_name}, 接收了 {transfer.written}/{transfer.file_size} 字节")
+            files_total('receive', 'failed').inc()
+            transfer.abort()
+            return False
+        
+        save_path = self._commit_partial(transfer.partial, transfer.file_name)
+        files_total('receive', 'ok').inc()
+            
+        print(f"\n文件接收完成: {save_path}")
+        return True
+            
+    def _receive_striped(self, conn, addr, file_info):
+        """协商分段传输：确定连接数并分配传输ID，随后本连接接收第一个分段"""
+        file_name = os.path.basename(file_info['name'])
+        file_size = file_info['size']
+        chunks = max(1, (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE)
+        streams = max(1, min(int(file_info.get('streams', 1)), MAX_STREAMS_PER_TRANSFER, chunks))
+        
+        transfer_id = uuid.uuid4().hex
+        temp_path = os.path.join(self.download_dir, f".{file_name}.{transfer_id[:8]}.tmp")
+        algorithm, chunk_size = negotiate_integrity(file_info)
+        transfer = _StripedTransfer(transfer_id, file_name, file_size, streams, temp_path, algorithm,
+                                    negotiated(file_info), chunk_size)
+        if PREALLOCATE_FILES:
+            preallocate_file(transfer.fd, file_size)
+        os.ftruncate(transfer.fd, file_size)
+        
+        with self.striped_lock:
+            self.striped_transfers[transfer_id] = transfer
+            
+        print(f"开始分段接收文件: {file_name}, 大小: {file_size} bytes, 连接数: {streams}, 来自: {addr}")
+        reply = {'transfer_id': transfer_id, 'streams': streams}
+        if 'integrity' in file_info:
+            reply['integrity'] = algorithm
+        send_reply_message(conn, file_info, reply)
+        
+        range_info = recv_json_message(conn)
+        if not range_info:
+            self._finish_range(transfer, None, False)
+            return
+        self._receive_range(conn, addr, transfer, range_info)
+        
+    def _receive_additional_range(self, conn, addr, file_info):
+        """接收已协商分段传输中的其他分段"""
+        with self.striped_lock:
+            transfer = self.striped_transfers.get(file_info.get('transfer_id'))
+        if transfer is None:
+            print(f"未知的分段传输ID来自: {addr}")
+            conn.sendall(b"ER")
+            return
+        self._receive_range(conn, addr, transfer, file_info)
+        
+    def _receive_range(self, conn, addr, transfer, range_info):
+        """把一个分段写入临时文件的对应偏移，单独校验该分段，等待整个文件完成后确认"""
+        range_index = range_info['range_index']
+        offset = range_info['offset']
+        length = range_info['length']
+        
+        ok = False
+        root = None
+        hasher = None
+        try:
+            if offset < 0 or offset + length > transfer.file_size:
+                raise ValueError(f"分段超出文件范围: {offset}+{length}")
+            if transfer.integrity:
+                hasher = ChunkHasher(transfer.fd, transfer.integrity, offset, length,
+                                     available=offset, chunk_size=transfer.chunk_size).start_hashing()
+            received_size = self._receive_file_content(conn, transfer.fd, length, offset=offset,
+                                                       preallocate=False,
+                                                       on_written=hasher.advance if hasher else None,
+                                                       throttle=self.rate_limiter.throttle(addr[0]))
+            ok = received_size == length
+            if not ok:
+                print(f"\n分段传输中断: {transfer.file_name}#{range_index}, 接收了 {received_size}/{length} 字节")
+            elif hasher is not None:
+                def receive_range(range_offset, range_length):
+                    return self._receive_file_content(conn, transfer.fd, range_length, offset=range_offset,
+                                                      preallocate=False)
+                ok, root = receive_verification(conn, hasher, receive_range, transfer.binary)
+                if not ok:
+                    print(f"\n分段校验失败: {transfer.file_name}#{range_index}")
+        finally:
+            if hasher is not None:
+                hasher.close()
+            self._finish_range(transfer, range_index, ok, length, root)
+            
+        # 所有分段到齐并完成重命名后才确认，保证发送方看到的是完整文件
+        finished = transfer.done.wait(STRIPE_FINALIZE_TIMEOUT)
+        succeeded = finished and not transfer.failed
+        try:
+            if transfer.integrity:
+                digest = transfer.digest.hex() if succeeded else ''
+                send_json_message(conn, {'ok': succeeded, 'digest': digest}, transfer.binary)
+            else:
+                conn.sendall(b"OK" if succeeded else b"ER")
+        except socket.error as se:
+            print(f"发送确认消息失败: {se}")
+            
+    def _finish_range(self, transfer, range_index, ok, length=0, root=None):
+        """记录分段完成情况，全部完成时原子地重命名为最终文件"""
+        with transfer.lock:
+            if transfer.done.is_set():
+                return
+            if ok:
+                transfer.completed_ranges.add(range_index)
+                transfer.completed_bytes += length
+                transfer.range_roots[range_index] = root
+            else:
+                transfer.failed = True
+            finished = transfer.failed or len(transfer.completed_ranges) >= transfer.streams
+            if not finished:
+                return
+                
+            succeeded = not transfer.failed and transfer.completed_bytes == transfer.file_size
+            try:
+                if succeeded and DURABLE_COMMIT:
+                    os.fsync(transfer.fd)
+            finally:
+                os.close(transfer.fd)
+            if succeeded:
+                if transfer.integrity:
+                    # 整个文件的根摘要由各分段的根按分段顺序合并
+                    transfer.digest = merkle_root(transfer.integrity,
+                                                  [transfer.range_roots[i] for i in sorted(transfer.range_roots)])
+                transfer.save_path = self._unique_save_path(transfer.file_name)
+                try:
+                    os.replace(transfer.temp_path, transfer.save_path)
+                finally:
+                    save_names.release(transfer.save_path)
+                if DURABLE_COMMIT:
+                    sync_directory(self.download_dir)
+                files_total('receive', 'ok').inc()
+                print(f"\n文件接收完成: {transfer.save_path}")
+            else:
+                transfer.failed = True
+                files_total('receive', 'failed').inc()
+                os.remove(transfer.temp_path)
+                print(f"\n分段传输失败: {transfer.file_name}")
+            transfer.done.set()
+            
+        with self.striped_lock:
+            self.striped_transfers.pop(transfer.transfer_id, None)
+            
+    def _receive_delta(self, conn, addr, file_info):
+        """增量传输：先发送同名文件的块签名，再按复制/原样操作重建文件"""
+        file_name = os.path.basename(file_info['name'])
+        file_size = file_info['size']
+        
+        basis_path = self._find_basis_file(file_name)
+        block_size = 0
+        signature = b''
+        if basis_path:
+            block_size = choose_block_size(os.path.getsize(basis_path))
+            signature = self._get_chunk_index().get_signature(basis_path, block_size)
+        basis_blocks = len(signature) // SIGNATURE_ENTRY.size
+        
+        print(f"开始增量接收文件: {file_name}, 大小: {file_size} bytes, 基准文件: {basis_path or '无'}, 来自: {addr}")
+        send_reply_message(conn, file_info, {'block_size': block_size, 'blocks': basis_blocks})
+        conn.sendall(signature)
+        
+        partial = PartialFile(self.download_dir, file_name, file_size)
+        partial.open()
+        basis_fd = os.open(basis_path, os.O_RDONLY) if basis_path else None
+        try:
+            written, expected_size, expected_digest, digest = apply_delta(
+                conn, partial.fd, basis_fd, block_size, basis_blocks)
+        except Exception:
+            partial.suspend(0)
+            raise
+        finally:
+            if basis_fd is not None:
+                os.close(basis_fd)
+                
+        if written != expected_size or written != file_size or digest != expected_digest:
+            print(f"增量重建校验失败: {file_name}, 重建 {written}/{file_size} 字节")
+            files_total('receive', 'failed').inc()
+            partial.suspend(0)
+            conn.sendall(b"ER")
+            return
+            
+        save_path = self._commit_partial(partial, file_name)
+        files_total('receive', 'ok').inc()
+        self._get_chunk_index().warm_up(save_path)
+        print(f"文件接收完成: {save_path}")
+        
+        try:
+            conn.sendall(b"OK")
+        except socket.error as se:
+            print(f"发送确认消息失败: {se}")
+            
+    def _find_basis_file(self, file_name):
+        """在下载目录中查找同名文件（包括自动添加数字后缀的版本），返回最新的一个"""
+        base_name, ext = os.path.splitext(os.path.basename(file_name))
+        pattern = re.compile(re.escape(base_name) + r'(_\d+)?' + re.escape(ext) + '$')
+        candidates = []
+        for entry in os.scandir(self.download_dir):
+            if entry.is_file() and pattern.match(entry.name):
+                candidates.append((entry.stat().st_mtime_ns, entry.path))
+        if not candidates:
+            return None
+        return max(candidates)[1]
+        
+    def _get_chunk_index(self):
+        """获取块签名索引"""
+        with self.chunk_index_lock:
+            if self.chunk_index is None:
+                self.chunk_index = ChunkIndex(self.download_dir)
+            return self.chunk_index
+            
+    def _unique_save_path(self, file_name):
+        """构建保存路径，如果文件已存在或正被其他传输占用，添加数字后缀
+        
+        返回的路径在 save_names.release() 之前不会分配给其他传输
+        """
+        return save_names.reserve(os.path.join(self.download_dir, os.path.basename(file_name)))
+        
+    def _commit_partial(self, partial, file_name, sync=True):
+        """把接收完成的 .part 文件重命名为下载目录中不冲突的文件名，返回最终路径"""
+        save_path = self._unique_save_path(file_name)
+        try:
+            partial.commit(save_path, sync)
+        finally:
+            save_names.release(save_path)
+        return save_path
+        
+    def _receive_file_content(self, conn, fd, length, offset=None, preallocate=True, on_written=None,
+                              throttle=None):
+        """使用预分配缓冲池和 recv_into 接收文件内容，返回实际接收的字节数
+        
+        offset 为 None 时顺序写入，否则从指定偏移开始使用 pwrite 写入；
+        每次写出后调用 on_written(已写入的文件末尾偏移)；throttle 不为空时按其限速接收
+        """
+        if offset is not None and self._use_mmap(length):
+            return self._receive_mapped(conn, fd, length, offset, on_written, throttle)
+        if PREALLOCATE_FILES and preallocate:
+            preallocate_file(fd, (offset or 0) + length)
+            
+        # 每次写出的数据量按连接调优选择的块大小决定，小文件只占用一个缓冲区
+        chunk_size = tune_connection(conn, length, 'receive')
+        buffers = self.buffer_pool.acquire(min(RECV_BUFFERS_PER_CONN, -(-chunk_size // CHUNK_SIZE)))
+        start_time = time.perf_counter()
+        views = [memoryview(buffer) for buffer in buffers]
+        received_size = 0
+        metrics = transfer_metrics('receive', conn)
+        recv_calls = metrics.io_calls('recv')
+        write_calls = metrics.io_calls('write')
+        printer = ProgressPrinter("接收进度")
+        try:
+            while received_size < length:
+                chunk_start = time.perf_counter()
+                # 依次填满若干个缓冲区，再一次性写出
+                filled = []
+                step = throttle.slice if throttle is not None else None
+                for view in views:
+                    remaining = length - received_size
+                    if remaining <= 0:
+                        break
+                    wanted = min(len(view), remaining, step or remaining)
+                    n = recv_into_exact(conn, view[:wanted], recv_calls)
+                    if n:
+                        filled.append(view[:n])
+                        received_size += n
+                        if throttle is not None:
+                            throttle.consume(n)
+                    if n < wanted:
+                        # 连接提前关闭
+                        break
+                        
+                if not filled:
+                    break
+                    
+                filled_size = sum(len(chunk) for chunk in filled)
+                write_offset = None
+                if offset is not None:
+                    write_offset = offset + received_size - filled_size
+                write_buffers(fd, filled, offset=write_offset, use_vectored=USE_WRITEV, calls=write_calls)
+                if on_written:
+                    on_written((offset or 0) + received_size)
+                metrics.bytes.inc(filled_size)
+                metrics.chunk_seconds.observe(time.perf_counter() - chunk_start)
+                printer.update(received_size, length)
+                
+                if len(filled) < len(views) and received_size < length:
+                    break
+        finally:
+            for view in views:
+                view.release()
+            self.buffer_pool.release(buffers)
+            
+        if throttle is None or throttle.slice is None:
+            record_transfer(conn, received_size, time.perf_counter() - start_time)
+        return received_size
+        
+    def _use_mmap(self, length):
+        """是否使用内存映射接收 length 字节的数据"""
+        return self.mmap_receive and length >= MMAP_MIN_SIZE and hasattr(mmap, 'mmap')
+        
+    def _receive_mapped(self, conn, fd, length, offset, on_written=None, throttle=None):
+        """内存映射接收：文件先扩展到 offset+length 并预分配，recv_into 直接写入映射
+        
+        后台线程按 MMAP_FLUSH_WATERMARK 刷盘，返回前所有数据都已经 msync 并 fdatasync，
+        之后发送的确认意味着数据已经落盘。返回实际接收的字节数
+        """
+        # 映射的区域必须有磁盘空间，否则磁盘写满时写入映射会触发 SIGBUS
+        preallocate_file(fd, offset + length)
+        if os.fstat(fd).st_size < offset + length:
+            os.ftruncate(fd, offset + length)
+            
+        chunk_size = tune_connection(conn, length, 'receive')
+        metrics = transfer_metrics('receive', conn)
+        recv_calls = metrics.io_calls('recv')
+        writer = MappedWriter(fd, offset, length, MMAP_FLUSH_WATERMARK, MMAP_MAX_DIRTY, metrics.io_calls('msync'))
+        printer = ProgressPrinter("接收进度")
+        received_size = 0
+        start_time = time.perf_counter()
+        try:
+            while received_size < length:
+                chunk_start = time.perf_counter()
+                step = throttle.slice if throttle is not None else None
+                wanted = min(chunk_size, length - received_size, step or chunk_size)
+                n = recv_into_exact(conn, writer.region(received_size, wanted), recv_calls)
+                if n == 0:
+                    break
+                received_size += n
+                if throttle is not None:
+                    throttle.consume(n)
+                writer.advance(received_size)
+                if on_written:
+                    on_written(offset + received_size)
+                metrics.bytes.inc(n)
+                metrics.chunk_seconds.observe(time.perf_counter() - chunk_start)
+                printer.update(received_size, length)
+                if n < wanted:
+                    # 连接提前关闭
+                    break
+        finally:
+            writer.close()
+            
+        if throttle is None or throttle.slice is None:
+            record_transfer(conn, received_size, time.perf_counter() - start_time)
+        return received_size
+        
 
 class FileSender:
-    def __init__(self):
+    def __init__(self, peer_table=None, rate_limiter=None):
         self.transfer_callback = None
+        # 用于查询对端能力；已确认支持二进制帧的对端地址
+        self.peer_table = peer_table
+        self.wire_peers = set()
+        # 发送限速（全局、每个对端、按时段），多个 FileSender 可以共用一个；当前传输的限速器
+        self.rate_limiter = rate_limiter or RateLimiter(RATE_LIMIT_UPLOAD, RATE_LIMIT_PEERS, RATE_LIMIT_SCHEDULE)
+        self.throttle = None
+        self.progress_printer = ProgressPrinter("发送进度")
+        
+    def set_rate_limit(self, rate):
+        """修改正在进行的传输的限速（字节/秒，0 表示不限速）"""
+        throttle = self.throttle
+        if throttle is not None:
+            throttle.set_rate(rate)
         
-    def send_file(self, file_path, target_ip, target_port=50002):
-        """发送文件到目标设备"""
+    def send_file(self, file_path, target_ip, target_port=50002, streams=None, resume=None, delta=None,
+                  compress=None, rate_limit=0):
+        """发送文件到目标设备
+        
+        streams 大于1时对大文件使用多连接分段传输；resume 为 True 时与接收方协商断点，只发送缺失的部分；
+        delta 为 True 时只发送与接收方同名文件不同的部分；compress 为 True 时对可压缩的数据启用流式压缩；
+        rate_limit 为本次传输的限速（字节/秒），同时受全局和该对端的限速约束
+        """
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"文件不存在: {file_path}")
             
+        if streams is None:
+            streams = DEFAULT_STREAMS
+        if resume is None:
+            resume = RESUME_ENABLED
+        if delta is None:
+            delta = DELTA_ENABLED
+        if compress is None:
+            compress = COMPRESSION_ENABLED
+        throttle = self.throttle = self.rate_limiter.throttle(target_ip, rate_limit)
+        with active_transfers('send').track():
+            try:
+                if delta:
+                    result = self._send_delta(file_path, target_ip, target_port, throttle)
+                elif streams > 1 and os.path.getsize(file_path) >= STRIPE_MIN_SIZE:
+                    result = self._send_striped(file_path, target_ip, target_port, streams, throttle)
+                else:
+                    result = self._send_single(file_path, target_ip, target_port, resume, compress, throttle)
+            except Exception:
+                files_total('send', 'failed').inc()
+                raise
+        files_total('send', 'ok').inc()
+        return result
+            
+    def _send_single(self, file_path, target_ip, target_port, resume, compress, throttle):
+        """通过单个连接发送整个文件"""
+        sock = None
         try:
             # 获取文件信息
             file_size = os.path.getsize(file_path)
@@ -160,59 +757,69 @@ class FileSender:
             sock.connect((target_ip, target_port))
             
             # 发送文件信息
-            import json
             file_info = {
                 'name': file_name,
                 'size': file_size
             }
-            header_json = json.dumps(file_info)
-            header_bytes = header_json.encode('utf-8')
-            header_size = len(header_bytes)
+            legacy = self._is_legacy_peer(target_ip)
+            if resume and not legacy:
+                file_info['resume'] = True
+                file_info['fingerprint'] = compute_fingerprint(file_path)
+            if compress and not legacy:
+                # 采样文件开头，只在压缩有收益时才提议压缩
+                file_info['codecs'] = select_codecs(file_path, 0, file_size)
+            if INTEGRITY_ENABLED and available_algorithms() and not legacy:
+                file_info['integrity'] = available_algorithms()
+                file_info['block_size'] = INTEGRITY_CHUNK_SIZE
+                # 旧版本的接收方只在请求续传或压缩时回复，空的压缩算法列表让它也回复协商结果
+                file_info.setdefault('codecs', [])
+            binary = self._send_header(sock, target_ip, file_info)
             
-            # 先发送头部长度，再发送头部内容
-            sock.sendall(header_size.to_bytes(4, 'big'))
-            sock.sendall(header_bytes)
+            # 协商续传偏移、压缩算法和完整性校验算法
+            offset = 0
+            codec = None
+            algorithm = None
+            if 'resume' in file_info or 'codecs' in file_info:
+                reply = self._recv_reply(sock, target_ip)
+                if not reply:
+                    raise ConnectionError("接收方未响应传输协商")
+                offset = reply.get('offset', 0)
+                codec = reply.get('codec')
+                algorithm = reply.get('integrity')
+                binary = binary or negotiated(reply)
+                if not 0 <= offset <= file_size:
+                    raise ValueError(f"接收方返回无效的续传偏移: {offset}")
+                if offset:
+                    print(f"从断点续传: 已跳过 {offset}/{file_size} 字节")
             
             # 发送文件内容
-            sent_size = 0
+            checkpoint = self._make_progress_checkpoint(file_name, file_size, offset)
             with open(file_path, 'rb') as f:
-                while sent_size < file_size:
-                    chunk = f.read(CHUNK_SIZE)
-                    if not chunk:
-                        break
-                    
-                    # 检查中断信号
-                    if self.transfer_callback and hasattr(self.transfer_callback, 'interrupted') and self.transfer_callback.interrupted:
-                        print(f"\n传输被用户中断: {file_name}")
-                        raise InterruptedError("传输被用户中断")
-                    
-                    sock.sendall(chunk)
-                    sent_size += len(chunk)
-                    
-                    # 计算进度
-                    progress = (sent_size / file_size) * 100
-                    print(f"\r发送进度: {progress:.1f}% ({sent_size}/{file_size})", end='', flush=True)
-                    
-                    # 调用回调函数更新UI
-                    if self.transfer_callback:
-                        self.transfer_callback(sent_size, file_size)
+                # 摘要线程与发送并行，续传时也计算整个文件的摘要，接收方据此校验断点之前的数据
+                hasher = ChunkHasher(f.fileno(), algorithm, 0, file_size).start_hashing() if algorithm else None
+                try:
+                    if codec:
+                        sender = CompressedSender(codec)
+                        sender.send(sock, f, offset, file_size - offset, checkpoint, PROGRESS_GRANULARITY, throttle)
+                        print(f"\n压缩传输({codec}): 原始 {sender.raw_bytes} 字节, 实际发送 {sender.compressed_bytes} 字节")
+                    else:
+                        self._send_file_content(sock, f, file_name, offset, file_size - offset, checkpoint,
+                                                throttle)
             
-            print(f"\n文件发送完成: {file_name}")
+                    print(f"\n文件发送完成: {file_name}")
             
-            # 等待确认
-            try:
-                sock.settimeout(10)  # 设置10秒超时等待确认
-                response = sock.recv(1024)
-                if response == b"OK":
-                    print("接收方确认收到文件")
-                else:
-                    print(f"接收方返回未知响应: {response.decode('utf-8', errors='ignore')}")
-            except socket.timeout:
-                print("等待接收方确认超时")
-                raise TimeoutError("等待接收方确认超时")
-            except socket.error as se:
-                print(f"接收确认消息时发生网络错误: {se}")
-                raise
+                    # 等待确认
+                    if hasher is not None:
+                        sock.settimeout(STRIPE_FINALIZE_TIMEOUT)
+                        ack = send_verification(sock, hasher, self._make_resend(sock, f, file_name, throttle),
+                                                binary)
+                        self._check_digest_ack(ack, hasher.root(), file_name)
+                        print(f"接收方确认收到文件，摘要一致: {hasher.root().hex()[:16]}")
+                    elif not self._wait_for_ack(sock):
+                        raise ConnectionError(f"接收方未确认收到完整文件: {file_name}")
+                finally:
+                    if hasher is not None:
+                        hasher.close()
                 
         except InterruptedError:
             print("传输被中断")
@@ -230,4 +837,386 @@ class FileSender:
             print(f"发送文件时出错: {e}")
             raise
         finally:
-            sock.close()
\ No newline at end of file
+            if sock:
+                sock.close()
+            
+    def _send_striped(self, file_path, target_ip, target_port, streams, throttle=None):
+        """把文件按字节区间拆分，通过多个并发连接发送"""
+        file_size = os.path.getsize(file_path)
+        file_name = os.path.basename(file_path)
+        
+        print(f"开始分段发送文件: {file_name} 到 {target_ip}:{target_port}, 大小: {file_size} bytes, 请求连接数: {streams}")
+        
+        file_info = {
+            'mode': 'striped',
+            'name': file_name,
+            'size': file_size,
+            'streams': streams
+        }
+        if INTEGRITY_ENABLED and available_algorithms():
+            file_info['integrity'] = available_algorithms()
+            file_info['block_size'] = INTEGRITY_CHUNK_SIZE
+            
+        first_sock = create_tcp_client_socket()
+        try:
+            first_sock.connect((target_ip, target_port))
+            binary = self._send_header(first_sock, target_ip, file_info)
+            reply = self._recv_reply(first_sock, target_ip)
+            if not reply:
+                raise ConnectionError("接收方未响应分段传输协商")
+        except Exception:
+            first_sock.close()
+            raise
+            
+        transfer_id = reply['transfer_id']
+        ranges = self._split_ranges(file_size, reply['streams'])
+        algorithm = reply.get('integrity')
+        binary = binary or negotiated(reply)
+        print(f"接收方接受连接数: {len(ranges)}")
+        
+        # 工作线程只负责发送，进度回调和中断检查在调用线程中进行，避免跨线程操作界面
+        sent_counts = [0] * len(ranges)
+        errors = []
+        stop_event = threading.Event()
+        # 每个分段单独校验：分段的根摘要和接收方的最终确认
+        range_roots = [None] * len(ranges)
+        acks = [None] * len(ranges)
+        
+        def worker(index, offset, length):
+            sock = first_sock if index == 0 else None
+            try:
+                range_info = {'range_index': index, 'offset': offset, 'length': length}
+                if sock is None:
+                    sock = create_tcp_client_socket()
+                    sock.connect((target_ip, target_port))
+                    range_info.update({'mode': 'range', 'transfer_id': transfer_id})
+                send_json_message(sock, range_info, self._use_binary(target_ip))
+                
+                def checkpoint(sent):
+                    sent_counts[index] = sent
+                    if stop_event.is_set():
+                        raise InterruptedError("传输被中断")
+                        
+                with open(file_path, 'rb') as f:
+                    if not algorithm:
+                        self._send_file_content(sock, f, file_name, offset, length, checkpoint, throttle)
+                        if not self._wait_for_ack(sock, timeout=STRIPE_FINALIZE_TIMEOUT):
+                            raise ConnectionError("接收方未能完成分段文件")
+                        return
+                    hasher = ChunkHasher(f.fileno(), algorithm, offset, length).start_hashing()
+                    try:
+                        self._send_file_content(sock, f, file_name, offset, length, checkpoint, throttle)
+                        sock.settimeout(STRIPE_FINALIZE_TIMEOUT)
+                        acks[index] = send_verification(sock, hasher,
+                                                        self._make_resend(sock, f, file_name, throttle), binary)
+                        range_roots[index] = hasher.root()
+                    finally:
+                        hasher.close()
+            except Exception as e:
+                errors.append(e)
+                stop_event.set()
+            finally:
+                if sock:
+                    sock.close()
+                    
+        threads = [threading.Thread(target=worker, args=(i, offset, length), daemon=True)
+                   for i, (offset, length) in enumerate(ranges)]
+        for thread in threads:
+            thread.start()
+            
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.2)
+                    self._check_interrupted(file_name)
+                    self._report_progress(sum(sent_counts), file_size)
+        except InterruptedError:
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+            raise
+            
+        if errors:
+            print(f"\n分段发送失败: {errors[0]}")
+            raise errors[0]
+            
+        if algorithm:
+            # 接收方在所有分段校验通过后才确认，每条连接的确认都携带整个文件的根摘要
+            root = merkle_root(algorithm, range_roots)
+            for ack in acks:
+                self._check_digest_ack(ack, root, file_name)
+            print(f"接收方确认收到文件，摘要一致: {root.hex()[:16]}")
+            
+        self._report_progress(file_size, file_size)
+        print(f"\n文件发送完成: {file_name}")
+        
+    def _send_delta(self, file_path, target_ip, target_port, throttle=None):
+        """增量发送：根据接收方同名文件的块签名，只发送原样数据和块引用"""
+        file_size = os.path.getsize(file_path)
+        file_name = os.path.basename(file_path)
+        
+        print(f"开始增量发送文件: {file_name} 到 {target_ip}:{target_port}, 大小: {file_size} bytes")
+        
+        sock = create_tcp_client_socket()
+        try:
+            sock.connect((target_ip, target_port))
+            self._send_header(sock, target_ip, {'mode': 'delta', 'name': file_name, 'size': file_size})
+            reply = self._recv_reply(sock, target_ip)
+            if not reply:
+                raise ConnectionError("接收方未响应增量传输协商")
+            block_size = reply['block_size']
+            signature = recv_exact(sock, reply['blocks'] * SIGNATURE_ENTRY.size)
+            if signature is None:
+                raise ConnectionError("接收块签名时连接中断")
+                
+            checkpoint = self._make_progress_checkpoint(file_name, file_size)
+            literal_bytes = 0
+            metrics = transfer_metrics('send', sock)
+            with open(file_path, 'rb') as f:
+                reader = HashingReader(f)
+                if block_size:
+                    ops = generate_delta(reader, block_size, signature)
+                else:
+                    # 接收方没有同名文件，全部作为原样数据发送
+                    ops = literal_ops(reader)
+                    
+                # 小的操作头先合并到缓冲区，减少系统调用
+                pending = bytearray()
+                next_report = PROGRESS_GRANULARITY
+                checkpoint(0)
+                for op in ops:
+                    header, data = encode_op(op)
+                    pending += header
+                    if data:
+                        literal_bytes += len(data)
+                        sock.sendall(pending)
+                        pending.clear()
+                        sock.sendall(data)
+                        metrics.bytes.inc(len(data))
+                        if throttle is not None:
+                            throttle.consume(len(data))
+                    elif len(pending) >= 64 * 1024:
+                        sock.sendall(pending)
+                        pending.clear()
+                    if reader.consumed >= next_report:
+                        checkpoint(reader.consumed)
+                        next_report = reader.consumed + PROGRESS_GRANULARITY
+                        
+                pending += OP_END + END_OP.pack(reader.consumed, reader.digest.digest())
+                sock.sendall(pending)
+                checkpoint(reader.consumed)
+                
+            print(f"\n增量发送完成: {file_name}, 发送原样数据 {literal_bytes} 字节, 复用 {file_size - literal_bytes} 字节")
+            
+            if not self._wait_for_ack(sock, timeout=STRIPE_FINALIZE_TIMEOUT):
+                raise ConnectionError(f"接收方未能重建文件: {file_name}")
+        finally:
+            sock.close()
+        
+    def _use_binary(self, target_ip):
+        """对端已确认或在发现应答中声明支持二进制帧时返回 True"""
+        if WIRE_FORMAT != 'binary':
+            return False
+        if target_ip in self.wire_peers:
+            return True
+        peer = self.peer_table.get_peer(target_ip) if self.peer_table is not None else None
+        return bool(peer) and WIRE_CAPABILITY in (peer.get('capabilities') or ())
+        
+    def _send_header(self, sock, target_ip, message):
+        """发送传输头，返回是否使用了二进制帧
+        
+        不确定对端是否支持时以JSON发送并附带 'wire' 字段，支持的接收方在回复中带上版本号，
+        之后发往该对端的消息都使用二进制帧；旧版本的接收方忽略该字段
+        """
+        binary = self._use_binary(target_ip)
+        if not binary and WIRE_FORMAT == 'binary':
+            message = dict(message, wire=WIRE_VERSION)
+        send_json_message(sock, message, binary)
+        return binary
+        
+    def _recv_reply(self, sock, target_ip):
+        """接收传输协商的回复；回复为二进制帧或带有 'wire' 字段时，记住该对端支持二进制帧"""
+        reply = recv_json_message(sock)
+        if reply and (getattr(reply, 'binary', False) or reply.get('wire')):
+            self.wire_peers.add(target_ip)
+        return reply
+            
+    def _is_legacy_peer(self, target_ip):
+        """对端的发现应答中没有续传能力时返回 True：这样的旧版本接收方不回复传输协商，只能从头发送原始数据
+        
+        只根据发现应答中明确声明的能力判断，回复慢不代表对端是旧版本；
+        没有发现信息的对端（如手动添加的地址）和已确认支持二进制帧的对端按支持协商处理
+        """
+        if target_ip in self.wire_peers:
+            return False
+        peer = self.peer_table.get_peer(target_ip) if self.peer_table is not None else None
+        if not peer or (peer['manual'] and not peer['capabilities']):
+            return False
+        return 'resume' not in peer['capabilities']
+        
+    def _split_ranges(self, file_size, streams):
+        """把文件拆分为按 CHUNK_SIZE 对齐的连续区间 [(offset, length), ...]"""
+        chunks = (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE
+        streams = max(1, min(streams, chunks))
+        ranges = []
+        offset = 0
+        for i in range(streams):
+            chunk_count = chunks // streams + (1 if i < chunks % streams else 0)
+            length = min(chunk_count * CHUNK_SIZE, file_size - offset)
+            ranges.append((offset, length))
+            offset += length
+        return ranges
+        
+    def _wait_for_ack(self, sock, timeout=10):
+        """等待接收方确认，收到 OK 时返回 True"""
+        try:
+            sock.settimeout(timeout)  # 设置超时等待确认
+            response = sock.recv(1024)
+            if response == b"OK":
+                print("接收方确认收到文件")
+                return True
+            print(f"接收方返回未知响应: {response.decode('utf-8', errors='ignore')}")
+            return False
+        except socket.timeout:
+            print("等待接收方确认超时")
+            raise TimeoutError("等待接收方确认超时")
+        except socket.error as se:
+            print(f"接收确认消息时发生网络错误: {se}")
+            raise
+            
+    def _make_resend(self, sock, f, file_name, throttle=None):
+        """构造完整性校验时重发数据块使用的函数"""
+        def resend(offset, length):
+            self._send_file_content(sock, f, file_name, offset, length, lambda sent: None, throttle)
+        return resend
+        
+    def _check_digest_ack(self, ack, digest, file_name):
+        """检查携带摘要的最终确认：接收方校验通过且根摘要与本方一致"""
+        if not ack.get('ok'):
+            raise ConnectionError(f"接收方校验文件失败: {file_name}")
+        if ack.get('digest') != digest.hex():
+            raise ConnectionError(f"接收方文件摘要不一致: {file_name}")
+        
+    def _make_progress_checkpoint(self, file_name, file_size, offset=0):
+        """构造单连接发送使用的检查点：检查中断并报告进度"""
+        def checkpoint(sent):
+            self._check_interrupted(file_name)
+            if sent:
+                self._report_progress(offset + sent, file_size)
+        return checkpoint
+        
+    def _send_file_content(self, sock, f, file_name, offset, count, checkpoint, throttle=None):
+        """发送文件区间 [offset, offset+count)，优先零拷贝，不可用时回退到缓冲循环
+        
+        每发送 PROGRESS_GRANULARITY 字节调用一次 checkpoint(已发送字节数)，
+        checkpoint 可以抛出异常来终止发送；throttle 不为空时按其限速发送
+        """
+        chunk_size = tune_connection(sock, count, 'send')
+        start_time = time.perf_counter()
+        sent_size = None
+        if USE_SENDFILE and hasattr(os, 'sendfile'):
+            try:
+                sent_size = self._send_zero_copy(sock, f, file_name, offset, count, checkpoint, throttle)
+            except _SendfileUnavailable as e:
+                print(f"零拷贝发送不可用，回退到缓冲发送: {e}")
+        if sent_size is None:
+            sent_size = self._send_buffered(sock, f, file_name, offset, count, checkpoint, throttle, chunk_size)
+        # 限速的传输测得的不是链路吞吐量，不记录
+        if throttle is None or throttle.slice is None:
+            record_transfer(sock, sent_size, time.perf_counter() - start_time)
+        return sent_size
+        
+    def _send_zero_copy(self, sock, f, file_name, offset, count, checkpoint, throttle=None):
+        """使用 os.sendfile 直接由内核把文件数据写入套接字"""
+        try:
+            in_fd = f.fileno()
+            out_fd = sock.fileno()
+        except (AttributeError, OSError) as e:
+            raise _SendfileUnavailable(e)
+            
+        sent_size = 0
+        metrics = transfer_metrics('send', sock)
+        sendfile_calls = metrics.io_calls('sendfile')
+        checkpoint(0)
+        while sent_size < count:
+            # 每次最多发送一个进度粒度，之后回调进度并检查中断
+            block_end = min(sent_size + PROGRESS_GRANULARITY, count)
+            while sent_size < block_end:
+                # 限速时每次只发送一小段，令牌按实际发送的字节数记账
+                step = throttle.slice if throttle is not None else None
+                chunk_start = time.perf_counter()
+                try:
+                    sendfile_calls.inc()
+                    sent = os.sendfile(out_fd, in_fd, offset + sent_size, min(block_end - sent_size, step or count))
+                except BlockingIOError:
+                    # 套接字设置了超时时处于非阻塞模式，等待可写
+                    select.select([], [sock], [], sock.gettimeout())
+                    continue
+                except OSError as e:
+                    if sent_size == 0 and e.errno in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                                                      errno.EOPNOTSUPP, errno.EBADF):
+                        raise _SendfileUnavailable(e)
+                    raise
+                if sent == 0:
+                    # 文件在发送过程中被截断
+                    raise IOError(f"文件读取提前结束: {file_name}, 已发送 {sent_size}/{count} 字节")
+                sent_size += sent
+                metrics.bytes.inc(sent)
+                metrics.chunk_seconds.observe(time.perf_counter() - chunk_start)
+                if throttle is not None:
+                    throttle.consume(sent)
+                
+            checkpoint(sent_size)
+            
+        return sent_size
+        
+    def _send_buffered(self, sock, f, file_name, offset, count, checkpoint, throttle=None, chunk_size=CHUNK_SIZE):
+        """逐块读取文件并通过 sendall 发送，每块 chunk_size 字节"""
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        f.seek(offset)
+        sent_size = 0
+        next_report = PROGRESS_GRANULARITY
+        metrics = transfer_metrics('send', sock)
+        read_calls = metrics.io_calls('read')
+        send_calls = metrics.io_calls('send')
+        checkpoint(0)
+        while sent_size < count:
+            chunk_start = time.perf_counter()
+            step = throttle.slice if throttle is not None else None
+            read_size = f.readinto(view[:min(chunk_size, count - sent_size, step or chunk_size)])
+            read_calls.inc()
+            if not read_size:
+                break
+                
+            sock.sendall(view[:read_size])
+            send_calls.inc()
+            sent_size += read_size
+            metrics.bytes.inc(read_size)
+            metrics.chunk_seconds.observe(time.perf_counter() - chunk_start)
+            if throttle is not None:
+                throttle.consume(read_size)
+            
+            if sent_size >= next_report or sent_size >= count:
+                checkpoint(sent_size)
+                next_report = sent_size + PROGRESS_GRANULARITY
+                
+        return sent_size
+        
+    def _check_interrupted(self, file_name):
+        """检查中断信号，被中断时抛出 InterruptedError"""
+        callback = self.transfer_callback
+        if callback is None:
+            return
+        # 回调通常是 ProgressTracker.update_progress 这样的绑定方法，中断标志在其所属对象上
+        owner = getattr(callback, '__self__', callback)
+        if getattr(owner, 'interrupted', False):
+            print(f"\n传输被用户中断: {file_name}")
+            raise InterruptedError("传输被用户中断")
+            
+    def _report_progress(self, sent_size, file_size):
+        """输出发送进度（限制输出频率）并调用回调函数更新UI"""
+        self.progress_printer.update(sent_size, file_size)
+        
+        if self.transfer_callback:
+            self.transfer_callback(sent_size, file_size)
\ No newline at end of file
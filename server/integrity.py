@@ -0,0 +1,227 @@
+# server/integrity.py
+import os
+import sys
+import hashlib
+import threading
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import INTEGRITY_ALGORITHMS, INTEGRITY_CHUNK_SIZE, INTEGRITY_MAX_ROUNDS
+from utils.network_utils import send_json_message, recv_json_message, recv_exact
+
+# 文件按发送方的 INTEGRITY_CHUNK_SIZE 切分为数据块，每块的摘要是 Merkle 树的叶子，叶子两两合并得到根摘要。
+# 分段传输的每个分段是一棵独立的子树，可以单独校验；各分段的根再合并为整个文件的根。
+# 叶子和内部节点使用不同的前缀，避免把内部节点当作数据块
+LEAF_PREFIX = b'\0'
+NODE_PREFIX = b'\1'
+
+# 接收方接受的发送方数据块大小范围，过小的数据块会让摘要列表过大
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+# 可用的摘要算法 {'名称': 构造函数}
+ALGORITHMS = {
+    'blake2b': lambda: hashlib.blake2b(digest_size=32),
+    'sha256': hashlib.sha256,
+}
+
+# 可选的第三方摘要算法，安装了才启用（非加密哈希，只用于发现传输损坏）
+try:
+    import xxhash
+    ALGORITHMS['xxh3'] = xxhash.xxh3_128
+except ImportError:
+    pass
+
+
+def available_algorithms():
+    """按配置的优先级返回本机可用的摘要算法"""
+    return [name for name in INTEGRITY_ALGORITHMS if name in ALGORITHMS]
+
+
+def negotiate_algorithm(offered):
+    """接收方从发送方提供的列表中选择第一个本机支持的摘要算法"""
+    for name in offered or []:
+        if name in ALGORITHMS:
+            return name
+    return None
+
+
+def negotiate_integrity(request):
+    """接收方：选择摘要算法并采用发送方的数据块大小，返回 (算法, 数据块大小)，不做校验时算法为 None
+    
+    双方配置的 INTEGRITY_CHUNK_SIZE 可能不同，数据块划分必须一致才能逐块对比摘要；
+    旧版本的发送方不在传输头中给出 'block_size'，使用本机的配置；数据块大小无效时不做完整性校验
+    """
+    algorithm = negotiate_algorithm(request.get('integrity'))
+    chunk_size = request.get('block_size', INTEGRITY_CHUNK_SIZE)
+    if algorithm and (type(chunk_size) is not int or not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE):
+        print(f"发送方的数据块大小无效，不做完整性校验: {chunk_size!r}")
+        return None, INTEGRITY_CHUNK_SIZE
+    return algorithm, chunk_size
+
+
+def leaf_digest(algorithm, data):
+    """数据块的摘要"""
+    digest = ALGORITHMS[algorithm]()
+    digest.update(LEAF_PREFIX)
+    digest.update(data)
+    return digest.digest()
+
+
+def merkle_root(algorithm, digests):
+    """由叶子（或子树根）摘要列表计算根摘要，某一层为奇数个节点时最后一个直接升到上一层"""
+    if not digests:
+        return leaf_digest(algorithm, b'')
+    level = list(digests)
+    while len(level) > 1:
+        parents = []
+        for i in range(0, len(level) - 1, 2):
+            digest = ALGORITHMS[algorithm]()
+            digest.update(NODE_PREFIX)
+            digest.update(level[i])
+            digest.update(level[i + 1])
+            parents.append(digest.digest())
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+
+class ChunkHasher:
+    """在后台线程中计算文件区间 [start, start+length) 每个数据块的摘要，与网络I/O重叠
+    
+    接收方每写出一批数据调用 advance(已写入的文件末尾偏移)，线程从文件读回已经完整的数据块计算摘要，
+    校验的是实际写入文件的内容；发送方对源文件使用时数据已经全部就绪。
+    """
+    
+    def __init__(self, fd, algorithm, start, length, available=None, chunk_size=None):
+        self.fd = fd
+        self.algorithm = algorithm
+        self.start = start
+        self.length = length
+        self.chunk_size = chunk_size or INTEGRITY_CHUNK_SIZE
+        self.count = max(1, (length + self.chunk_size - 1) // self.chunk_size)
+        self.digests = []
+        self.available = start + length if available is None else available
+        self.closed = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        
+    def start_hashing(self):
+        """启动摘要线程，返回自身"""
+        self.thread.start()
+        return self
+        
+    def advance(self, end):
+        """数据已写入到文件偏移 end"""
+        with self.condition:
+            if end > self.available:
+                self.available = end
+                self.condition.notify()
+        
+    def finish(self):
+        """所有数据已经就绪，等待摘要线程算完并返回每个数据块的摘要"""
+        self.advance(self.start + self.length)
+        self.thread.join()
+        if self.error:
+            raise self.error
+        return self.digests
+        
+    def close(self):
+        """放弃计算，结束摘要线程"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread.is_alive():
+            self.thread.join()
+        
+    def chunk_range(self, index):
+        """数据块在文件中的 (偏移, 长度)"""
+        if not 0 <= index < self.count:
+            raise ValueError(f"无效的数据块序号: {index}")
+        offset = self.start + index * self.chunk_size
+        return offset, min(self.chunk_size, self.start + self.length - offset)
+        
+    def rehash(self, indices):
+        """重新计算指定数据块的摘要（重收损坏的块之后调用）"""
+        for index in indices:
+            self.digests[index] = self._hash_chunk(index)
+        
+    def root(self):
+        """本区间的根摘要"""
+        return merkle_root(self.algorithm, self.digests)
+        
+    def _run(self):
+        """摘要线程：等待每个数据块写完整后读回计算摘要"""
+        try:
+            for index in range(self.count):
+                offset, length = self.chunk_range(index)
+                with self.condition:
+                    self.condition.wait_for(lambda: self.closed or self.available >= offset + length)
+                    if self.closed:
+                        return
+                self.digests.append(self._hash_chunk(index))
+        except Exception as e:
+            self.error = e
+        
+    def _hash_chunk(self, index):
+        """读回一个数据块并计算摘要"""
+        offset, length = self.chunk_range(index)
+        data = os.pread(self.fd, length, offset)
+        if len(data) < length:
+            raise IOError(f"读取数据块失败: 偏移 {offset}, 读到 {len(data)}/{length} 字节")
+        return leaf_digest(self.algorithm, data)
+
+
+def send_verification(sock, hasher, send_range, binary=False):
+    """发送方：数据发送完后发送各数据块的摘要，按接收方的要求重发不一致的块
+    
+    send_range(偏移, 长度) 重新发送文件区间的数据；返回接收方的最终确认 {'ok', 'digest'}
+    """
+    digests = hasher.finish()
+    send_json_message(sock, {'block_size': hasher.chunk_size, 'blocks': len(digests)}, binary)
+    sock.sendall(b''.join(digests))
+    while True:
+        reply = recv_json_message(sock)
+        if not reply:
+            raise ConnectionError("接收方未响应完整性校验")
+        retry = reply.get('retry')
+        if not retry:
+            return reply
+        print(f"\n接收方校验发现 {len(retry)} 个数据块不一致，重新发送")
+        for index in retry:
+            send_range(*hasher.chunk_range(index))
+
+
+def receive_verification(conn, hasher, receive_range, binary=False):
+    """接收方：对比发送方的数据块摘要，请求重发不一致的块，返回 (是否一致, 本方根摘要)
+    
+    receive_range(偏移, 长度) 重新接收文件区间的数据并返回接收的字节数；
+    最终确认由调用方发送，分段传输要等所有分段完成后才能给出整个文件的摘要
+    """
+    digests = hasher.finish()
+    header = recv_json_message(conn)
+    if not header:
+        raise ConnectionError("发送方未发送数据块摘要")
+    if header.get('block_size') != hasher.chunk_size or header.get('blocks') != len(digests):
+        raise ValueError(f"数据块摘要不匹配: {header.get('block_size')}x{header.get('blocks')}")
+    size = len(digests[0])
+    data = recv_exact(conn, size * len(digests))
+    if data is None:
+        raise ConnectionError("接收数据块摘要时连接中断")
+    expected = [data[i:i + size] for i in range(0, len(data), size)]
+    
+    for round_index in range(INTEGRITY_MAX_ROUNDS + 1):
+        bad = [index for index, digest in enumerate(hasher.digests) if digest != expected[index]]
+        if not bad or round_index == INTEGRITY_MAX_ROUNDS:
+            break
+        print(f"\n{len(bad)} 个数据块校验不一致，请求重发")
+        send_json_message(conn, {'retry': bad}, binary)
+        for index in bad:
+            offset, length = hasher.chunk_range(index)
+            if receive_range(offset, length) < length:
+                raise ConnectionError("重收数据块时连接中断")
+        hasher.rehash(bad)
+    return not bad, hasher.root()
\ No newline at end of file
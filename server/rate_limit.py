@@ -0,0 +1,185 @@
+# server/rate_limit.py
+import os
+import sys
+import time
+import threading
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import PROGRESS_GRANULARITY, RATE_LIMIT_BURST, RATE_LIMIT_SLICE, RATE_LIMIT_MIN_SLEEP
+
+# 限速时单次发送/接收的最小数据量，速率很低时也不把系统调用切得过碎
+MIN_SLICE = 16 * 1024
+# 时间表最多每隔多少秒重新检查一次
+SCHEDULE_CHECK_INTERVAL = 1.0
+
+
+def parse_schedule(schedule):
+    """把 [('09:00', '18:00', 速率), ...] 解析为 [(开始分钟, 结束分钟, 速率), ...]"""
+    entries = []
+    for start, end, rate in schedule or []:
+        entries.append((_parse_minutes(start), _parse_minutes(end), rate))
+    return entries
+
+
+def _parse_minutes(text):
+    """'HH:MM' 转换为当天的分钟数"""
+    hours, _, minutes = text.partition(':')
+    value = int(hours) * 60 + int(minutes or 0)
+    if not 0 <= value <= 24 * 60:
+        raise ValueError(f"无效的时间: {text}")
+    return value
+
+
+def scheduled_rate(entries, minutes):
+    """返回当天第 minutes 分钟命中的第一个时段的速率，没有命中时返回 None；结束早于开始的时段跨越零点"""
+    for start, end, rate in entries:
+        if start <= end:
+            if start <= minutes < end:
+                return rate
+        elif minutes >= start or minutes < end:
+            return rate
+    return None
+
+
+class TokenBucket:
+    """令牌桶：速率为每秒字节数，0 表示不限速；速率可以在运行时修改
+    
+    取用令牌时不等待，允许令牌为负（欠额），返回还清欠额需要的时间，由调用方决定何时休眠。
+    这样大块数据一次记账，休眠时间按实际经过的时间补充令牌，睡过头的部分不会丢失。
+    """
+    
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+        
+    def set_rate(self, rate):
+        """修改速率，容量为 RATE_LIMIT_BURST 秒的数据量"""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = max(0, rate or 0)
+            self.burst = max(MIN_SLICE, self.rate * RATE_LIMIT_BURST)
+            self.tokens = min(self.tokens, self.burst)
+        
+    def reserve(self, size):
+        """取用 size 字节的令牌，返回需要等待的秒数（不限速时为0）"""
+        with self.lock:
+            if not self.rate:
+                return 0.0
+            self._refill(time.monotonic())
+            self.tokens -= size
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+        
+    def _refill(self, now):
+        """按经过的时间补充令牌，最多补满容量"""
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class Throttle:
+    """一次传输使用的限速器：同时受传输、对端和全局三个令牌桶约束，取其中最长的等待时间
+    
+    同一个传输的多个连接（分段传输）共用一个 Throttle，多个线程可以同时调用。
+    """
+    
+    def __init__(self, limiter, buckets):
+        self.limiter = limiter
+        self.buckets = buckets
+        
+    def set_rate(self, rate):
+        """修改本次传输的限速"""
+        self.buckets[0].set_rate(rate)
+        
+    @property
+    def slice(self):
+        """限速时每次发送/接收的数据量（约 RATE_LIMIT_SLICE 秒），不限速时为 None"""
+        self.limiter.check_schedule()
+        rates = [bucket.rate for bucket in self.buckets if bucket.rate]
+        if not rates:
+            return None
+        return int(max(MIN_SLICE, min(PROGRESS_GRANULARITY, min(rates) * RATE_LIMIT_SLICE)))
+        
+    def reserve(self, size):
+        """记账 size 字节，返回需要等待的秒数，供不能阻塞的调用方（asyncio）使用"""
+        self.limiter.check_schedule()
+        return max(bucket.reserve(size) for bucket in self.buckets)
+        
+    def consume(self, size):
+        """记账 size 字节，欠额超过 RATE_LIMIT_MIN_SLEEP 时休眠；更小的欠额留到下一次一起等待"""
+        delay = self.reserve(size)
+        if delay > RATE_LIMIT_MIN_SLEEP:
+            time.sleep(delay)
+
+
+class RateLimiter:
+    """一个方向（发送或接收）的限速设置：全局限速、每个对端的限速和按时段的全局限速
+    
+    所有限速都可以在运行时修改，已经开始的传输立即按新的速率执行。
+    """
+    
+    def __init__(self, global_rate=0, peer_rates=None, schedule=None):
+        self.lock = threading.Lock()
+        self.global_rate = global_rate
+        self.global_bucket = TokenBucket(global_rate)
+        self.peer_buckets = {}
+        self.schedule = parse_schedule(schedule)
+        self.next_schedule_check = 0.0
+        for ip, rate in (peer_rates or {}).items():
+            self.set_peer_limit(ip, rate)
+        self.check_schedule(force=True)
+        
+    def set_global_limit(self, rate):
+        """修改全局限速（不在时间表时段内时生效）"""
+        with self.lock:
+            self.global_rate = rate
+        self.check_schedule(force=True)
+        
+    def set_peer_limit(self, ip, rate):
+        """修改发往/来自某个对端的限速，0 表示不限速"""
+        with self.lock:
+            bucket = self.peer_buckets.get(ip)
+            if bucket is None:
+                bucket = self.peer_buckets[ip] = TokenBucket()
+        bucket.set_rate(rate)
+        
+    def set_schedule(self, schedule):
+        """修改时间表 [('09:00', '18:00', 速率), ...]，命中的时段覆盖全局限速"""
+        entries = parse_schedule(schedule)
+        with self.lock:
+            self.schedule = entries
+        self.check_schedule(force=True)
+        
+    def limits(self):
+        """当前生效的限速 {'global': 速率, 'peers': {ip: 速率}}"""
+        with self.lock:
+            peers = {ip: bucket.rate for ip, bucket in self.peer_buckets.items() if bucket.rate}
+        return {'global': self.global_bucket.rate, 'peers': peers}
+        
+    def throttle(self, ip, rate=0):
+        """为一次传输创建限速器，rate 为本次传输的限速"""
+        with self.lock:
+            peer_bucket = self.peer_buckets.get(ip)
+            if peer_bucket is None:
+                # 先建一个不限速的桶，之后修改该对端的限速时正在进行的传输也能生效
+                peer_bucket = self.peer_buckets[ip] = TokenBucket()
+        return Throttle(self, [TokenBucket(rate), peer_bucket, self.global_bucket])
+        
+    def check_schedule(self, force=False):
+        """按当前时间更新全局令牌桶的速率，最多每 SCHEDULE_CHECK_INTERVAL 秒检查一次"""
+        now = time.monotonic()
+        if not force and (not self.schedule or now < self.next_schedule_check):
+            return
+        with self.lock:
+            self.next_schedule_check = now + SCHEDULE_CHECK_INTERVAL
+            local = time.localtime()
+            rate = scheduled_rate(self.schedule, local.tm_hour * 60 + local.tm_min)
+            if rate is None:
+                rate = self.global_rate
+        if rate != self.global_bucket.rate:
+            self.global_bucket.set_rate(rate)
\ No newline at end of file
@@ -0,0 +1,209 @@
+# server/resume.py
+import os
+import sys
+import json
+import uuid
+import hashlib
+import threading
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import RESUME_VERIFY_SIZE, DURABLE_COMMIT, COMMIT_FSYNC_WORKERS
+from utils.io_utils import sync_directory, fsync_all
+
+# 正在被某个连接写入的 .part 文件，防止同名同内容的并发传输互相覆盖
+_active_parts = set()
+_active_lock = threading.Lock()
+
+
+class SaveNameIndex:
+    """最终文件名的内存索引：并发接收同名文件时分配互不冲突的路径
+    
+    reserve() 返回的路径在 release() 之前不会再分配出去，已存在的文件通过 os.path.exists 排除；
+    每个名称记住下一个数字后缀，重复的文件名不用每次从 _1 开始探测
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reserved = set()
+        self.next_suffix = {}
+        
+    def reserve(self, path):
+        """返回 path 或添加了数字后缀的可用路径，并占用该路径"""
+        base_name, ext = os.path.splitext(path)
+        with self.lock:
+            candidate = path
+            if candidate in self.reserved or os.path.exists(candidate):
+                counter = self.next_suffix.get(path, 1)
+                candidate = f"{base_name}_{counter}{ext}"
+                while candidate in self.reserved or os.path.exists(candidate):
+                    counter += 1
+                    candidate = f"{base_name}_{counter}{ext}"
+                self.next_suffix[path] = counter + 1
+            self.reserved.add(candidate)
+        return candidate
+        
+    def release(self, path):
+        """文件已经重命名到位（或放弃使用该路径），不再占用"""
+        with self.lock:
+            self.reserved.discard(path)
+
+
+# 进程内共用的最终文件名索引
+save_names = SaveNameIndex()
+
+
+def sync_partials(partials):
+    """并发 fsync 一批已写完的 .part 文件，之后它们的 commit() 不再逐个 fsync"""
+    if not DURABLE_COMMIT:
+        return
+    fsync_all([partial.fd for partial in partials], COMMIT_FSYNC_WORKERS)
+    for partial in partials:
+        partial.synced = True
+
+
+def compute_fingerprint(file_path):
+    """计算文件指纹：大小、修改时间以及首尾各 1MB 内容的 BLAKE2 摘要"""
+    stat = os.stat(file_path)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8'))
+    with open(file_path, 'rb') as f:
+        digest.update(f.read(RESUME_VERIFY_SIZE))
+        if stat.st_size > RESUME_VERIFY_SIZE:
+            f.seek(max(RESUME_VERIFY_SIZE, stat.st_size - RESUME_VERIFY_SIZE))
+            digest.update(f.read(RESUME_VERIFY_SIZE))
+    return digest.hexdigest()
+
+
+class PartialFile:
+    """接收中的隐藏 .part 文件，旁边的 .part.json 日志记录已校验的偏移和内容指纹
+    
+    文件名以点开头，下载目录的读者和同步工具看不到写了一半的文件；完成后 commit() 重命名为最终文件
+    """
+    
+    def __init__(self, directory, file_name, file_size, fingerprint=None):
+        self.file_name = os.path.basename(file_name)
+        self.file_size = file_size
+        self.fingerprint = fingerprint
+        self.fd = None
+        self.offset = 0
+        self.synced = False
+        
+        if fingerprint:
+            part_name = f".{self.file_name}.{fingerprint[:16]}.part"
+            with _active_lock:
+                if os.path.join(directory, part_name) in _active_parts:
+                    # 相同内容正在被另一个连接接收，本次不参与续传
+                    self.fingerprint = None
+                else:
+                    _active_parts.add(os.path.join(directory, part_name))
+        if not self.fingerprint:
+            part_name = f".{self.file_name}.{uuid.uuid4().hex[:8]}.part"
+            
+        self.part_name = part_name
+        self.part_path = os.path.join(directory, part_name)
+        self.journal_path = self.part_path + '.json'
+        
+    def open(self):
+        """打开 .part 文件，返回可以续传的偏移（不可续传时为0）"""
+        offset = self._load_verified_offset()
+        # 不可续传的文件名是随机的，用 O_EXCL 保证不会打开别人的文件；可续传的文件名已经由 _active_parts 独占
+        flags = os.O_RDWR | os.O_CREAT | (0 if self.fingerprint else os.O_EXCL)
+        self.fd = os.open(self.part_path, flags, 0o644)
+        # 丢弃断点之后未经校验的数据
+        os.ftruncate(self.fd, offset)
+        self.offset = offset
+        return offset
+        
+    def checkpoint(self, offset):
+        """把数据刷到磁盘后记录新的断点"""
+        if not self.fingerprint or self.fd is None:
+            return
+        os.fsync(self.fd)
+        journal = {
+            'name': self.file_name,
+            'size': self.file_size,
+            'fingerprint': self.fingerprint,
+            'offset': offset,
+            'tail_digest': self._tail_digest(offset)
+        }
+        temp_path = self.journal_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(journal, f)
+        os.replace(temp_path, self.journal_path)
+        self.offset = offset
+        
+    def commit(self, save_path, sync=True):
+        """传输完成：fsync 后把 .part 文件原子地重命名为最终文件并删除日志
+        
+        sync 为 False 时不 fsync 目录，由调用方在提交一批文件后统一调用 sync_directory
+        """
+        if DURABLE_COMMIT and not self.synced:
+            os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        os.replace(self.part_path, save_path)
+        self._remove(self.journal_path)
+        self._release()
+        if DURABLE_COMMIT and sync:
+            sync_directory(os.path.dirname(save_path))
+        
+    def suspend(self, offset):
+        """传输中断：保留已接收的数据供下次续传，无法续传时直接删除"""
+        try:
+            if self.fingerprint and offset > 0:
+                self.checkpoint(offset)
+                print(f"已保留断点: {self.part_name}, 偏移 {offset}/{self.file_size}")
+            else:
+                self._remove(self.part_path)
+                self._remove(self.journal_path)
+        finally:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+            self._release()
+            
+    def _load_verified_offset(self):
+        """读取日志，指纹和断点前数据都校验通过时返回断点偏移"""
+        if not self.fingerprint:
+            return 0
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            return 0
+            
+        offset = journal.get('offset', 0)
+        if (journal.get('fingerprint') != self.fingerprint or journal.get('size') != self.file_size
+                or not 0 < offset <= self.file_size):
+            return 0
+        try:
+            if os.path.getsize(self.part_path) < offset:
+                return 0
+        except OSError:
+            return 0
+        if self._tail_digest(offset) != journal.get('tail_digest'):
+            print(f"断点数据校验失败，重新开始传输: {self.file_name}")
+            return 0
+        return offset
+        
+    def _tail_digest(self, offset):
+        """计算断点之前最后 RESUME_VERIFY_SIZE 字节的摘要"""
+        start = max(0, offset - RESUME_VERIFY_SIZE)
+        with open(self.part_path, 'rb') as f:
+            f.seek(start)
+            data = f.read(offset - start)
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+        
+    def _release(self):
+        """释放对 .part 文件的占用"""
+        with _active_lock:
+            _active_parts.discard(self.part_path)
+            
+    def _remove(self, path):
+        """删除文件，文件不存在时忽略"""
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
\ No newline at end of file
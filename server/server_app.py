@@ -7,23 +7,77 @@ from datetime import datetime
 # 添加项目根目录到系统路径
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from config import SERVER_ENGINE, METRICS_HTTP_HOST, METRICS_HTTP_PORT
+from utils.metrics import registry, MetricsServer
+
 try:
     from server.file_transfer import FileReceiver
+    from server.discovery_responder import DiscoveryResponder
 except ImportError:
     from .file_transfer import FileReceiver  # 尝试相对导入
+    from .discovery_responder import DiscoveryResponder
 
 
 class ServerApp:
-    def __init__(self):
-        self.file_receiver = FileReceiver()
+    def __init__(self, host='0.0.0.0', port=50002, download_dir=None, peer_table=None):
+        self.file_receiver = FileReceiver(host, port, download_dir)
+        self.server_engine = None
+        # 应答其他设备的发现请求，并把请求方记录到 peer_table
+        self.discovery_responder = DiscoveryResponder(port, peer_table)
+        self.metrics_server = None
         self.is_running = False
         
-    def start(self):
-        """启动服务端应用"""
+    def start(self, engine=None):
+        """启动服务端应用，engine 可选 'threaded' 或 'asyncio'，默认使用 SERVER_ENGINE"""
+        engine = engine or SERVER_ENGINE
+        if engine == 'asyncio':
+            # asyncio 导入较慢，只在选用该引擎时导入，保持命令行启动速度
+            try:
+                from server.async_receiver import AsyncFileReceiver
+            except ImportError:
+                from .async_receiver import AsyncFileReceiver
+            self.server_engine = AsyncFileReceiver(self.file_receiver)
+        elif engine == 'threaded':
+            self.server_engine = self.file_receiver
+        else:
+            raise ValueError(f"未知的服务器引擎: {engine}")
         self.is_running = True
-        self.file_receiver.start_server()
+        self.server_engine.start_server()
+        try:
+            self.discovery_responder.start()
+        except OSError as e:
+            # 发现端口被占用时仍然可以接收文件，只是不会被其他设备发现
+            print(f"设备发现应答服务启动失败: {e}")
+        if METRICS_HTTP_PORT and self.metrics_server is None:
+            self.start_metrics_server(METRICS_HTTP_PORT)
+        
+    def start_metrics_server(self, port, host=METRICS_HTTP_HOST):
+        """启动指标 HTTP 接口（/metrics 为 Prometheus 文本格式，/metrics.json 为JSON快照），返回实际端口"""
+        try:
+            self.metrics_server = MetricsServer(host, port)
+        except OSError as e:
+            print(f"指标接口启动失败: {e}")
+            return None
+        self.metrics_server.start()
+        return self.metrics_server.port
+        
+    def get_metrics(self):
+        """接收方向的指标快照：字节数和速率、I/O调用次数、块延迟直方图、活动连接数等"""
+        return registry.snapshot(direction='receive')
+        
+    def set_download_limit(self, rate, peer_ip=None):
+        """修改接收限速（字节/秒，0 表示不限速），peer_ip 为空时修改全局限速，正在进行的传输立即生效"""
+        if peer_ip is None:
+            self.file_receiver.rate_limiter.set_global_limit(rate)
+        else:
+            self.file_receiver.rate_limiter.set_peer_limit(peer_ip, rate)
         
     def stop(self):
         """停止服务端应用"""
         self.is_running = False
-        self.file_receiver.stop_server()
\ No newline at end of file
+        if self.server_engine:
+            self.server_engine.stop_server()
+        self.discovery_responder.stop()
+        if self.metrics_server:
+            self.metrics_server.stop()
+            self.metrics_server = None
\ No newline at end of file
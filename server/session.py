@@ -0,0 +1,461 @@
+# server/session.py
+import os
+import sys
+import queue
+import socket
+import struct
+import threading
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import (SESSION_CONNECTIONS, SESSION_WINDOW, SESSION_MAX_WINDOW, SESSION_COALESCE_SIZE,
+                    SESSION_BATCH_BYTES, SESSION_BATCH_FILES, SESSION_ACK_TIMEOUT,
+                    DURABLE_COMMIT)
+from utils.network_utils import (create_tcp_client_socket, send_json_message, send_reply_message,
+                                 recv_json_message, recv_exact)
+from utils.wire import MSG_ACK, negotiated, encode_meta, decode_meta
+from utils.io_utils import recv_into_exact, write_buffers, sync_directory
+from utils.metrics import transfer_metrics, files_total
+
+try:
+    from server.resume import PartialFile, sync_partials
+except ImportError:
+    from .resume import PartialFile, sync_partials  # 尝试相对导入
+
+# 会话中的数据帧: 帧类型(1字节) + 元数据长度(4字节) + 元数据 + 文件数据
+# 元数据和确认在双方协商支持二进制帧时使用 utils/wire.py 的二进制编码，否则为JSON
+FRAME_HEADER = struct.Struct('>cI')
+FRAME_FILE = b'F'   # 单个文件: {'id', 'name', 'size'}
+FRAME_BATCH = b'B'  # 合并的多个小文件: {'id', 'files': [[name, size], ...]}，数据依次拼接
+FRAME_END = b'E'    # 发送方结束会话
+
+# 接收方单个批量帧允许的最大数据量，防止恶意元数据导致过量内存分配
+MAX_BATCH_BYTES = max(SESSION_BATCH_BYTES, 16 * 1024 * 1024)
+
+
+def encode_frame_header(frame_type, meta, binary=False):
+    """编码帧头和元数据"""
+    payload = encode_meta(meta, binary)
+    return FRAME_HEADER.pack(frame_type, len(payload)) + payload
+
+
+def build_frames(files):
+    """把 [(路径, 大小), ...] 分组为帧：大文件单独一帧，小文件合并为批量帧，产生 (帧类型, [(路径, 大小), ...])"""
+    batch = []
+    batch_bytes = 0
+    for path, size in files:
+        if size >= SESSION_COALESCE_SIZE:
+            yield FRAME_FILE, [(path, size)]
+            continue
+        if batch and (batch_bytes + size > SESSION_BATCH_BYTES or len(batch) >= SESSION_BATCH_FILES):
+            yield FRAME_BATCH, batch
+            batch = []
+            batch_bytes = 0
+        batch.append((path, size))
+        batch_bytes += size
+    if batch:
+        yield FRAME_BATCH, batch
+
+
+class _SessionConnection:
+    """会话中的一条持久连接：发送方流水线发送帧，后台线程读取接收方的异步确认"""
+    
+    def __init__(self, file_sender, target_ip, target_port, window):
+        self.sock = create_tcp_client_socket()
+        try:
+            self.sock.connect((target_ip, target_port))
+            binary = file_sender._send_header(self.sock, target_ip, {'mode': 'session', 'window': window})
+            reply = file_sender._recv_reply(self.sock, target_ip)
+            if not reply:
+                raise ConnectionError("接收方未响应会话协商")
+        except Exception:
+            self.sock.close()
+            raise
+        # 帧元数据是否使用二进制编码
+        self.binary = binary or negotiated(reply)
+        # 窗口限制未确认的帧数
+        self.window = threading.Semaphore(reply['window'])
+        # 等待确认的帧 {帧ID: ([文件路径, ...], 结果字典)}
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.next_id = 0
+        self.broken = False
+        self.ack_thread = threading.Thread(target=self._read_acks, daemon=True)
+        self.ack_thread.start()
+        
+    def send_frame(self, frame_type, meta, paths, results, data=()):
+        """登记等待确认的帧并发送帧头和数据，返回帧ID"""
+        with self.condition:
+            frame_id = self.next_id
+            self.next_id += 1
+            self.pending[frame_id] = (paths, results)
+        meta['id'] = frame_id
+        header = encode_frame_header(frame_type, meta, self.binary)
+        if data:
+            # 小文件数据与帧头合并为一次发送
+            self.sock.sendall(b''.join([header, *data]))
+        else:
+            self.sock.sendall(header)
+        return frame_id
+        
+    def wait_idle(self, timeout):
+        """等待所有已发送的帧被确认，超时或连接断开时返回 False"""
+        with self.condition:
+            self.condition.wait_for(lambda: not self.pending or self.broken, timeout)
+            return not self.pending
+            
+    def abort(self, timeout=SESSION_ACK_TIMEOUT):
+        """当前帧无法发送完整时结束连接：只关闭发送方向，接收方读到不完整的帧后断开，
+        之前已经发出的帧的确认仍然可以收到，只有未确认的帧记为失败
+        """
+        try:
+            self.sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        self.ack_thread.join(timeout)
+        self.close(graceful=False)
+        
+    def close(self, graceful=True):
+        """结束会话并关闭连接"""
+        if graceful and not self.broken:
+            try:
+                self.sock.sendall(encode_frame_header(FRAME_END, {}, self.binary))
+            except OSError:
+                pass
+        self._mark_broken()
+        try:
+            self.sock.shutdown(2)
+        except OSError:
+            pass
+        self.sock.close()
+        
+    def _read_acks(self):
+        """确认线程：接收方每处理完一帧返回 {'id': 帧ID, 'results': [每个文件是否成功]}"""
+        try:
+            while True:
+                ack = recv_json_message(self.sock)
+                if ack is None:
+                    break
+                with self.condition:
+                    paths, results = self.pending.pop(ack['id'])
+                    for path, ok in zip(paths, ack['results']):
+                        results[path] = ok
+                    self.condition.notify_all()
+                self.window.release()
+        except (OSError, ValueError, KeyError):
+            pass
+        finally:
+            self._mark_broken()
+            
+    def _mark_broken(self):
+        """连接不可再用：未确认的文件全部记为失败，唤醒等待窗口的发送线程"""
+        with self.condition:
+            if self.broken:
+                return
+            self.broken = True
+            for paths, results in self.pending.values():
+                for path in paths:
+                    results[path] = False
+            self.pending.clear()
+            self.condition.notify_all()
+        # 释放足够多的窗口，避免发送线程永久阻塞
+        for _ in range(SESSION_MAX_WINDOW):
+            self.window.release()
+
+
+class SessionSender:
+    """与一个对端保持的持久会话，批量发送文件时复用连接池中的连接
+    
+    大文件单独成帧，小文件合并到批量帧中；每条连接在窗口允许范围内连续发送多个帧，
+    不等待逐个文件的确认。
+    """
+    
+    def __init__(self, file_sender, target_ip, target_port=50002, connections=None, window=None):
+        self.file_sender = file_sender
+        self.target_ip = target_ip
+        self.target_port = target_port
+        self.connection_count = connections or SESSION_CONNECTIONS
+        self.window = window or SESSION_WINDOW
+        self.connections = []
+        self.lock = threading.Lock()
+        # 会话中的所有连接共同受全局和该对端的发送限速约束
+        self.throttle = file_sender.rate_limiter.throttle(target_ip)
+        
+    def send_files(self, file_paths):
+        """发送一批文件，返回 {文件路径: 是否成功}；被用户中断时抛出 InterruptedError"""
+        with self.lock:
+            results = {}
+            files = []
+            for path in file_paths:
+                try:
+                    files.append((path, os.path.getsize(path)))
+                except OSError as e:
+                    print(f"无法读取文件: {path}, {e}")
+                    results[path] = False
+            if not files:
+                return results
+                
+            total_size = sum(size for _, size in files)
+            print(f"开始批量发送 {len(files)} 个文件到 {self.target_ip}:{self.target_port}, 总大小: {total_size} bytes")
+            
+            frames = queue.Queue()
+            for frame in build_frames(files):
+                frames.put(frame)
+            connections = self._ensure_connections(min(self.connection_count, frames.qsize()))
+            
+            # 工作线程只负责发送，进度回调和中断检查在调用线程中进行
+            sent_counts = [0] * len(connections)
+            stop_event = threading.Event()
+            threads = [threading.Thread(target=self._run_connection,
+                                        args=(connections, index, frames, results, sent_counts, stop_event),
+                                        daemon=True)
+                       for index in range(len(connections))]
+            for thread in threads:
+                thread.start()
+                
+            try:
+                for thread in threads:
+                    while thread.is_alive():
+                        thread.join(0.2)
+                        self.file_sender._check_interrupted(f"{len(files)} 个文件")
+                        self.file_sender._report_progress(sum(sent_counts), total_size)
+            except InterruptedError:
+                stop_event.set()
+                for thread in threads:
+                    thread.join()
+                raise
+                
+            # 等待窗口中剩余的确认
+            for connection in connections:
+                if not connection.wait_idle(SESSION_ACK_TIMEOUT):
+                    print("\n等待会话确认超时或连接断开")
+                    connection.close(graceful=False)
+                    
+            # 所有连接都断开时，队列中剩余的帧无法发送
+            while not frames.empty():
+                for path, _ in frames.get_nowait()[1]:
+                    results[path] = False
+            for path, _ in files:
+                results.setdefault(path, False)
+                
+            succeeded = sum(1 for ok in results.values() if ok)
+            self.file_sender._report_progress(total_size, total_size)
+            print(f"\n批量发送完成: 成功 {succeeded}/{len(results)} 个文件")
+            return results
+            
+    def close(self):
+        """关闭会话中的所有连接"""
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+            
+    def _ensure_connections(self, count):
+        """复用仍然可用的连接，不足时建立新连接"""
+        self.connections = [connection for connection in self.connections if not connection.broken]
+        while len(self.connections) < count:
+            self.connections.append(_SessionConnection(self.file_sender, self.target_ip, self.target_port,
+                                                       self.window))
+        return self.connections[:max(1, count)]
+        
+    def _run_connection(self, connections, index, frames, results, sent_counts, stop_event):
+        """工作线程：从共享队列取帧并在 connections[index] 上发送，连接断开时把帧放回队列留给其他连接
+        
+        帧发送到一半出错（例如文件被截断）时，等待之前的帧确认后重新建立连接，继续发送剩余的帧
+        """
+        connection = connections[index]
+        while not stop_event.is_set():
+            try:
+                frame_type, files = frames.get_nowait()
+            except queue.Empty:
+                return
+            connection.window.acquire()
+            if connection.broken:
+                frames.put((frame_type, files))
+                return
+            try:
+                if frame_type == FRAME_FILE:
+                    self._send_file_frame(connection, index, files[0], results, sent_counts, stop_event)
+                else:
+                    self._send_batch_frame(connection, index, files, results, sent_counts)
+            except InterruptedError:
+                connection.close(graceful=False)
+                return
+            except Exception as e:
+                print(f"\n会话连接出错: {e}")
+                connection.abort()
+                connection = self._reconnect(connection)
+                if connection is None:
+                    return
+                connections[index] = connection
+        
+    def _reconnect(self, old):
+        """用新连接替换连接池中出错的连接，无法连接时返回 None"""
+        try:
+            connection = _SessionConnection(self.file_sender, self.target_ip, self.target_port, self.window)
+        except Exception as e:
+            print(f"\n无法重新建立会话连接: {e}")
+            return None
+        if old in self.connections:
+            self.connections[self.connections.index(old)] = connection
+        return connection
+        
+    def _send_file_frame(self, connection, index, file, results, sent_counts, stop_event):
+        """发送单个大文件帧，文件数据使用 FileSender 的零拷贝发送
+        
+        打开文件失败时只记录该文件失败，不占用帧ID，连接继续使用
+        """
+        path, _ = file
+        file_name = os.path.basename(path)
+        try:
+            f = open(path, 'rb')
+        except OSError as e:
+            print(f"无法读取文件: {path}, {e}")
+            results[path] = False
+            connection.window.release()
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            connection.send_frame(FRAME_FILE, {'name': file_name, 'size': size}, [path], results)
+            base = sent_counts[index]
+            
+            def checkpoint(sent):
+                sent_counts[index] = base + sent
+                if stop_event.is_set():
+                    raise InterruptedError("传输被中断")
+                    
+            sent = self.file_sender._send_file_content(connection.sock, f, file_name, 0, size, checkpoint,
+                                                       self.throttle)
+            if sent < size:
+                raise IOError(f"文件读取提前结束: {file_name}, 已发送 {sent}/{size} 字节")
+        
+    def _send_batch_frame(self, connection, index, files, results, sent_counts):
+        """读取多个小文件，连同帧头一次发送"""
+        paths = []
+        entries = []
+        data = []
+        for path, _ in files:
+            try:
+                with open(path, 'rb') as f:
+                    content = f.read()
+            except OSError as e:
+                print(f"无法读取文件: {path}, {e}")
+                results[path] = False
+                continue
+            paths.append(path)
+            entries.append([os.path.basename(path), len(content)])
+            data.append(content)
+        if not paths:
+            connection.window.release()
+            return
+        connection.send_frame(FRAME_BATCH, {'files': entries}, paths, results, data)
+        batch_bytes = sum(len(content) for content in data)
+        transfer_metrics('send', connection.sock).bytes.inc(batch_bytes)
+        sent_counts[index] += batch_bytes
+        self.throttle.consume(batch_bytes)
+
+
+def receive_session(receiver, conn, addr, file_info):
+    """接收方处理会话连接：依次接收帧，每处理完一帧返回一条确认，直到发送方结束会话"""
+    window = max(1, min(int(file_info.get('window', SESSION_WINDOW)), SESSION_MAX_WINDOW))
+    binary = negotiated(file_info)
+    send_reply_message(conn, file_info, {'window': window})
+    print(f"会话连接建立: {addr}, 窗口: {window}")
+    
+    received_files = 0
+    while True:
+        header = recv_exact(conn, FRAME_HEADER.size)
+        if header is None:
+            break
+        frame_type, meta_length = FRAME_HEADER.unpack(header)
+        meta_data = recv_exact(conn, meta_length)
+        if meta_data is None:
+            break
+        meta = decode_meta(meta_data, binary)
+        
+        if frame_type == FRAME_END:
+            break
+        elif frame_type == FRAME_FILE:
+            results = [_receive_file_frame(receiver, conn, meta['name'], meta['size'])]
+        elif frame_type == FRAME_BATCH:
+            results = _receive_batch_frame(receiver, conn, meta['files'])
+        else:
+            raise ValueError(f"未知的会话帧类型: {frame_type!r}")
+            
+        received_files += sum(1 for ok in results if ok)
+        send_json_message(conn, {'id': meta['id'], 'results': results}, binary, MSG_ACK)
+        
+    print(f"会话连接结束: {addr}, 共接收 {received_files} 个文件")
+
+
+def _receive_file_frame(receiver, conn, file_name, file_size):
+    """接收单个文件帧，数据不完整时连接已无法继续使用，抛出 ConnectionError"""
+    partial = PartialFile(receiver.download_dir, file_name, file_size)
+    partial.open()
+    try:
+        received = receiver._receive_file_content(conn, partial.fd, file_size)
+    except Exception:
+        partial.suspend(0)
+        raise
+    if received < file_size:
+        partial.suspend(0)
+        raise ConnectionError(f"会话帧数据不完整: {file_name}, 接收了 {received}/{file_size} 字节")
+    save_path = receiver._commit_partial(partial, file_name)
+    files_total('receive', 'ok').inc()
+    print(f"\n文件接收完成: {save_path}")
+    return True
+
+
+def _receive_batch_frame(receiver, conn, files):
+    """接收批量帧：一次读入所有小文件的数据，再逐个写出，单个文件写入失败不影响后续帧"""
+    total = sum(size for _, size in files)
+    if total > MAX_BATCH_BYTES:
+        raise ValueError(f"批量帧过大: {total} bytes")
+    data = memoryview(bytearray(total))
+    metrics = transfer_metrics('receive', conn)
+    if recv_into_exact(conn, data, metrics.io_calls('recv')) < total:
+        raise ConnectionError("批量帧数据不完整")
+    metrics.bytes.inc(total)
+        
+    # 先写出整批文件并一起 fsync，再逐个重命名，最后只 fsync 一次目录
+    results = []
+    written = []
+    offset = 0
+    for index, (file_name, size) in enumerate(files):
+        chunk = data[offset:offset + size]
+        offset += size
+        partial = PartialFile(receiver.download_dir, file_name, size)
+        try:
+            partial.open()
+            write_buffers(partial.fd, [chunk])
+            written.append((index, file_name, partial))
+            results.append(True)
+        except OSError as e:
+            _discard_batch_file(file_name, partial, e)
+            results.append(False)
+        
+    try:
+        sync_partials([partial for _, _, partial in written])
+    except OSError as e:
+        for index, file_name, partial in written:
+            _discard_batch_file(file_name, partial, e)
+            results[index] = False
+        return results
+    for index, file_name, partial in written:
+        try:
+            receiver._commit_partial(partial, file_name, sync=False)
+            files_total('receive', 'ok').inc()
+        except OSError as e:
+            _discard_batch_file(file_name, partial, e)
+            results[index] = False
+    if DURABLE_COMMIT and any(results):
+        sync_directory(receiver.download_dir)
+    return results
+
+
+def _discard_batch_file(file_name, partial, error):
+    """批量帧中的一个文件保存失败：记录并删除 .part 文件"""
+    print(f"保存文件失败: {file_name}, {error}")
+    files_total('receive', 'failed').inc()
+    partial.suspend(0)
\ No newline at end of file
@@ -0,0 +1,653 @@
+# server/swarm.py
+import os
+import sys
+import time
+import uuid
+import random
+import socket
+import threading
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import (PREALLOCATE_FILES, WIRE_FORMAT, SWARM_PIECE_SIZE, SWARM_DOWNLOAD_WORKERS, SWARM_MAX_PEERS,
+                    SWARM_REFRESH_INTERVAL, SWARM_SEED_RESERVE_TIME, SWARM_MAX_BAD_PIECES, SWARM_STALL_TIMEOUT,
+                    SWARM_LINGER_TIMEOUT)
+from utils.network_utils import (create_tcp_server_socket, create_tcp_client_socket, send_json_message,
+                                 send_reply_message, recv_json_message, recv_exact)
+from utils.wire import WIRE_VERSION, negotiated
+from utils.io_utils import recv_into_exact, preallocate_file, write_buffers
+from utils.metrics import transfer_metrics, files_total, ProgressPrinter
+from utils.tuning import configure_socket
+
+try:
+    from server.integrity import ALGORITHMS, ChunkHasher, available_algorithms, leaf_digest, merkle_root
+    from server.resume import PartialFile
+except ImportError:
+    from .integrity import ALGORITHMS, ChunkHasher, available_algorithms, leaf_digest, merkle_root  # 尝试相对导入
+    from .resume import PartialFile
+
+# 一个文件发往多个设备时，源端只作为"种子"，接收方之间互相转发已经收到并校验过的分片：
+#   源端向每个接收方发送 {'mode': 'swarm', 'swarm_id', 'name', 'size', 'piece_size', 'integrity',
+#   'digests': 各分片摘要拼接的十六进制, 'root', 'seed_port', 'peers': [[ip, 端口], ...]}，接收方回复 {'ok'}；
+#   接收方下载完成后发送 {'ok', 'root'}，之后继续提供分片，直到源端在所有接收方完成后发送 {'done': True}。
+# 分片连接（连到源端的种子端口或其他接收方的监听端口）先发送 {'mode': 'swarm_peer', 'swarm_id'}，
+# 回复 {'ok', 'pieces': 分片数}，之后一问一答：
+#   {'have': True}  -> {'pieces': 分片数, 'length': 位图字节数}，随后是位图（第 i 位为 1 表示提供第 i 片）
+#   {'piece': 序号} -> {'piece': 序号, 'size': 长度}，随后是分片数据；size 为 0 表示对方没有（或暂不提供）该分片
+
+
+def piece_count(size, piece_size):
+    """文件的分片数，与 ChunkHasher 一致：空文件也有一个长度为0的分片"""
+    return max(1, (size + piece_size - 1) // piece_size)
+
+
+def encode_bitmap(indices, count):
+    """分片序号集合编码为位图"""
+    bitmap = bytearray((count + 7) // 8)
+    for index in indices:
+        bitmap[index >> 3] |= 0x80 >> (index & 7)
+    return bytes(bitmap)
+
+
+def decode_bitmap(data, count):
+    """位图解码为分片序号集合"""
+    return {index for index in range(count) if data[index >> 3] & (0x80 >> (index & 7))}
+
+
+class PieceSource:
+    """可以向其他设备提供分片的文件：源端的原文件，或接收方正在下载的文件
+    
+    reserve_time 大于0时（源端）一个分片发出后在这段时间内不再提供给其他接收方，
+    接收方只能从彼此那里获取已经分发出去的分片，源端的上行带宽留给尚未分发的分片。
+    close() 之后不再提供分片，文件在最后一个进行中的读取结束后关闭。
+    """
+    
+    def __init__(self, path, size, piece_size, have_all=False, reserve_time=0):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = size
+        self.piece_size = piece_size
+        self.count = piece_count(size, piece_size)
+        self.have = set(range(self.count)) if have_all else set()
+        self.reserve_time = reserve_time
+        # 每个分片最近一次提供出去的时间 {序号: 时间}，只在 reserve_time 大于0时记录
+        self.served = {}
+        self.served_bytes = 0
+        self.readers = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        
+    def piece_range(self, index):
+        """分片在文件中的 (偏移, 长度)"""
+        offset = index * self.piece_size
+        return offset, min(self.piece_size, self.size - offset)
+        
+    def add(self, index):
+        """分片已经校验并写入文件，可以提供给其他设备"""
+        with self.lock:
+            self.have.add(index)
+        
+    def advertised(self):
+        """当前愿意提供的分片序号"""
+        with self.lock:
+            if not self.reserve_time:
+                return set(self.have)
+            now = time.monotonic()
+            return {index for index in self.have
+                    if now - self.served.get(index, -self.reserve_time) >= self.reserve_time}
+        
+    def checkout(self, index):
+        """开始提供一个分片，返回是否可以提供；返回 True 时调用方发送完必须调用 release()"""
+        with self.lock:
+            if self.closed or index not in self.have:
+                return False
+            if self.reserve_time:
+                now = time.monotonic()
+                if now - self.served.get(index, -self.reserve_time) < self.reserve_time:
+                    return False
+                self.served[index] = now
+            self.readers += 1
+            return True
+        
+    def release(self, length):
+        """一个分片发送结束"""
+        with self.lock:
+            self.readers -= 1
+            self.served_bytes += length
+            if self.closed and self.readers == 0:
+                os.close(self.fd)
+        
+    def close(self):
+        """不再提供分片"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.readers == 0:
+                os.close(self.fd)
+
+
+def serve_pieces(conn, source, binary, throttle=None):
+    """处理一条分片连接：应答位图和分片请求，直到对方关闭连接或 source 不再提供分片"""
+    metrics = transfer_metrics('send', conn)
+    send_calls = metrics.io_calls('send')
+    while not source.closed:
+        request = recv_json_message(conn)
+        if not request:
+            return
+        if 'piece' not in request:
+            bitmap = encode_bitmap(source.advertised(), source.count)
+            send_json_message(conn, {'pieces': source.count, 'length': len(bitmap)}, binary)
+            conn.sendall(bitmap)
+            continue
+            
+        index = request['piece']
+        if not isinstance(index, int) or not 0 <= index < source.count or not source.checkout(index):
+            send_json_message(conn, {'piece': index, 'size': 0}, binary)
+            continue
+        offset, length = source.piece_range(index)
+        try:
+            data = os.pread(source.fd, length, offset)
+        finally:
+            source.release(length)
+        if len(data) < length:
+            raise IOError(f"读取分片失败: {index}, 读到 {len(data)}/{length} 字节")
+        chunk_start = time.perf_counter()
+        send_json_message(conn, {'piece': index, 'size': length}, binary)
+        conn.sendall(data)
+        send_calls.inc(2)
+        metrics.bytes.inc(length)
+        metrics.chunk_seconds.observe(time.perf_counter() - chunk_start)
+        if throttle is not None:
+            throttle.consume(length)
+
+
+class _SeedServer:
+    """源端的种子端口：临时监听一个端口，为各接收方的分片连接提供源文件的分片"""
+    
+    def __init__(self, source, swarm_id, rate_limiter):
+        self.source = source
+        self.swarm_id = swarm_id
+        self.rate_limiter = rate_limiter
+        self.server_socket = create_tcp_server_socket('0.0.0.0', 0)
+        self.port = self.server_socket.getsockname()[1]
+        self.connections = set()
+        self.lock = threading.Lock()
+        self.running = True
+        self.accept_thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self.accept_thread.start()
+        
+    def stop(self):
+        """停止监听并断开所有分片连接"""
+        self.running = False
+        with self.lock:
+            connections = list(self.connections)
+        # 关闭监听套接字不一定能唤醒阻塞的 accept，先 shutdown
+        for sock in [self.server_socket] + connections:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.server_socket.close()
+        self.accept_thread.join(1.0)
+        
+    def _accept_loop(self):
+        """接受分片连接，每个连接一个线程"""
+        while self.running:
+            try:
+                conn, addr = self.server_socket.accept()
+            except OSError:
+                break
+            configure_socket(conn)
+            threading.Thread(target=self._serve, args=(conn, addr), daemon=True).start()
+        
+    def _serve(self, conn, addr):
+        """处理一个接收方的分片连接，上传受发送限速约束"""
+        with self.lock:
+            self.connections.add(conn)
+        try:
+            request = recv_json_message(conn)
+            if not request or request.get('swarm_id') != self.swarm_id:
+                return
+            send_reply_message(conn, request, {'ok': True, 'pieces': self.source.count})
+            serve_pieces(conn, self.source, negotiated(request), self.rate_limiter.throttle(addr[0]))
+        except Exception as e:
+            if self.running:
+                print(f"\n提供分片时出错: {addr}, {e}")
+        finally:
+            with self.lock:
+                self.connections.discard(conn)
+            conn.close()
+
+
+class SwarmSender:
+    """把一个文件分发到多个设备：源端只提供分片，接收方之间按 rarest-first 互相转发
+    
+    源端的每个分片通常只上传一次，之后在接收方之间扩散，总时间随设备数对数增长，而不是线性增长
+    """
+    
+    def __init__(self, file_sender):
+        self.file_sender = file_sender
+        
+    def send_file(self, file_path, targets):
+        """把文件分发到 targets [(ip, port), ...]，返回 {(ip, port): 是否成功}"""
+        file_path = os.path.abspath(file_path)
+        if not os.path.isfile(file_path):
+            raise FileNotFoundError(f"文件不存在: {file_path}")
+        targets = list(dict.fromkeys((ip, int(port)) for ip, port in targets))
+        if not targets:
+            raise ValueError("没有可以分发的目标设备")
+        algorithms = available_algorithms()
+        if not algorithms:
+            raise ValueError("没有可用的摘要算法，无法校验分片")
+        algorithm = algorithms[0]
+        file_name = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        
+        source = PieceSource(file_path, file_size, SWARM_PIECE_SIZE, have_all=True,
+                             reserve_time=SWARM_SEED_RESERVE_TIME if len(targets) > 1 else 0)
+        results = {target: False for target in targets}
+        controls = {}
+        seed = None
+        try:
+            print(f"开始分发文件: {file_name}, 大小: {file_size} bytes, 分片数: {source.count}, "
+                  f"目标: {len(targets)} 个设备")
+            digests = ChunkHasher(source.fd, algorithm, 0, file_size,
+                                  chunk_size=SWARM_PIECE_SIZE).start_hashing().finish()
+            root = merkle_root(algorithm, digests).hex()
+            swarm_id = uuid.uuid4().hex
+            seed = _SeedServer(source, swarm_id, self.file_sender.rate_limiter)
+            manifest = {
+                'mode': 'swarm',
+                'swarm_id': swarm_id,
+                'name': file_name,
+                'size': file_size,
+                'piece_size': SWARM_PIECE_SIZE,
+                'integrity': algorithm,
+                'digests': b''.join(digests).hex(),
+                'root': root,
+                'seed_port': seed.port,
+            }
+            start_time = time.monotonic()
+            for target in targets:
+                peers = [list(peer) for peer in targets if peer != target]
+                control = self._open_control(target, dict(manifest, peers=peers))
+                if control is not None:
+                    controls[target] = control
+                
+            # 每个接收方下载完成后发来确认，全部完成之前它们继续为其他接收方提供分片
+            for target, (sock, binary) in controls.items():
+                try:
+                    reply = recv_json_message(sock)
+                except OSError as e:
+                    print(f"\n接收方连接中断: {target[0]}:{target[1]}, {e}")
+                    continue
+                results[target] = bool(reply and reply.get('ok') and reply.get('root') == root)
+                if not results[target]:
+                    print(f"\n接收方未能完成下载: {target[0]}:{target[1]}")
+            for sock, binary in controls.values():
+                try:
+                    send_json_message(sock, {'done': True}, binary)
+                except OSError:
+                    pass
+                
+            elapsed = time.monotonic() - start_time
+            print(f"\n分发完成: {file_name}, 成功 {sum(results.values())}/{len(targets)} 个设备, "
+                  f"用时 {elapsed:.1f} 秒, 源端上传 {source.served_bytes} 字节"
+                  f"（文件大小的 {source.served_bytes / max(1, file_size):.2f} 倍）")
+            return results
+        finally:
+            for sock, binary in controls.values():
+                sock.close()
+            if seed is not None:
+                seed.stop()
+            source.close()
+        
+    def _open_control(self, target, manifest):
+        """向一个接收方发送分发清单，返回 (控制连接, 是否使用二进制帧)，失败时返回 None"""
+        ip, port = target
+        sock = create_tcp_client_socket()
+        try:
+            sock.connect((ip, port))
+            binary = self.file_sender._send_header(sock, ip, manifest)
+            reply = self.file_sender._recv_reply(sock, ip)
+            if not reply or not reply.get('ok'):
+                raise ConnectionError(reply.get('error', "接收方拒绝分发") if reply else "接收方未响应")
+            return sock, binary or negotiated(reply)
+        except (OSError, ConnectionError) as e:
+            print(f"无法向 {ip}:{port} 分发文件: {e}")
+            sock.close()
+            return None
+
+
+class _PeerLink:
+    """到一个分片提供方（源端或其他接收方）的持久连接，以及它最近一次报告的分片位图"""
+    
+    def __init__(self, address, is_seed):
+        self.address = address
+        self.is_seed = is_seed
+        self.sock = None
+        self.binary = False
+        self.metrics = None
+        self.pieces = set()
+        self.refreshed_at = None
+        self.retry_at = 0.0
+        self.busy = False
+        self.bad_pieces = 0
+        self.throttle = None
+        
+    def connect(self, swarm_id):
+        """建立分片连接，对方还没有加入（或已经离开）该分发时抛出 ConnectionError"""
+        sock = create_tcp_client_socket()
+        try:
+            sock.settimeout(SWARM_STALL_TIMEOUT)
+            sock.connect(self.address)
+            request = {'mode': 'swarm_peer', 'swarm_id': swarm_id}
+            if WIRE_FORMAT == 'binary':
+                request['wire'] = WIRE_VERSION
+            send_json_message(sock, request)
+            reply = recv_json_message(sock)
+            if not reply or not reply.get('ok'):
+                raise ConnectionError(f"对端没有参与该分发: {self.address[0]}:{self.address[1]}")
+        except Exception:
+            sock.close()
+            raise
+        self.sock = sock
+        self.binary = negotiated(reply)
+        self.metrics = transfer_metrics('receive', sock)
+        
+    def request_have(self, count):
+        """获取对方当前提供的分片序号"""
+        send_json_message(self.sock, {'have': True}, self.binary)
+        reply = recv_json_message(self.sock)
+        if not reply or reply.get('pieces') != count or reply.get('length') != (count + 7) // 8:
+            raise ConnectionError("无效的分片位图应答")
+        data = recv_exact(self.sock, reply['length'])
+        if data is None:
+            raise ConnectionError("分片连接提前关闭")
+        return decode_bitmap(data, count)
+        
+    def request_piece(self, index, length):
+        """下载一个分片，对方没有该分片时返回 None"""
+        send_json_message(self.sock, {'piece': index}, self.binary)
+        reply = recv_json_message(self.sock)
+        if not reply or reply.get('piece') != index:
+            raise ConnectionError("无效的分片应答")
+        if not reply.get('size'):
+            return None
+        if reply['size'] != length:
+            raise ConnectionError(f"分片长度不一致: {index}, {reply['size']}/{length}")
+        data = bytearray(length)
+        if recv_into_exact(self.sock, memoryview(data), self.metrics.io_calls('recv')) < length:
+            raise ConnectionError("分片连接提前关闭")
+        self.metrics.bytes.inc(length)
+        return data
+        
+    def close(self):
+        """关闭连接"""
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class SwarmDownloader:
+    """接收方的分片调度：同时从源端和随机选取的其他接收方下载，优先下载持有者最少的分片（rarest-first）
+    
+    每个连接同一时间只有一个请求，工作线程各自占用不同的连接；同样稀少的分片随机选择，
+    同一个分片优先从其他接收方而不是源端获取。分片先按清单中的摘要校验再写入文件，
+    校验失败的分片重新调度，发来 SWARM_MAX_BAD_PIECES 个错误分片的对端不再使用。
+    """
+    
+    def __init__(self, swarm_id, source, fd, algorithm, digests, seed, peers, rate_limiter=None):
+        self.swarm_id = swarm_id
+        self.source = source
+        self.fd = fd
+        self.algorithm = algorithm
+        self.digests = digests
+        peers = [tuple(peer) for peer in peers]
+        self.links = [_PeerLink(seed, True)] + [_PeerLink(peer, False)
+                                               for peer in random.sample(peers, min(len(peers), SWARM_MAX_PEERS))]
+        if rate_limiter is not None:
+            for link in self.links:
+                link.throttle = rate_limiter.throttle(link.address[0])
+        # 每个分片在已知位图中出现的次数
+        self.availability = [0] * source.count
+        # 缺少的分片按稀有程度排序，位图变化后重新排序
+        self.order = []
+        self.order_stale = True
+        self.missing = set(range(source.count)) - source.have
+        self.in_flight = set()
+        self.done_bytes = source.size - sum(source.piece_range(index)[1] for index in self.missing)
+        self.seed_bytes = 0
+        self.peer_bytes = 0
+        self.last_progress = time.monotonic()
+        self.condition = threading.Condition()
+        self.printer = ProgressPrinter("接收进度")
+        if source.size == 0:
+            self._complete_piece(0, 0, True)
+        
+    def run(self):
+        """下载所有缺少的分片，返回是否全部完成"""
+        workers = [threading.Thread(target=self._worker, daemon=True)
+                   for _ in range(min(SWARM_DOWNLOAD_WORKERS, len(self.links)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        for link in self.links:
+            link.close()
+        return not self.missing
+        
+    def _worker(self):
+        """工作线程：反复领取一个任务（刷新位图或下载分片）执行，直到下载完成或停滞"""
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            link, index = job
+            try:
+                if index is None:
+                    self._refresh(link)
+                else:
+                    self._download(link, index)
+            except Exception as e:
+                link.close()
+                with self.condition:
+                    self._forget(link)
+                    link.retry_at = time.monotonic() + SWARM_REFRESH_INTERVAL
+                if not isinstance(e, (OSError, ConnectionError)):
+                    print(f"\n分片下载出错: {link.address[0]}:{link.address[1]}, {e}")
+            finally:
+                with self.condition:
+                    link.busy = False
+                    self.in_flight.discard(index)
+                    self.condition.notify_all()
+        
+    def _next_job(self):
+        """领取下一个任务 (连接, 分片序号)，分片序号为 None 表示刷新该连接的位图；结束时返回 None"""
+        with self.condition:
+            while self.missing:
+                now = time.monotonic()
+                if now - self.last_progress > SWARM_STALL_TIMEOUT:
+                    print(f"\n{SWARM_STALL_TIMEOUT} 秒内没有下载到任何分片，放弃下载")
+                    return None
+                job = self._choose(now)
+                if job is not None:
+                    link, index = job
+                    link.busy = True
+                    if index is not None:
+                        self.in_flight.add(index)
+                    return job
+                self.condition.wait(SWARM_REFRESH_INTERVAL / 4)
+            return None
+        
+    def _choose(self, now):
+        """选择任务（调用方持有锁）：先刷新过期的位图，再按稀有程度选择空闲连接能提供的分片"""
+        idle = [link for link in self.links
+                if not link.busy and link.retry_at <= now and link.bad_pieces < SWARM_MAX_BAD_PIECES]
+        if not idle:
+            return None
+        for link in idle:
+            if link.refreshed_at is None or now - link.refreshed_at >= SWARM_REFRESH_INTERVAL:
+                return link, None
+            
+        if self.order_stale:
+            self.order = sorted(self.missing, key=lambda index: (self.availability[index], random.random()))
+            self.order_stale = False
+        peers = [link for link in idle if not link.is_seed]
+        seeds = [link for link in idle if link.is_seed]
+        for index in self.order:
+            if index not in self.missing or index in self.in_flight:
+                continue
+            holders = [link for link in peers if index in link.pieces]
+            if holders:
+                return random.choice(holders), index
+            for link in seeds:
+                if index in link.pieces:
+                    return link, index
+        return None
+        
+    def _refresh(self, link):
+        """连接（必要时重新连接）并获取对方的分片位图"""
+        if link.sock is None:
+            link.connect(self.swarm_id)
+        pieces = link.request_have(self.source.count)
+        with self.condition:
+            for index in link.pieces - pieces:
+                self.availability[index] -= 1
+            for index in pieces - link.pieces:
+                self.availability[index] += 1
+            if pieces != link.pieces:
+                self.order_stale = True
+            link.pieces = pieces
+            link.refreshed_at = time.monotonic()
+        
+    def _download(self, link, index):
+        """从 link 下载一个分片，校验通过后写入文件"""
+        offset, length = self.source.piece_range(index)
+        data = link.request_piece(index, length)
+        if data is None:
+            # 对方的位图已经过期（源端刚把该分片发给了别人）
+            with self.condition:
+                self._drop_piece(link, index)
+            return
+        if link.throttle is not None:
+            link.throttle.consume(length)
+        if leaf_digest(self.algorithm, data) != self.digests[index]:
+            with self.condition:
+                self._drop_piece(link, index)
+                link.bad_pieces += 1
+            print(f"\n分片校验失败: {index}, 来自 {link.address[0]}:{link.address[1]}")
+            if link.bad_pieces >= SWARM_MAX_BAD_PIECES:
+                print(f"不再从 {link.address[0]}:{link.address[1]} 下载分片")
+                link.close()
+                with self.condition:
+                    self._forget(link)
+            return
+        write_buffers(self.fd, [data], offset=offset, calls=link.metrics.io_calls('write'))
+        with self.condition:
+            self._complete_piece(index, length, link.is_seed)
+        
+    def _complete_piece(self, index, length, from_seed):
+        """分片已写入文件（调用方持有锁或在启动前调用）"""
+        self.missing.discard(index)
+        self.source.add(index)
+        self.done_bytes += length
+        if from_seed:
+            self.seed_bytes += length
+        else:
+            self.peer_bytes += length
+        self.last_progress = time.monotonic()
+        self.printer.update(self.done_bytes, self.source.size)
+        
+    def _drop_piece(self, link, index):
+        """对方实际上不提供该分片（调用方持有锁）"""
+        if index in link.pieces:
+            link.pieces.discard(index)
+            self.availability[index] -= 1
+            self.order_stale = True
+        
+    def _forget(self, link):
+        """连接断开或不再使用，清除它的位图（调用方持有锁）"""
+        for index in link.pieces:
+            self.availability[index] -= 1
+        if link.pieces:
+            self.order_stale = True
+        link.pieces = set()
+        link.refreshed_at = None
+
+
+def receive_swarm(receiver, conn, addr, file_info):
+    """接收方处理分发：从源端和其他接收方下载分片，完成后继续提供分片直到源端宣布结束"""
+    swarm_id = file_info['swarm_id']
+    file_name = os.path.basename(file_info['name'])
+    file_size = file_info['size']
+    piece_size = file_info['piece_size']
+    algorithm = file_info.get('integrity')
+    binary = negotiated(file_info)
+    if algorithm not in ALGORITHMS:
+        send_reply_message(conn, file_info, {'ok': False, 'error': f"不支持的摘要算法: {algorithm}"})
+        return
+    digest_size = len(leaf_digest(algorithm, b''))
+    data = bytes.fromhex(file_info['digests'])
+    digests = [data[i:i + digest_size] for i in range(0, len(data), digest_size)]
+    if piece_size <= 0 or len(digests) != piece_count(file_size, piece_size):
+        raise ValueError("分片摘要数量与文件大小不一致")
+    if merkle_root(algorithm, digests).hex() != file_info['root']:
+        raise ValueError("分片摘要与根摘要不一致")
+        
+    partial = PartialFile(receiver.download_dir, file_name, file_size)
+    partial.open()
+    committed = False
+    source = None
+    try:
+        if PREALLOCATE_FILES:
+            preallocate_file(partial.fd, file_size)
+        os.ftruncate(partial.fd, file_size)
+        # 另开一个只读描述符提供分片，重命名为最终文件后仍然有效
+        source = PieceSource(partial.part_path, file_size, piece_size)
+        with receiver.swarms_lock:
+            receiver.swarms[swarm_id] = source
+        send_reply_message(conn, file_info, {'ok': True})
+        print(f"开始接收分发文件: {file_name}, 大小: {file_size} bytes, 分片数: {source.count}, 来自: {addr}")
+        
+        downloader = SwarmDownloader(swarm_id, source, partial.fd, algorithm, digests,
+                                     (addr[0], file_info['seed_port']), file_info.get('peers', []),
+                                     receiver.rate_limiter)
+        if not downloader.run():
+            print(f"\n分发文件接收失败: {file_name}, 缺少 {len(downloader.missing)}/{source.count} 个分片")
+            files_total('receive', 'failed').inc()
+            send_json_message(conn, {'ok': False}, binary)
+            return
+            
+        save_path = receiver._commit_partial(partial, file_name)
+        committed = True
+        files_total('receive', 'ok').inc()
+        print(f"\n分发文件接收完成: {save_path}, 从源端下载 {downloader.seed_bytes} 字节, "
+              f"从其他接收方下载 {downloader.peer_bytes} 字节")
+        send_json_message(conn, {'ok': True, 'root': file_info['root']}, binary)
+        
+        # 其他接收方可能还需要本机的分片
+        conn.settimeout(SWARM_LINGER_TIMEOUT)
+        try:
+            recv_json_message(conn)
+        except OSError:
+            pass
+    finally:
+        with receiver.swarms_lock:
+            receiver.swarms.pop(swarm_id, None)
+        if source is not None:
+            source.close()
+        if not committed:
+            partial.suspend(0)
+
+
+def serve_swarm_peer(receiver, conn, addr, file_info):
+    """接收方处理其他接收方的分片连接"""
+    with receiver.swarms_lock:
+        source = receiver.swarms.get(file_info.get('swarm_id'))
+    if source is None:
+        send_reply_message(conn, file_info, {'ok': False})
+        return
+    send_reply_message(conn, file_info, {'ok': True, 'pieces': source.count})
+    serve_pieces(conn, source, negotiated(file_info))
\ No newline at end of file
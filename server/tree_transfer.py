@@ -0,0 +1,386 @@
+# server/tree_transfer.py
+import os
+import sys
+import stat
+import socket
+import collections
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import (SESSION_COALESCE_SIZE, SESSION_BATCH_BYTES, SESSION_BATCH_FILES, STRIPE_FINALIZE_TIMEOUT,
+                    TREE_PACK_WORKERS, TREE_PREFETCH_FRAMES, DURABLE_COMMIT)
+from utils.network_utils import (create_tcp_client_socket, send_json_message, send_reply_message,
+                                 recv_json_message, recv_exact)
+from utils.wire import negotiated, decode_meta
+from utils.io_utils import recv_into_exact, write_buffers, sync_directory
+from utils.metrics import transfer_metrics, queue_depth, files_total
+
+try:
+    from server.resume import PartialFile, save_names, sync_partials
+    from server.session import (FRAME_HEADER, FRAME_FILE, FRAME_BATCH, FRAME_END, MAX_BATCH_BYTES,
+                                encode_frame_header)
+except ImportError:
+    from .resume import PartialFile, save_names, sync_partials  # 尝试相对导入
+    from .session import (FRAME_HEADER, FRAME_FILE, FRAME_BATCH, FRAME_END, MAX_BATCH_BYTES,
+                          encode_frame_header)
+
+# 目录树传输复用会话的帧格式（包括元数据的二进制/JSON协商），清单随数据帧流式发送，路径一律使用 '/' 分隔的相对路径：
+#   FRAME_DIR:   {'dirs': [[路径, 权限, mtime_ns], ...]}
+#   FRAME_BATCH: {'files': [[路径, 大小, 权限, mtime_ns], ...]}，数据依次拼接
+#   FRAME_FILE:  {'path', 'size', 'mode', 'mtime'}，随后是文件数据
+#   FRAME_END:   {'files': 文件数, 'bytes': 总字节数}，接收方回复 {'files', 'failed'}
+FRAME_DIR = b'D'
+
+# 只恢复发送方的读写执行权限，setuid/setgid/sticky 位来自远端，不能原样应用
+PERMISSION_MASK = 0o777
+
+
+def walk_tree(root):
+    """惰性遍历目录树，产生 (相对路径, os.DirEntry)；目录先于其内容产生，符号链接被跳过"""
+    stack = ['']
+    while stack:
+        relative = stack.pop()
+        try:
+            entries = os.scandir(os.path.join(root, relative))
+        except OSError as e:
+            print(f"无法读取目录: {relative or root}, {e}")
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_symlink():
+                    continue
+                entry_path = f"{relative}/{entry.name}" if relative else entry.name
+                if entry.is_dir():
+                    yield entry_path, entry
+                    stack.append(entry_path)
+                elif entry.is_file():
+                    yield entry_path, entry
+
+
+def plan_frames(root):
+    """把目录树遍历结果分组为帧计划，产生 (帧类型, [(相对路径, 绝对路径, stat结果), ...])"""
+    dirs = []
+    batch = []
+    batch_bytes = 0
+    for relative, entry in walk_tree(root):
+        try:
+            st = entry.stat()
+        except OSError as e:
+            print(f"无法读取文件信息: {relative}, {e}")
+            continue
+        item = (relative, entry.path, st)
+        if stat.S_ISDIR(st.st_mode):
+            dirs.append(item)
+            if len(dirs) >= SESSION_BATCH_FILES:
+                yield FRAME_DIR, dirs
+                dirs = []
+        elif st.st_size >= SESSION_COALESCE_SIZE:
+            yield FRAME_FILE, [item]
+        else:
+            if batch and (batch_bytes + st.st_size > SESSION_BATCH_BYTES or len(batch) >= SESSION_BATCH_FILES):
+                yield FRAME_BATCH, batch
+                batch = []
+                batch_bytes = 0
+            batch.append(item)
+            batch_bytes += st.st_size
+    if dirs:
+        yield FRAME_DIR, dirs
+    if batch:
+        yield FRAME_BATCH, batch
+
+
+def _read_batch(items):
+    """打包线程：读取批量帧中所有小文件，返回 (清单条目, 数据列表)，读取失败的文件被跳过"""
+    entries = []
+    data = []
+    for relative, path, st in items:
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except OSError as e:
+            print(f"无法读取文件: {path}, {e}")
+            continue
+        entries.append([relative, len(content), stat.S_IMODE(st.st_mode), st.st_mtime_ns])
+        data.append(content)
+    return entries, data
+
+
+class TreeSender:
+    """通过一个连接发送整个目录树：边遍历边发送，小文件由线程池预先读取并合并成批"""
+    
+    def __init__(self, file_sender):
+        self.file_sender = file_sender
+        
+    def send_tree(self, dir_path, target_ip, target_port=50002):
+        """发送目录，返回接收方的汇总 {'root': 接收方目录名, 'files': 成功文件数, 'failed': [失败路径]}"""
+        dir_path = os.path.abspath(dir_path)
+        if not os.path.isdir(dir_path):
+            raise FileNotFoundError(f"目录不存在: {dir_path}")
+        root_name = os.path.basename(dir_path.rstrip(os.sep))
+        
+        print(f"开始发送目录: {root_name} 到 {target_ip}:{target_port}")
+        
+        sock = create_tcp_client_socket()
+        try:
+            sock.connect((target_ip, target_port))
+            binary = self.file_sender._send_header(sock, target_ip, {'mode': 'tree', 'root': root_name})
+            reply = self.file_sender._recv_reply(sock, target_ip)
+            if not reply:
+                raise ConnectionError("接收方未响应目录传输协商")
+            binary = binary or negotiated(reply)
+                
+            throttle = self.file_sender.rate_limiter.throttle(target_ip)
+            file_count, sent_bytes = self._send_frames(sock, dir_path, root_name, binary, throttle)
+            
+            sock.sendall(encode_frame_header(FRAME_END, {'files': file_count, 'bytes': sent_bytes}, binary))
+            sock.settimeout(STRIPE_FINALIZE_TIMEOUT)
+            summary = recv_json_message(sock)
+            if not summary:
+                raise ConnectionError(f"接收方未确认目录传输: {root_name}")
+            summary['root'] = reply['root']
+            print(f"\n目录发送完成: {root_name} -> {reply['root']}, "
+                  f"成功 {summary['files']}/{file_count} 个文件, 共 {sent_bytes} 字节")
+            return summary
+        except socket.timeout:
+            print(f"等待接收方确认超时: {target_ip}:{target_port}")
+            raise
+        finally:
+            sock.close()
+            
+    def _send_frames(self, sock, dir_path, root_name, binary, throttle):
+        """按遍历顺序发送帧，批量帧的文件读取提前提交给线程池，返回 (文件数, 字节数)"""
+        file_count = 0
+        sent_bytes = 0
+        # 已发现的文件总字节数，遍历是惰性的，进度的分母随遍历增长
+        known_bytes = 0
+        pending = collections.deque()
+        # 只有发送方需要线程池，延迟导入以免拖慢接收服务的启动
+        from concurrent.futures import ThreadPoolExecutor
+        
+        with ThreadPoolExecutor(max_workers=TREE_PACK_WORKERS, thread_name_prefix='tree-pack') as executor:
+            frames = plan_frames(dir_path)
+            exhausted = False
+            while True:
+                # 保持若干个帧的预读，使磁盘读取与网络发送重叠
+                while not exhausted and len(pending) < TREE_PREFETCH_FRAMES:
+                    frame = next(frames, None)
+                    if frame is None:
+                        exhausted = True
+                        break
+                    frame_type, items = frame
+                    if frame_type != FRAME_DIR:
+                        known_bytes += sum(st.st_size for _, _, st in items)
+                    future = executor.submit(_read_batch, items) if frame_type == FRAME_BATCH else None
+                    pending.append((frame_type, items, future))
+                if not pending:
+                    break
+                    
+                queue_depth('tree_prefetch').set(len(pending))
+                frame_type, items, future = pending.popleft()
+                self.file_sender._check_interrupted(root_name)
+                if frame_type == FRAME_DIR:
+                    dirs = [[relative, stat.S_IMODE(st.st_mode), st.st_mtime_ns] for relative, _, st in items]
+                    sock.sendall(encode_frame_header(FRAME_DIR, {'dirs': dirs}, binary))
+                elif frame_type == FRAME_BATCH:
+                    entries, data = future.result()
+                    if entries:
+                        header = encode_frame_header(FRAME_BATCH, {'files': entries}, binary)
+                        sock.sendall(b''.join([header, *data]))
+                        batch_bytes = sum(len(content) for content in data)
+                        transfer_metrics('send', sock).bytes.inc(batch_bytes)
+                        file_count += len(entries)
+                        sent_bytes += batch_bytes
+                        throttle.consume(batch_bytes)
+                else:
+                    sent = self._send_large_file(sock, items[0], sent_bytes, known_bytes, binary, throttle)
+                    if sent is not None:
+                        file_count += 1
+                        sent_bytes += sent
+                self.file_sender._report_progress(sent_bytes, max(known_bytes, sent_bytes))
+                
+        return file_count, sent_bytes
+        
+    def _send_large_file(self, sock, item, base, known_bytes, binary, throttle):
+        """发送单个大文件帧，文件无法打开时跳过并返回 None"""
+        relative, path, st = item
+        try:
+            f = open(path, 'rb')
+        except OSError as e:
+            print(f"无法读取文件: {path}, {e}")
+            return None
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            sock.sendall(encode_frame_header(FRAME_FILE, {
+                'path': relative,
+                'size': size,
+                'mode': stat.S_IMODE(st.st_mode),
+                'mtime': st.st_mtime_ns
+            }, binary))
+            
+            def checkpoint(sent):
+                self.file_sender._check_interrupted(relative)
+                if sent:
+                    self.file_sender._report_progress(base + sent, max(known_bytes, base + sent))
+                    
+            sent = self.file_sender._send_file_content(sock, f, relative, 0, size, checkpoint, throttle)
+            if sent < size:
+                raise IOError(f"文件读取提前结束: {relative}, 已发送 {sent}/{size} 字节")
+        return size
+
+
+def receive_tree(receiver, conn, addr, file_info):
+    """接收方处理目录树传输：在下载目录下重建目录结构，最后恢复目录的权限和修改时间"""
+    root_name = os.path.basename(file_info['root']) or 'folder'
+    root_path = receiver._unique_save_path(root_name)
+    try:
+        os.makedirs(root_path)
+    finally:
+        save_names.release(root_path)
+    binary = negotiated(file_info)
+    send_reply_message(conn, file_info, {'root': os.path.basename(root_path)})
+    print(f"开始接收目录: {root_name} -> {root_path}, 来自: {addr}")
+    
+    dirs = []
+    failed = []
+    received_files = 0
+    # 新建了目录项的目录，确认之前统一 fsync，每个目录只做一次
+    dirty_dirs = {receiver.download_dir}
+    while True:
+        header = recv_exact(conn, FRAME_HEADER.size)
+        if header is None:
+            raise ConnectionError(f"目录传输提前结束: {root_name}")
+        frame_type, meta_length = FRAME_HEADER.unpack(header)
+        meta_data = recv_exact(conn, meta_length)
+        if meta_data is None:
+            raise ConnectionError(f"目录传输提前结束: {root_name}")
+        meta = decode_meta(meta_data, binary)
+        
+        if frame_type == FRAME_END:
+            break
+        elif frame_type == FRAME_DIR:
+            for relative, mode, mtime_ns in meta['dirs']:
+                target = _safe_join(root_path, relative)
+                os.makedirs(target, exist_ok=True)
+                dirs.append((target, mode, mtime_ns))
+                dirty_dirs.add(os.path.dirname(target))
+        elif frame_type == FRAME_BATCH:
+            total = sum(entry[1] for entry in meta['files'])
+            if total > MAX_BATCH_BYTES:
+                raise ValueError(f"批量帧过大: {total} bytes")
+            data = memoryview(bytearray(total))
+            metrics = transfer_metrics('receive', conn)
+            if recv_into_exact(conn, data, metrics.io_calls('recv')) < total:
+                raise ConnectionError(f"目录传输提前结束: {root_name}")
+            metrics.bytes.inc(total)
+            offset = 0
+            pending = []
+            for relative, size, mode, mtime_ns in meta['files']:
+                chunk = data[offset:offset + size]
+                offset += size
+                if not _write_tree_file(root_path, relative, size, mode, mtime_ns,
+                                        lambda fd, chunk=chunk: write_buffers(fd, [chunk]), pending):
+                    failed.append(relative)
+            commit_failed = _commit_tree_files(pending, dirty_dirs)
+            received_files += len(pending) - len(commit_failed)
+            failed.extend(commit_failed)
+        elif frame_type == FRAME_FILE:
+            size = meta['size']
+            
+            def receive(fd):
+                received = receiver._receive_file_content(conn, fd, size)
+                if received < size:
+                    raise ConnectionError(f"目录传输提前结束: {meta['path']}")
+                    
+            # 大文件的数据必须读完，否则连接无法继续使用，因此写入失败直接结束传输
+            pending = []
+            _write_tree_file(root_path, meta['path'], size, meta['mode'], meta['mtime'], receive, pending,
+                             strict=True)
+            commit_failed = _commit_tree_files(pending, dirty_dirs)
+            received_files += 1 - len(commit_failed)
+            failed.extend(commit_failed)
+        else:
+            raise ValueError(f"未知的目录传输帧类型: {frame_type!r}")
+            
+    # 写入文件会改变目录的修改时间，所以目录属性最后按从深到浅的顺序恢复
+    for target, mode, mtime_ns in reversed(dirs):
+        try:
+            os.chmod(target, mode & PERMISSION_MASK)
+            os.utime(target, ns=(mtime_ns, mtime_ns))
+        except OSError as e:
+            print(f"无法恢复目录属性: {target}, {e}")
+    if DURABLE_COMMIT:
+        for directory in sorted(dirty_dirs, reverse=True):
+            sync_directory(directory)
+            
+    send_json_message(conn, {'files': received_files, 'failed': failed}, binary)
+    print(f"\n目录接收完成: {root_path}, 共 {received_files} 个文件, 失败 {len(failed)} 个")
+
+
+def _safe_join(root_path, relative):
+    """把发送方提供的相对路径转换为 root_path 下的本地路径，拒绝越出根目录的路径"""
+    parts = relative.split('/')
+    if not relative or any(part in ('', '.', '..') or os.sep in part or (os.altsep and os.altsep in part)
+                           for part in parts):
+        raise ValueError(f"无效的相对路径: {relative!r}")
+    return os.path.join(root_path, *parts)
+
+
+def _write_tree_file(root_path, relative, size, mode, mtime_ns, write, pending, strict=False):
+    """把目录树中的一个文件写入 .part 文件并加入 pending 等待 _commit_tree_files 提交，成功返回 True
+    
+    write(fd) 负责写入数据；strict 为 False 时本地写入失败只记录，不中断传输
+    """
+    target = _safe_join(root_path, relative)
+    directory = os.path.dirname(target)
+    partial = None
+    try:
+        os.makedirs(directory, exist_ok=True)
+        partial = PartialFile(directory, os.path.basename(target), size)
+        partial.open()
+        write(partial.fd)
+        pending.append((relative, target, mode, mtime_ns, partial))
+        return True
+    except OSError as e:
+        files_total('receive', 'failed').inc()
+        if partial:
+            partial.suspend(0)
+        if strict:
+            raise
+        print(f"保存文件失败: {relative}, {e}")
+        return False
+    except Exception:
+        if partial:
+            partial.suspend(0)
+        raise
+
+
+def _commit_tree_files(pending, dirty_dirs):
+    """一起 fsync 已写入的文件，再逐个重命名为最终文件并恢复权限和修改时间，返回失败的相对路径列表
+    
+    文件所在目录加入 dirty_dirs，整个目录树接收完成后统一 fsync
+    """
+    failed = []
+    try:
+        sync_partials([entry[4] for entry in pending])
+    except OSError as e:
+        print(f"保存文件失败: {e}")
+        for relative, _, _, _, partial in pending:
+            files_total('receive', 'failed').inc()
+            partial.suspend(0)
+            failed.append(relative)
+        return failed
+        
+    for relative, target, mode, mtime_ns, partial in pending:
+        try:
+            partial.commit(target, sync=False)
+            dirty_dirs.add(os.path.dirname(target))
+            os.chmod(target, mode & PERMISSION_MASK)
+            os.utime(target, ns=(mtime_ns, mtime_ns))
+            files_total('receive', 'ok').inc()
+        except OSError as e:
+            print(f"保存文件失败: {relative}, {e}")
+            files_total('receive', 'failed').inc()
+            partial.suspend(0)
+            failed.append(relative)
+    return failed
\ No newline at end of file
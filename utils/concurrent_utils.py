@@ -1,94 +1,336 @@
 # utils/concurrent_utils.py
 import threading
-import queue
 import time
+import heapq
+import random
+import collections
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from config import (SCHEDULER_MAX_CONCURRENT, SCHEDULER_PER_PEER, SCHEDULER_MAX_RETRIES, SCHEDULER_BACKOFF_BASE,
+                    SCHEDULER_BACKOFF_MAX, TASK_HISTORY_LIMIT)
+
 
 class TaskManager:
     """任务管理器，用于处理并发任务"""
     
-    def __init__(self, max_workers=5):
+    def __init__(self, max_workers=5, history_limit=None):
         self.max_workers = max_workers
         self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # 未完成的任务 {task_id: future}，完成后移入 finished
         self.futures = {}
+        # 最近完成的任务，最多保留 history_limit 个，避免长期运行时无限增长
+        self.finished = collections.OrderedDict()
+        self.history_limit = history_limit or TASK_HISTORY_LIMIT
         self.task_counter = 0
+        self.lock = threading.Lock()
         
     def submit_task(self, func, *args, **kwargs):
         """提交任务到线程池"""
-        future = self.executor.submit(func, *args, **kwargs)
-        task_id = self.task_counter
-        self.futures[task_id] = future
-        self.task_counter += 1
+        with self.lock:
+            task_id = self.task_counter
+            self.task_counter += 1
+            future = self.executor.submit(func, *args, **kwargs)
+            self.futures[task_id] = future
+        future.add_done_callback(lambda f: self._task_finished(task_id))
         return task_id
         
     def get_result(self, task_id):
         """获取任务结果"""
-        if task_id in self.futures:
-            return self.futures[task_id].result()
+        future = self._get_future(task_id)
+        if future is not None:
+            return future.result()
         return None
         
     def is_task_done(self, task_id):
         """检查任务是否完成"""
-        if task_id in self.futures:
-            return self.futures[task_id].done()
+        future = self._get_future(task_id)
+        if future is not None:
+            return future.done()
         return False
         
     def cancel_task(self, task_id):
         """取消任务"""
-        if task_id in self.futures:
-            return self.futures[task_id].cancel()
+        future = self._get_future(task_id)
+        if future is not None:
+            return future.cancel()
         return False
         
     def get_active_tasks_count(self):
         """获取活跃任务数量"""
-        count = 0
-        for future in self.futures.values():
-            if not future.done():
-                count += 1
-        return count
+        with self.lock:
+            return len(self.futures)
         
     def shutdown(self, wait=True):
         """关闭任务管理器"""
         self.executor.shutdown(wait=wait)
         
+    def _get_future(self, task_id):
+        """查找未完成或最近完成的任务"""
+        with self.lock:
+            return self.futures.get(task_id) or self.finished.get(task_id)
+            
+    def _task_finished(self, task_id):
+        """任务完成回调：移出活跃任务表，并淘汰最旧的完成记录"""
+        with self.lock:
+            future = self.futures.pop(task_id, None)
+            if future is None:
+                return
+            self.finished[task_id] = future
+            while len(self.finished) > self.history_limit:
+                self.finished.popitem(last=False)
+
 
 class TransferQueue:
-    """文件传输队列，管理待传输的文件"""
+    """文件传输队列，管理待传输的文件
+    
+    按优先级（数值越小越优先）取任务，同一优先级内在不同目标设备之间轮转，
+    避免一个目标的大量任务饿死其他目标。
+    """
     
     def __init__(self):
-        self.queue = queue.Queue()
+        # {优先级: OrderedDict{(ip, port): deque[任务]}}
+        self.queue = {}
+        self.size = 0
+        self.task_counter = 0
         self.lock = threading.Lock()
         
-    def add_transfer_task(self, file_path, target_ip, target_port=50002):
+    def add_transfer_task(self, file_path, target_ip, target_port=50002, priority=0, options=None):
         """添加传输任务"""
-        task = {
-            'file_path': file_path,
-            'target_ip': target_ip,
-            'target_port': target_port,
-            'status': 'pending',  # pending, in_progress, completed, failed
-            'progress': 0,
-            'timestamp': time.time()
-        }
-        
         with self.lock:
-            self.queue.put(task)
+            task = {
+                'id': self.task_counter,
+                'file_path': file_path,
+                'target_ip': target_ip,
+                'target_port': target_port,
+                'priority': priority,
+                'options': options or {},
+                'status': 'pending',  # pending, in_progress, completed, failed, cancelled
+                'progress': 0,
+                'attempts': 0,
+                'error': None,
+                'timestamp': time.time()
+            }
+            self.task_counter += 1
+        self.put_task(task)
         return task
         
-    def get_next_task(self):
-        """获取下一个任务"""
-        try:
-            with self.lock:
-                if not self.queue.empty():
-                    return self.queue.get_nowait()
-                return None
-        except queue.Empty:
+    def put_task(self, task):
+        """把任务（包括需要重试的任务）放回队列"""
+        with self.lock:
+            targets = self.queue.setdefault(task['priority'], collections.OrderedDict())
+            targets.setdefault((task['target_ip'], task['target_port']), collections.deque()).append(task)
+            self.size += 1
+            
+    def get_next_task(self, busy_targets=()):
+        """获取下一个任务，跳过 busy_targets 中的目标（已达到单设备并发上限）"""
+        with self.lock:
+            for priority in sorted(self.queue):
+                targets = self.queue[priority]
+                for target in list(targets):
+                    if target in busy_targets:
+                        continue
+                    tasks = targets[target]
+                    task = tasks.popleft()
+                    if tasks:
+                        # 轮转：本目标移到队尾
+                        targets.move_to_end(target)
+                    else:
+                        del targets[target]
+                    if not targets:
+                        del self.queue[priority]
+                    self.size -= 1
+                    return task
             return None
             
+    def remove_task(self, task):
+        """从队列中移除尚未开始的任务，成功时返回 True"""
+        with self.lock:
+            targets = self.queue.get(task['priority'], {})
+            tasks = targets.get((task['target_ip'], task['target_port']))
+            if not tasks or task not in tasks:
+                return False
+            tasks.remove(task)
+            if not tasks:
+                del targets[(task['target_ip'], task['target_port'])]
+            if not targets:
+                del self.queue[task['priority']]
+            self.size -= 1
+            return True
+            
     def get_queue_size(self):
         """获取队列大小"""
-        return self.queue.qsize()
+        return self.size
         
     def is_empty(self):
         """检查队列是否为空"""
-        return self.queue.empty()
\ No newline at end of file
+        return self.size == 0
+
+
+class PartialTransferError(Exception):
+    """传输本身完成了，但其中部分文件失败（目录传输）"""
+    pass
+
+
+class TransferScheduler:
+    """传输调度器：在全局和单设备并发上限内执行 TransferQueue 中的任务，失败时按指数退避重试
+    
+    send_func(task) 执行一次传输，抛出异常表示失败；返回带非空 'failed' 列表的汇总（目录传输）表示部分文件失败，
+    任务记为失败但不重试（重试会把整个目录再发送一份）。不依赖界面，可以在命令行或后台服务中使用。
+    on_task_done(task) 在任务最终完成、失败或取消时从工作线程中调用。
+    """
+    
+    # 重试也不会成功的错误
+    NON_RETRYABLE = (FileNotFoundError, PermissionError, IsADirectoryError, PartialTransferError)
+    
+    def __init__(self, send_func, max_concurrent=None, per_peer=None, max_retries=None, on_task_done=None):
+        self.send_func = send_func
+        self.max_concurrent = max_concurrent or SCHEDULER_MAX_CONCURRENT
+        self.per_peer = per_peer or SCHEDULER_PER_PEER
+        self.max_retries = SCHEDULER_MAX_RETRIES if max_retries is None else max_retries
+        self.on_task_done = on_task_done
+        self.transfer_queue = TransferQueue()
+        self.task_manager = TaskManager(max_workers=self.max_concurrent)
+        # 等待退避时间到达的重试任务 [(可重试时间, 任务ID, 任务)]
+        self.delayed = []
+        self.active = 0
+        self.active_per_peer = collections.Counter()
+        self.unfinished = 0
+        self.condition = threading.Condition()
+        self.running = True
+        self.dispatch_thread = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self.dispatch_thread.start()
+        
+    def submit(self, file_path, target_ip, target_port=50002, priority=0, **options):
+        """提交传输任务，返回任务字典（status/progress/error 字段会随传输更新）"""
+        task = self.transfer_queue.add_transfer_task(file_path, target_ip, target_port, priority, options)
+        with self.condition:
+            self.unfinished += 1
+            self.condition.notify_all()
+            # 调度器已关闭时任务不会再被执行
+            cancelled = not self.running and self.transfer_queue.remove_task(task)
+        if cancelled:
+            self._finish(task, 'cancelled')
+        return task
+        
+    def cancel(self, task):
+        """取消任务：排队中的任务直接移除，进行中的任务在下一个检查点中断"""
+        with self.condition:
+            task['cancel_requested'] = True
+            if task['status'] != 'pending':
+                return
+            if self.transfer_queue.remove_task(task):
+                pass
+            elif any(entry[2] is task for entry in self.delayed):
+                self.delayed = [entry for entry in self.delayed if entry[2] is not task]
+                heapq.heapify(self.delayed)
+            else:
+                return
+        self._finish(task, 'cancelled')
+        
+    def wait(self, timeout=None):
+        """等待所有已提交的任务结束，超时返回 False"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.unfinished == 0, timeout)
+            
+    def shutdown(self, wait=True):
+        """停止调度：排队中和等待重试的任务记为取消，wait 为 True 时等待进行中的任务结束"""
+        with self.condition:
+            self.running = False
+            pending = [entry[2] for entry in self.delayed]
+            self.delayed = []
+            while True:
+                task = self.transfer_queue.get_next_task()
+                if task is None:
+                    break
+                pending.append(task)
+            self.condition.notify_all()
+        for task in pending:
+            self._finish(task, 'cancelled')
+        self.dispatch_thread.join()
+        self.task_manager.shutdown(wait=wait)
+        
+    def get_stats(self):
+        """获取调度器状态"""
+        with self.condition:
+            return {
+                'active': self.active,
+                'queued': self.transfer_queue.get_queue_size(),
+                'retrying': len(self.delayed),
+                'per_peer': dict(self.active_per_peer)
+            }
+            
+    def _dispatch_loop(self):
+        """调度线程：有空闲名额时取出符合单设备上限的任务交给线程池"""
+        with self.condition:
+            while self.running:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    self.transfer_queue.put_task(heapq.heappop(self.delayed)[2])
+                    
+                task = None
+                if self.active < self.max_concurrent:
+                    busy = {target for target, count in self.active_per_peer.items() if count >= self.per_peer}
+                    task = self.transfer_queue.get_next_task(busy)
+                if task is None:
+                    timeout = self.delayed[0][0] - now if self.delayed else None
+                    self.condition.wait(timeout)
+                    continue
+                    
+                target = (task['target_ip'], task['target_port'])
+                self.active += 1
+                self.active_per_peer[target] += 1
+                task['status'] = 'in_progress'
+                task['attempts'] += 1
+                self.task_manager.submit_task(self._run_task, task)
+        
+    def _run_task(self, task):
+        """工作线程：执行一次传输并决定完成、重试或失败"""
+        error = None
+        try:
+            task['result'] = self.send_func(task)
+        except Exception as e:
+            error = e
+        else:
+            failed = task['result'].get('failed') if isinstance(task['result'], dict) else None
+            if failed:
+                error = PartialTransferError(f"{len(failed)} 个文件发送失败: {', '.join(failed[:5])}")
+            
+        target = (task['target_ip'], task['target_port'])
+        with self.condition:
+            self.active -= 1
+            self.active_per_peer[target] -= 1
+            if not self.active_per_peer[target]:
+                del self.active_per_peer[target]
+            self.condition.notify_all()
+            
+            if error is not None and self.running and not task.get('cancel_requested') \
+                    and not isinstance(error, self.NON_RETRYABLE) and task['attempts'] <= self.max_retries:
+                # 指数退避加随机抖动，避免多个任务同时重试
+                delay = min(SCHEDULER_BACKOFF_MAX, SCHEDULER_BACKOFF_BASE * 2 ** (task['attempts'] - 1))
+                delay *= random.uniform(0.5, 1.0)
+                task['status'] = 'pending'
+                task['error'] = str(error)
+                print(f"传输失败，{delay:.1f} 秒后重试 ({task['attempts']}/{self.max_retries}): {task['file_path']}, {error}")
+                heapq.heappush(self.delayed, (time.monotonic() + delay, task['id'], task))
+                return
+                
+        if error is None:
+            self._finish(task, 'completed')
+        elif task.get('cancel_requested'):
+            self._finish(task, 'cancelled', error)
+        else:
+            self._finish(task, 'failed', error)
+            
+    def _finish(self, task, status, error=None):
+        """记录任务最终状态并通知等待者"""
+        task['status'] = status
+        if error is not None:
+            task['error'] = str(error)
+        if self.on_task_done:
+            try:
+                self.on_task_done(task)
+            except Exception as e:
+                print(f"任务完成回调出错: {e}")
+        with self.condition:
+            self.unfinished -= 1
+            self.condition.notify_all()
\ No newline at end of file
@@ -0,0 +1,102 @@
+# utils/dnssd.py
+import socket
+
+from config import DISCOVERY_DNSSD, DISCOVERY_DNSSD_SERVICE, LOCAL_HOSTNAME
+
+# 可选的第三方库，安装了才启用 DNS-SD(mDNS) 发布和浏览
+try:
+    from zeroconf import Zeroconf, ServiceInfo, ServiceBrowser
+except ImportError:
+    Zeroconf = None
+
+
+def dnssd_enabled():
+    """配置启用了 DNS-SD 并且安装了 zeroconf"""
+    return DISCOVERY_DNSSD and Zeroconf is not None
+
+
+def _service_name(instance):
+    """DNS-SD 服务实例名，带上实例ID避免同名主机冲突"""
+    return f"{LOCAL_HOSTNAME}-{instance}.{DISCOVERY_DNSSD_SERVICE}"
+
+
+class DnsSdAdvertiser:
+    """在 mDNS 上发布本机的文件接收服务，TXT 记录中包含主机名、实例ID和能力列表"""
+    
+    def __init__(self, listen_port, addresses, capabilities, instance):
+        self.info = ServiceInfo(
+            DISCOVERY_DNSSD_SERVICE,
+            _service_name(instance),
+            port=listen_port,
+            addresses=[socket.inet_aton(address) for address in addresses],
+            properties={
+                'hostname': LOCAL_HOSTNAME,
+                'instance': instance,
+                'capabilities': ','.join(capabilities)
+            },
+            server=f"{LOCAL_HOSTNAME}.local."
+        )
+        self.zeroconf = None
+        
+    def start(self):
+        """发布服务"""
+        self.zeroconf = Zeroconf()
+        self.zeroconf.register_service(self.info)
+        
+    def stop(self):
+        """撤销服务并关闭 mDNS"""
+        if self.zeroconf:
+            self.zeroconf.unregister_service(self.info)
+            self.zeroconf.close()
+            self.zeroconf = None
+
+
+class DnsSdBrowser:
+    """浏览 mDNS 上的文件接收服务，把发现的设备写入设备表，服务撤销时从设备表中移除"""
+    
+    def __init__(self, peer_table, instance):
+        self.peer_table = peer_table
+        self.instance = instance
+        self.zeroconf = None
+        self.browser = None
+        # {'服务实例名': 'ip'}
+        self.services = {}
+        
+    def start(self):
+        """开始浏览"""
+        self.zeroconf = Zeroconf()
+        self.browser = ServiceBrowser(self.zeroconf, DISCOVERY_DNSSD_SERVICE, listener=self)
+        
+    def stop(self):
+        """停止浏览"""
+        if self.zeroconf:
+            self.browser.cancel()
+            self.zeroconf.close()
+            self.zeroconf = None
+        
+    # 以下三个方法是 zeroconf 的 ServiceListener 接口，在 zeroconf 的线程中调用
+    def add_service(self, zeroconf, service_type, name):
+        """发现或更新了一个服务，解析出地址后写入设备表"""
+        info = zeroconf.get_service_info(service_type, name)
+        if info is None:
+            return
+        properties = {key.decode('utf-8'): (value or b'').decode('utf-8')
+                      for key, value in info.properties.items()}
+        if properties.get('instance') == self.instance:
+            return
+        addresses = [address for address in info.parsed_addresses() if ':' not in address]
+        if not addresses:
+            return
+        capabilities = [item for item in properties.get('capabilities', '').split(',') if item]
+        self.services[name] = addresses[0]
+        self.peer_table.update(addresses[0], properties.get('hostname', 'Unknown'), info.port, capabilities)
+        
+    def update_service(self, zeroconf, service_type, name):
+        """服务记录变化"""
+        self.add_service(zeroconf, service_type, name)
+        
+    def remove_service(self, zeroconf, service_type, name):
+        """服务被撤销"""
+        ip = self.services.pop(name, None)
+        if ip:
+            self.peer_table.remove(ip)
\ No newline at end of file
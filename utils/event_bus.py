@@ -0,0 +1,72 @@
+# utils/event_bus.py
+import collections
+
+
+class UIEventBus:
+    """工作线程向界面线程传递事件的队列
+    
+    publish 可以在任意线程调用，只做一次 deque.append（线程安全，不加锁）；
+    界面线程通过 attach 以固定帧率用 root.after 取出事件并分发给订阅者。
+    带 coalesce_key 的事件在同一帧内只保留最新的一条，例如每个传输的进度。
+    """
+    
+    def __init__(self):
+        self.events = collections.deque()
+        self.handlers = collections.defaultdict(list)
+        self.root = None
+        self.interval = None
+        self.after_id = None
+        
+    def publish(self, event_type, coalesce_key=None, **data):
+        """发布事件（线程安全）"""
+        self.events.append((event_type, coalesce_key, data))
+        
+    def subscribe(self, event_type, handler):
+        """订阅事件，handler(**data) 在界面线程中调用"""
+        self.handlers[event_type].append(handler)
+        
+    def drain(self):
+        """取出当前所有事件，合并同一 coalesce_key 的事件，按最后一次出现的顺序返回 [(事件类型, 数据)]"""
+        pending = []
+        while True:
+            try:
+                pending.append(self.events.popleft())
+            except IndexError:
+                break
+                
+        latest = {}
+        for index, (event_type, key, _) in enumerate(pending):
+            if key is not None:
+                latest[(event_type, key)] = index
+        return [(event_type, data) for index, (event_type, key, data) in enumerate(pending)
+                if key is None or latest[(event_type, key)] == index]
+        
+    def dispatch(self):
+        """分发当前所有事件（在界面线程中调用），返回分发的事件数"""
+        events = self.drain()
+        for event_type, data in events:
+            for handler in self.handlers.get(event_type, []):
+                try:
+                    handler(**data)
+                except Exception as e:
+                    print(f"处理界面事件 {event_type} 时出错: {e}")
+        return len(events)
+        
+    def attach(self, root, fps):
+        """在 Tk 主循环中以 fps 帧率分发事件"""
+        self.root = root
+        self.interval = max(1, int(1000 / fps))
+        self.after_id = self.root.after(self.interval, self._tick)
+        
+    def detach(self):
+        """停止分发"""
+        if self.root and self.after_id:
+            self.root.after_cancel(self.after_id)
+        self.root = None
+        self.after_id = None
+        
+    def _tick(self):
+        """每帧分发一次事件"""
+        self.dispatch()
+        if self.root:
+            self.after_id = self.root.after(self.interval, self._tick)
\ No newline at end of file
@@ -0,0 +1,143 @@
+# utils/interfaces.py
+import socket
+import struct
+import ipaddress
+
+# 可选的第三方库，安装了就用它枚举网卡（支持 Windows/macOS 以及一块网卡上的多个地址）
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Linux 网卡 ioctl 请求号和标志位
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFBRDADDR = 0x8919
+SIOCGIFNETMASK = 0x891b
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+
+
+def list_interfaces(include_loopback=False):
+    """枚举本机已启用网卡上的地址
+    
+    返回 [{'name', 'index', 'family', 'address', 'netmask', 'broadcast'}]，每个地址一项；
+    family 为 socket.AF_INET 或 socket.AF_INET6，IPv6 地址没有 netmask/broadcast。
+    依次尝试 psutil、Linux ioctl，都不可用时退回到主机名解析出的IPv4地址（没有子网信息）。
+    """
+    for source in (_psutil_interfaces, _linux_interfaces):
+        try:
+            interfaces = source()
+        except (OSError, ImportError):
+            continue
+        if interfaces is not None:
+            break
+    else:
+        interfaces = _fallback_interfaces()
+        
+    if not include_loopback:
+        interfaces = [item for item in interfaces if not ipaddress.ip_address(item['address']).is_loopback]
+    return interfaces
+
+
+def directed_broadcast(address, netmask):
+    """计算地址所在子网的定向广播地址，/31 和 /32 没有广播地址时返回 None"""
+    network = ipaddress.IPv4Network(f"{address}/{netmask}", strict=False)
+    if network.prefixlen >= 31:
+        return None
+    return str(network.broadcast_address)
+
+
+def _interface_index(name):
+    """网卡序号，IPv6 组播需要用它指定网卡"""
+    try:
+        return socket.if_nametoindex(name)
+    except (OSError, AttributeError):
+        return 0
+
+
+def _entry(name, family, address, netmask=None, broadcast=None, index=None):
+    """构造一项网卡地址"""
+    if family == socket.AF_INET and netmask and not broadcast:
+        broadcast = directed_broadcast(address, netmask)
+    return {
+        'name': name,
+        'index': index if index is not None else _interface_index(name),
+        'family': family,
+        'address': address,
+        'netmask': netmask,
+        'broadcast': broadcast
+    }
+
+
+def _psutil_interfaces():
+    """通过 psutil 枚举网卡，未安装时返回 None"""
+    if psutil is None:
+        return None
+    stats = psutil.net_if_stats()
+    interfaces = []
+    for name, addresses in psutil.net_if_addrs().items():
+        if name in stats and not stats[name].isup:
+            continue
+        for addr in addresses:
+            if addr.family == socket.AF_INET:
+                interfaces.append(_entry(name, socket.AF_INET, addr.address, addr.netmask, addr.broadcast))
+            elif addr.family == socket.AF_INET6:
+                # 链路本地地址带有 %网卡 后缀
+                interfaces.append(_entry(name, socket.AF_INET6, addr.address.split('%')[0]))
+    return interfaces
+
+
+def _linux_interfaces():
+    """通过 ioctl 和 /proc/net/if_inet6 枚举 Linux 网卡，非 Linux 系统返回 None"""
+    import fcntl
+    if not hasattr(socket, 'if_nameindex'):
+        return None
+        
+    interfaces = []
+    up_names = set()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for index, name in socket.if_nameindex():
+            request = struct.pack('256s', name[:15].encode('utf-8'))
+            flags = struct.unpack('H', fcntl.ioctl(sock.fileno(), SIOCGIFFLAGS, request)[16:18])[0]
+            if not flags & IFF_UP:
+                continue
+            up_names.add(name)
+            try:
+                address = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFADDR, request)[20:24])
+            except OSError:
+                # 网卡没有IPv4地址
+                continue
+            netmask = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFNETMASK, request)[20:24])
+            broadcast = None
+            if not flags & IFF_LOOPBACK:
+                try:
+                    broadcast = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFBRDADDR, request)[20:24])
+                except OSError:
+                    pass
+            interfaces.append(_entry(name, socket.AF_INET, address, netmask, broadcast, index))
+    finally:
+        sock.close()
+        
+    try:
+        with open('/proc/net/if_inet6', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 6 or fields[5] not in up_names:
+                    continue
+                address = str(ipaddress.IPv6Address(bytes.fromhex(fields[0])))
+                interfaces.append(_entry(fields[5], socket.AF_INET6, address, index=int(fields[1], 16)))
+    except OSError:
+        # 内核没有启用IPv6
+        pass
+    return interfaces
+
+
+def _fallback_interfaces():
+    """无法枚举网卡时，使用主机名解析出的IPv4地址"""
+    try:
+        addresses = socket.gethostbyname_ex(socket.gethostname())[2]
+    except OSError:
+        addresses = []
+    return [_entry('', socket.AF_INET, address, index=0) for address in addresses]
\ No newline at end of file
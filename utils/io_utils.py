@@ -0,0 +1,330 @@
+# utils/io_utils.py
+import os
+import mmap
+import errno
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BufferPool:
+    """固定容量的缓冲区池，复用 bytearray 以减少内存分配和GC开销"""
+    
+    def __init__(self, buffer_size, max_buffers):
+        self.buffer_size = buffer_size
+        self.max_buffers = max_buffers
+        self.free_buffers = []
+        self.created_count = 0
+        self.condition = threading.Condition()
+        
+    def acquire(self, count=1):
+        """获取指定数量的缓冲区，池耗尽时阻塞等待归还"""
+        count = max(1, min(count, self.max_buffers))
+        with self.condition:
+            while len(self.free_buffers) + (self.max_buffers - self.created_count) < count:
+                self.condition.wait()
+            buffers = []
+            while len(buffers) < count:
+                if self.free_buffers:
+                    buffers.append(self.free_buffers.pop())
+                else:
+                    # 按需创建，直到达到容量上限
+                    buffers.append(bytearray(self.buffer_size))
+                    self.created_count += 1
+            return buffers
+            
+    def release(self, buffers):
+        """归还缓冲区"""
+        with self.condition:
+            self.free_buffers.extend(buffers)
+            self.condition.notify_all()
+            
+    def get_stats(self):
+        """获取缓冲池使用情况"""
+        with self.condition:
+            return {
+                'buffer_size': self.buffer_size,
+                'created': self.created_count,
+                'free': len(self.free_buffers),
+                'max': self.max_buffers
+            }
+
+
+def recv_into_exact(conn, view, calls=None):
+    """循环调用 recv_into 直到填满 view，返回实际接收的字节数（连接关闭时可能不足）
+    
+    calls 为计数器（utils.metrics.Counter）时累加 recv_into 的调用次数
+    """
+    received = 0
+    size = len(view)
+    count = 0
+    while received < size:
+        n = conn.recv_into(view[received:], size - received)
+        count += 1
+        if n == 0:
+            break
+        received += n
+    if calls is not None:
+        calls.inc(count)
+    return received
+
+
+def preallocate_file(fd, size):
+    """为文件预分配磁盘空间，减少碎片，不支持时静默跳过"""
+    if size <= 0 or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+        return True
+    except OSError as e:
+        if e.errno in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+            return False
+        raise
+
+
+def write_buffers(fd, views, offset=None, use_vectored=True, calls=None):
+    """把多个缓冲区写入文件描述符，可用时使用 os.writev/os.pwritev 一次系统调用写出
+    
+    offset 为 None 时按文件当前位置顺序写入，否则使用 pwrite 写入指定偏移；
+    calls 为计数器时累加写入系统调用的次数
+    """
+    views = [v for v in views if len(v)]
+    vectored = os.writev if offset is None else getattr(os, 'pwritev', None)
+    if not use_vectored or vectored is None or not hasattr(os, 'writev'):
+        count = 0
+        for view in views:
+            offset, written_calls = _write_all(fd, view, offset)
+            count += written_calls
+        if calls is not None:
+            calls.inc(count)
+        return
+        
+    count = 0
+    while views:
+        count += 1
+        if offset is None:
+            written = os.writev(fd, views)
+        else:
+            written = os.pwritev(fd, views, offset)
+            offset += written
+        # 处理部分写入：跳过已完整写出的缓冲区，截断写了一半的缓冲区
+        while views and written >= len(views[0]):
+            written -= len(views[0])
+            views.pop(0)
+        if views and written:
+            views[0] = views[0][written:]
+    if calls is not None:
+        calls.inc(count)
+
+
+class DirectorySyncer:
+    """目录 fsync 的组提交：同一目录的并发请求合并为一次 fsync
+    
+    sync() 等待一次在调用之后才开始的 fsync 完成；正在执行的 fsync 结束前到达的请求
+    共用下一次 fsync，大量小文件同时完成时不会为每个文件各做一次目录 fsync
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {目录: _SyncState}，没有调用方等待时删除
+        self.states = {}
+        
+    def sync(self, directory):
+        """确保目录中在此之前完成的创建、重命名和删除已经落盘"""
+        with self.lock:
+            state = self.states.get(directory)
+            if state is None:
+                state = self.states[directory] = _SyncState(self.lock)
+            # 正在执行的那一轮可能开始于本次调用之前，需要等下一轮
+            target = state.started + 1
+            state.waiters += 1
+            try:
+                while state.finished < target:
+                    if state.running:
+                        state.condition.wait()
+                        continue
+                    state.started += 1
+                    round_number = state.started
+                    state.running = True
+                    self.lock.release()
+                    try:
+                        _fsync_directory(directory)
+                        succeeded = True
+                    finally:
+                        self.lock.acquire()
+                        state.running = False
+                        state.condition.notify_all()
+                    # 失败时不更新完成的轮次，其他等待者会自己再试一次
+                    if succeeded:
+                        state.finished = round_number
+            finally:
+                state.waiters -= 1
+                if state.waiters == 0:
+                    self.states.pop(directory, None)
+
+
+class _SyncState:
+    """一个目录的 fsync 组提交状态"""
+    
+    def __init__(self, lock):
+        self.started = 0
+        self.finished = 0
+        self.running = False
+        self.waiters = 0
+        self.condition = threading.Condition(lock)
+
+
+def _fsync_directory(directory):
+    """fsync 目录，不支持打开目录的平台（Windows）上静默跳过"""
+    try:
+        fd = os.open(directory, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        if e.errno not in (errno.EINVAL, errno.EBADF):
+            raise
+    finally:
+        os.close(fd)
+
+
+# 进程内共用的目录 fsync 组提交
+_directory_syncer = DirectorySyncer()
+
+# 批量 fsync 使用的线程池，首次使用时创建
+_fsync_executor = None
+_fsync_lock = threading.Lock()
+
+
+def sync_directory(directory):
+    """fsync 目录，并发调用合并为一次（见 DirectorySyncer）"""
+    _directory_syncer.sync(directory)
+
+
+def fsync_all(fds, max_workers):
+    """并发 fsync 多个文件：同时到达的 fsync 由文件系统合并到同一次日志提交，比逐个 fsync 快得多"""
+    global _fsync_executor
+    if len(fds) <= 1:
+        for fd in fds:
+            os.fsync(fd)
+        return
+    with _fsync_lock:
+        if _fsync_executor is None:
+            _fsync_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fsync')
+    for _ in _fsync_executor.map(os.fsync, fds):
+        pass
+
+
+class MappedWriter:
+    """把文件的 [offset, offset+length) 区间映射到内存，接收方直接 recv_into 映射的切片
+    
+    后台线程在写入量每超过 watermark 字节时用 msync 把这部分数据刷到磁盘，并把刷完的页面
+    移出页面缓存；未刷盘的数据超过 max_dirty 字节时 advance() 阻塞等待，限制脏页数量。
+    close() 刷完剩余数据并 fdatasync 后返回。文件必须已经扩展到至少 offset+length 字节，
+    并且最好已经预分配空间：磁盘写满时写入映射会触发 SIGBUS 而不是 OSError。
+    """
+    
+    def __init__(self, fd, offset, length, watermark, max_dirty, calls=None):
+        self.fd = fd
+        # mmap 的偏移必须按 ALLOCATIONGRANULARITY 对齐，start 为区间在映射中的起点
+        self.base = offset - offset % mmap.ALLOCATIONGRANULARITY
+        self.start = offset - self.base
+        self.mapping = mmap.mmap(fd, self.start + length, offset=self.base)
+        self.view = memoryview(self.mapping)
+        self.watermark = max(watermark, mmap.PAGESIZE)
+        self.max_dirty = max(max_dirty, self.watermark)
+        self.calls = calls
+        # 以下位置都相对于区间起点：已写入、已请求刷盘、已刷盘
+        self.written = 0
+        self.requested = 0
+        self.flushed = 0
+        self.error = None
+        self.closing = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self.thread.start()
+        
+    def region(self, position, size):
+        """区间内从 position 开始、size 字节的可写切片"""
+        return self.view[self.start + position:self.start + position + size]
+        
+    def advance(self, written):
+        """记录区间内已写入到 written，达到水位时请求刷盘，脏数据过多时等待后台线程"""
+        with self.condition:
+            self.written = written
+            if written - self.requested >= self.watermark:
+                self.requested = written
+                self.condition.notify_all()
+            while written - self.flushed > self.max_dirty and self.error is None:
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+        
+    def close(self):
+        """刷完所有已写入的数据、fdatasync 并解除映射，刷盘出错时抛出异常"""
+        with self.condition:
+            self.requested = self.written
+            self.closing = True
+            self.condition.notify_all()
+        self.thread.join()
+        try:
+            if self.error is None:
+                if hasattr(os, 'fdatasync'):
+                    os.fdatasync(self.fd)
+                else:
+                    os.fsync(self.fd)
+        finally:
+            self.view.release()
+            self.mapping.close()
+        if self.error is not None:
+            raise self.error
+        
+    def _flush_loop(self):
+        """后台线程：按请求的位置依次 msync，完成后释放对应的页面缓存"""
+        while True:
+            with self.condition:
+                while self.requested <= self.flushed and not self.closing:
+                    self.condition.wait()
+                if self.requested <= self.flushed:
+                    return
+                begin, end = self.flushed, self.requested
+            try:
+                self._flush_range(begin, end)
+            except OSError as e:
+                with self.condition:
+                    self.error = e
+                    self.condition.notify_all()
+                return
+            with self.condition:
+                self.flushed = end
+                self.condition.notify_all()
+        
+    def _flush_range(self, begin, end):
+        """msync 区间 [begin, end)，然后把其中完整的页面移出映射和页面缓存"""
+        page = mmap.PAGESIZE
+        first = (self.start + begin) // page * page
+        last = self.start + end
+        self.mapping.flush(first, last - first)
+        if self.calls is not None:
+            self.calls.inc()
+        # 只释放完整的页面，最后一页可能还会继续写入
+        drop_end = last // page * page
+        if drop_end > first:
+            if hasattr(self.mapping, 'madvise'):
+                self.mapping.madvise(mmap.MADV_DONTNEED, first, drop_end - first)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(self.fd, self.base + first, drop_end - first, os.POSIX_FADV_DONTNEED)
+
+
+def _write_all(fd, view, offset=None):
+    """循环写入直到整个缓冲区写出，返回 (写入后的偏移, 系统调用次数)"""
+    count = 0
+    while len(view):
+        if offset is None:
+            written = os.write(fd, view)
+        else:
+            written = os.pwrite(fd, view, offset)
+            offset += written
+        view = view[written:]
+        count += 1
+    return offset, count
\ No newline at end of file
@@ -0,0 +1,401 @@
+# utils/metrics.py
+import json
+import math
+import time
+import bisect
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import METRICS_RATE_WINDOW, PROGRESS_PRINT_INTERVAL
+
+# 延迟直方图的桶上限（秒）
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+
+class Counter:
+    """只增不减的计数器"""
+    
+    kind = 'counter'
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+        
+    def inc(self, amount=1):
+        """增加计数"""
+        with self.lock:
+            self.value += amount
+        
+    def get(self):
+        """当前值"""
+        return self.value
+
+
+class Gauge:
+    """可增可减的当前值；设置了 function 时在读取时调用它取值，热路径上没有任何开销"""
+    
+    kind = 'gauge'
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+        self.function = None
+        
+    def set(self, value):
+        """设置当前值"""
+        self.value = value
+        
+    def inc(self, amount=1):
+        """增加当前值"""
+        with self.lock:
+            self.value += amount
+        
+    def dec(self, amount=1):
+        """减少当前值"""
+        self.inc(-amount)
+        
+    def set_function(self, function):
+        """读取时调用 function() 取值，例如队列长度"""
+        self.function = function
+        
+    @contextlib.contextmanager
+    def track(self):
+        """在 with 块执行期间加一，例如统计活动连接数"""
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+        
+    def get(self):
+        """当前值，取值函数出错时返回 NaN"""
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return math.nan
+        return self.value
+
+
+class Histogram:
+    """固定桶的直方图，记录一次观测只做一次二分查找和加法"""
+    
+    kind = 'histogram'
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        
+    def observe(self, value):
+        """记录一次观测值"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+        
+    @contextlib.contextmanager
+    def time(self):
+        """记录 with 块的执行时间"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+        
+    def get(self):
+        """返回 {'count', 'sum', 'buckets': [(上限, 累计次数), ...], 'p50', 'p95', 'p99'}"""
+        with self.lock:
+            counts = list(self.counts)
+            total = self.count
+            value_sum = self.sum
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            running += count
+            cumulative.append((bound, running))
+        return {
+            'count': total,
+            'sum': value_sum,
+            'buckets': cumulative,
+            'p50': self._quantile(cumulative, total, 0.50),
+            'p95': self._quantile(cumulative, total, 0.95),
+            'p99': self._quantile(cumulative, total, 0.99),
+        }
+        
+    def _quantile(self, cumulative, total, q):
+        """按桶内线性插值估算分位数，落在最后一个桶时返回最大的有限上限"""
+        if not total:
+            return 0.0
+        rank = q * total
+        lower_bound, lower_count = 0.0, 0
+        for bound, count in cumulative:
+            if count >= rank:
+                if math.isinf(bound):
+                    return lower_bound
+                return lower_bound + (bound - lower_bound) * (rank - lower_count) / max(1, count - lower_count)
+            lower_bound, lower_count = bound, count
+        return lower_bound
+
+
+class MetricsRegistry:
+    """进程内的指标集合，按 (名称, 标签) 区分不同的序列
+    
+    热路径应先用 counter()/gauge()/histogram() 取得指标对象并保存下来，之后只调用 inc/observe。
+    计数器的速率（每秒）在生成快照时按与上一次采样的差值计算，采样间隔至少 METRICS_RATE_WINDOW 秒。
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.help = {}
+        self.samples = {}
+        self.created = time.time()
+        
+    def counter(self, name, help_text='', **labels):
+        """获取（必要时创建）计数器"""
+        return self._get(Counter, name, help_text, labels)
+        
+    def gauge(self, name, help_text='', **labels):
+        """获取（必要时创建）当前值指标"""
+        return self._get(Gauge, name, help_text, labels)
+        
+    def histogram(self, name, help_text='', buckets=LATENCY_BUCKETS, **labels):
+        """获取（必要时创建）直方图"""
+        return self._get(lambda: Histogram(buckets), name, help_text, labels)
+        
+    def _get(self, factory, name, help_text, labels):
+        """按名称和标签查找指标，不存在时用 factory() 创建"""
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = self.metrics[key] = factory()
+                    if help_text:
+                        self.help.setdefault(name, help_text)
+        return metric
+        
+    def _series(self, match):
+        """按名称排序的 (名称, 标签, 指标)；match 中的标签只过滤带有该标签的序列"""
+        with self.lock:
+            items = sorted(self.metrics.items())
+        for (name, labels), metric in items:
+            label_dict = dict(labels)
+            if all(label_dict.get(key, value) == value for key, value in match.items()):
+                yield name, label_dict, metric
+        
+    def snapshot(self, **match):
+        """生成可以序列化为JSON的快照，例如 snapshot(direction='send') 只包含发送方向和不分方向的指标"""
+        now = time.monotonic()
+        result = {'time': time.time(), 'uptime': time.time() - self.created,
+                  'counters': {}, 'gauges': {}, 'histograms': {}}
+        for name, labels, metric in self._series(match):
+            if metric.kind == 'counter':
+                value = metric.get()
+                rate = self._rate((name, tuple(sorted(labels.items()))), value, now)
+                result['counters'].setdefault(name, []).append({'labels': labels, 'value': value, 'rate': rate})
+            elif metric.kind == 'gauge':
+                result['gauges'].setdefault(name, []).append({'labels': labels, 'value': metric.get()})
+            else:
+                data = metric.get()
+                data['buckets'] = [['+Inf' if math.isinf(bound) else bound, count]
+                                   for bound, count in data['buckets']]
+                result['histograms'].setdefault(name, []).append(dict(data, labels=labels))
+        return result
+        
+    def _rate(self, key, value, now):
+        """计数器相对上一次采样的每秒增量"""
+        with self.lock:
+            previous = self.samples.get(key)
+            if previous is None or now - previous[0] >= METRICS_RATE_WINDOW:
+                self.samples[key] = (now, value, previous[:2] if previous else None)
+            else:
+                # 采样间隔太短，沿用更早的一次采样
+                previous = previous[2]
+        if previous is None or now <= previous[0]:
+            return 0.0
+        return (value - previous[1]) / (now - previous[0])
+        
+    def render_prometheus(self):
+        """Prometheus 文本格式（0.0.4）"""
+        lines = []
+        described = set()
+        for name, labels, metric in self._series({}):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {metric.kind}")
+            if metric.kind == 'histogram':
+                data = metric.get()
+                for bound, count in data['buckets']:
+                    le = '+Inf' if math.isinf(bound) else repr(bound)
+                    lines.append(f"{name}_bucket{_format_labels(dict(labels, le=le))} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {data['sum']!r}")
+                lines.append(f"{name}_count{_format_labels(labels)} {data['count']}")
+            else:
+                lines.append(f"{name}{_format_labels(labels)} {metric.get()!r}")
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    """{'a': 'b'} 转换为 {a="b"}"""
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items())) + '}'
+
+
+def _escape(value):
+    """转义标签值中的反斜杠、引号和换行"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# 进程内共用的指标集合，ClientApp/ServerApp 的快照和 HTTP 接口都从这里读取
+registry = MetricsRegistry()
+
+
+class TransferMetrics:
+    """一个方向、一个对端的传输在热路径上使用的指标，每块数据只做几次加法"""
+    
+    def __init__(self, direction, peer, registry=registry):
+        self.direction = direction
+        self.registry = registry
+        self.bytes = registry.counter('lanshare_bytes_total', "传输的数据字节数", direction=direction, peer=peer)
+        self.chunk_seconds = registry.histogram('lanshare_chunk_seconds', "每块数据的网络和磁盘I/O耗时（秒）",
+                                                direction=direction)
+        self.calls = {}
+        
+    def io_calls(self, call):
+        """某种I/O调用（recv/send/sendfile/read/write/msync）的计数器"""
+        counter = self.calls.get(call)
+        if counter is None:
+            counter = self.calls[call] = self.registry.counter(
+                'lanshare_io_calls_total', "数据通路上的I/O系统调用次数", direction=self.direction, call=call)
+        return counter
+
+
+_transfer_metrics = {}
+_transfer_metrics_lock = threading.Lock()
+
+
+def transfer_metrics(direction, sock=None, peer=None):
+    """获取某个方向、某个对端的 TransferMetrics，对端可以直接给出或从套接字的对端地址取得"""
+    if peer is None:
+        try:
+            peer = sock.getpeername()[0]
+        except (AttributeError, OSError, IndexError):
+            peer = 'unknown'
+    key = (direction, peer)
+    metrics = _transfer_metrics.get(key)
+    if metrics is None:
+        with _transfer_metrics_lock:
+            metrics = _transfer_metrics.setdefault(key, TransferMetrics(direction, peer))
+    return metrics
+
+
+def active_connections(direction):
+    """活动连接数"""
+    return registry.gauge('lanshare_active_connections', "活动的传输连接数", direction=direction)
+
+
+def active_transfers(direction):
+    """正在进行的文件传输数"""
+    return registry.gauge('lanshare_active_transfers', "正在进行的文件传输数", direction=direction)
+
+
+def queue_depth(queue_name):
+    """内部队列的当前长度"""
+    return registry.gauge('lanshare_queue_depth', "内部队列的当前长度", queue=queue_name)
+
+
+def files_total(direction, result):
+    """完成或失败的文件数"""
+    return registry.counter('lanshare_files_total', "传输的文件数", direction=direction, result=result)
+
+
+class ProgressPrinter:
+    """限制频率的终端进度输出，最多每 interval 秒输出一行，同时显示这段时间的传输速度
+    
+    每块数据都可以调用 update，不输出时只做一次时间比较。
+    """
+    
+    def __init__(self, label, interval=PROGRESS_PRINT_INTERVAL):
+        self.label = label
+        self.interval = interval
+        self.last_time = None
+        self.last_done = 0
+        self.speed = 0.0
+        
+    def update(self, done, total):
+        """报告进度，距离上一次输出不足 interval 秒且没有完成时直接返回"""
+        now = time.monotonic()
+        if self.last_time is None or done < self.last_done:
+            # 第一次调用或开始了新文件
+            self.last_time = now
+            self.last_done = done
+        elif now - self.last_time < self.interval and done < total:
+            return
+        elif now > self.last_time:
+            self.speed = (done - self.last_done) / (now - self.last_time)
+            self.last_time = now
+            self.last_done = done
+        progress = (done / total) * 100 if total else 100.0
+        print(f"\r{self.label}: {progress:.1f}% ({done}/{total}) {self.speed / 1024 / 1024:.1f} MB/s",
+              end='', flush=True)
+
+
+class MetricsServer:
+    """在本机提供指标的 HTTP 接口：/metrics 为 Prometheus 文本格式，/metrics.json 为JSON快照"""
+    
+    def __init__(self, host='127.0.0.1', port=0, registry=registry):
+        self.registry = registry
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.host, self.port = self.httpd.server_address[:2]
+        self.thread = None
+        
+    def start(self):
+        """在后台线程中提供服务"""
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        print(f"指标接口启动于 http://{self.host}:{self.port}/metrics")
+        
+    def stop(self):
+        """停止服务并关闭监听套接字"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        
+    def _make_handler(self):
+        """构造绑定到本注册表的请求处理类"""
+        registry = self.registry
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?', 1)[0]
+                if path == '/metrics':
+                    body = registry.render_prometheus().encode('utf-8')
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                elif path == '/metrics.json':
+                    body = json.dumps(registry.snapshot()).encode('utf-8')
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                
+            def log_message(self, format, *args):
+                # 不在终端输出每次抓取的访问日志
+                pass
+            
+        return Handler
\ No newline at end of file
@@ -4,18 +4,39 @@ import struct
 import json
 import threading
 import time
+import uuid
+import selectors
 from datetime import datetime
 
+from config import TCP_LISTEN_BACKLOG, DISCOVERY_MAX_DATAGRAM, MAX_CONTROL_MESSAGE
+from utils.io_utils import recv_into_exact
+from utils.interfaces import list_interfaces
+from utils.tuning import configure_socket
+from utils.wire import (MAGIC, FRAME, MSG_HEADER, MSG_REPLY, encode_message, encode_reply,
+                        encode_datagram, decode_datagram, parse_frame_header, decode_payload)
+
+# 本进程的实例ID，用于在发现消息中识别并忽略自己发出的请求和应答
+INSTANCE_ID = uuid.uuid4().hex[:12]
+
+# recv_exact 第一次分配的缓冲区大小，之后随收到的数据成倍扩大
+RECV_EXACT_STEP = 64 * 1024
+
 def get_local_ip():
-    """获取本地IP地址"""
+    """获取本地IP地址：优先使用默认路由出口的地址，没有默认路由时取第一块网卡的IPv4地址"""
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # UDP connect 只查路由表，不会发出数据包
         s.connect(("8.8.8.8", 80))
         ip = s.getsockname()[0]
         s.close()
         return ip
     except Exception:
-        return "127.0.0.1"
+        addresses = get_local_ips()
+        return addresses[0] if addresses else "127.0.0.1"
+
+def get_local_ips():
+    """获取所有已启用网卡上的IPv4地址（不含回环地址）"""
+    return [item['address'] for item in list_interfaces() if item['family'] == socket.AF_INET]
 
 def create_broadcast_socket(port):
     """创建UDP广播套接字"""
@@ -55,33 +76,135 @@ def send_response_broadcast(sock, response_port, hostname, ip_address, listen_po
     message = json.dumps(response_msg).encode('utf-8')
     sock.sendto(message, ('<broadcast>', response_port))
 
+def send_discovery_response(sock, addr, hostname, ip_address, listen_port, capabilities, binary=False):
+    """以单播向发现请求的来源地址回复本机信息，binary 与请求的格式一致"""
+    response_msg = {
+        'type': 'response',
+        'hostname': hostname,
+        'ip': ip_address,
+        'listen_port': listen_port,
+        'instance': INSTANCE_ID,
+        'capabilities': capabilities,
+        # 本机所有IPv4地址，通过IPv6收到应答的一方据此选择TCP连接地址
+        'addresses': get_local_ips()
+    }
+    sock.sendto(encode_datagram(response_msg, binary), addr)
+
+def set_multicast_options(sock, family, ttl):
+    """设置组播TTL（IPv6为跳数限制），并允许本机其他进程收到组播"""
+    if family == socket.AF_INET6:
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_HOPS, ttl)
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_LOOP, 1)
+    else:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+
+def join_multicast_group(sock, group, interface):
+    """在指定网卡上加入组播组，interface 为 list_interfaces 返回的一项"""
+    if interface['family'] == socket.AF_INET6:
+        mreq = socket.inet_pton(socket.AF_INET6, group) + struct.pack('@I', interface['index'])
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, mreq)
+    else:
+        mreq = socket.inet_aton(group) + socket.inet_aton(interface['address'])
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+
+def send_multicast(sock, message, group, port, interface):
+    """从指定网卡向组播组发送一个数据包"""
+    if interface['family'] == socket.AF_INET6:
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_IF, interface['index'])
+        sock.sendto(message, (group, port, 0, interface['index']))
+    else:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface['address']))
+        sock.sendto(message, (group, port))
+
 def receive_broadcast_messages(sock, timeout=1.0):
-    """接收广播消息"""
-    start_time = time.time()
+    """接收广播消息：在 timeout 秒内等待数据到达，只在套接字可读时唤醒"""
+    deadline = time.monotonic() + timeout
     messages = []
     
-    while time.time() - start_time < timeout:
+    with selectors.DefaultSelector() as selector:
+        selector.register(sock, selectors.EVENT_READ)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not selector.select(remaining):
+                break
+            messages.extend(drain_datagrams(sock))
+        
+    return messages
+
+def drain_datagrams(sock):
+    """读出非阻塞套接字中已到达的所有数据报，返回解析成功的 [(消息, 地址)]，消息可以是二进制帧或JSON"""
+    messages = []
+    while True:
         try:
-            data, addr = sock.recvfrom(1024)
-            try:
-                message = json.loads(data.decode('utf-8'))
-                messages.append((message, addr))
-            except json.JSONDecodeError:
-                continue
-        except socket.timeout:
+            data, addr = sock.recvfrom(DISCOVERY_MAX_DATAGRAM)
+        except (BlockingIOError, InterruptedError):
+            break
+        except ConnectionResetError:
+            # Windows 上对端端口不可达的ICMP会让UDP套接字的下一次接收报错，忽略即可
             continue
-    
+        message = decode_datagram(data)
+        if message is not None:
+            messages.append((message, addr))
     return messages
 
-def create_tcp_server_socket(host, port):
-    """创建TCP服务器套接字"""
+def create_tcp_server_socket(host, port, backlog=None):
+    """创建TCP服务器套接字，backlog 为等待接受的连接队列长度"""
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind((host, port))
-    sock.listen(5)
+    sock.listen(backlog or TCP_LISTEN_BACKLOG)
     return sock
 
 def create_tcp_client_socket():
     """创建TCP客户端套接字"""
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    return sock
\ No newline at end of file
+    configure_socket(sock)
+    return sock
+
+def send_json_message(sock, message, binary=False, msg_type=MSG_HEADER):
+    """发送一条控制消息：默认为带4字节长度前缀的JSON，binary 为 True 时为二进制帧（参见 utils/wire.py）"""
+    sock.sendall(encode_message(message, binary, msg_type))
+
+def send_reply_message(sock, request, reply, msg_type=MSG_REPLY):
+    """按请求的格式发送回复"""
+    sock.sendall(encode_reply(request, reply, msg_type))
+
+def recv_json_message(sock):
+    """接收一条控制消息，自动识别JSON和二进制帧，连接关闭时返回None"""
+    header = recv_exact(sock, 4)
+    if header is None:
+        return None
+    if header[:2] == MAGIC:
+        rest = recv_exact(sock, FRAME.size - 4)
+        if rest is None:
+            return None
+        _, msg_type, length = parse_frame_header(header + rest)
+        payload = recv_exact(sock, check_message_length(length))
+        if payload is None:
+            return None
+        return decode_payload(msg_type, payload)
+    payload = recv_exact(sock, check_message_length(int.from_bytes(header, 'big')))
+    if payload is None:
+        return None
+    return json.loads(payload.decode('utf-8'))
+
+def check_message_length(length):
+    """控制消息的长度前缀来自对端，超过 MAX_CONTROL_MESSAGE 时抛出 ValueError（例如误连到本端口的HTTP请求）"""
+    if length > MAX_CONTROL_MESSAGE:
+        raise ValueError(f"控制消息过长: {length} bytes")
+    return length
+
+def recv_exact(sock, size):
+    """接收指定大小的数据，连接提前关闭时返回None
+    
+    缓冲区随数据到达成倍扩大，不按对端声明的大小一次性分配
+    """
+    data = bytearray()
+    while len(data) < size:
+        start = len(data)
+        data.extend(bytes(min(size - start, max(start, RECV_EXACT_STEP))))
+        with memoryview(data) as view:
+            if recv_into_exact(sock, view[start:]) < len(data) - start:
+                return None
+    return bytes(data)
\ No newline at end of file
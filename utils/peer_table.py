@@ -0,0 +1,185 @@
+# utils/peer_table.py
+import heapq
+import time
+import threading
+
+
+class PeerTable:
+    """发现到的对端设备表，设备发现客户端和发现应答服务共用，可以跨线程访问
+    
+    时间戳使用 time.monotonic()，不受系统时间调整影响。过期检查使用按 last_seen 排序的最小堆，
+    刷新设备时只压入新记录，旧记录在出堆时识别并丢弃，每次过期检查只处理真正到期的设备。
+    另外按主机名和能力建立索引。手动添加的设备不会过期。
+    
+    设备变化时调用 subscribe 注册的回调 callback(event, peer)：event 为 'joined'、'updated'
+    （主机名、端口或能力变化，仅刷新 last_seen 不通知）或 'left'；回调在修改设备表的线程中执行，不持有锁。
+    """
+    
+    def __init__(self):
+        # {'ip': {'ip', 'hostname', 'listen_port', 'capabilities', 'last_seen', 'manual'}}
+        self.peers = {}
+        self.by_hostname = {}
+        self.by_capability = {}
+        # [(last_seen, ip)]，可能含有已被刷新或移除的旧记录
+        self.expiry_heap = []
+        self.lock = threading.Lock()
+        self.listeners = []
+        
+    def __len__(self):
+        return len(self.peers)
+        
+    def __contains__(self, ip):
+        return ip in self.peers
+        
+    def subscribe(self, callback):
+        """注册设备变化的回调"""
+        self.listeners.append(callback)
+        
+    def unsubscribe(self, callback):
+        """取消注册回调"""
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+        
+    def update(self, ip, hostname, listen_port=None, capabilities=None):
+        """记录或刷新一个对端，返回 True 表示新发现的设备"""
+        now = time.monotonic()
+        with self.lock:
+            peer = self.peers.get(ip)
+            is_new = peer is None
+            if is_new:
+                peer = self.peers[ip] = {'ip': ip, 'hostname': None, 'listen_port': 50002, 'capabilities': [],
+                                         'manual': False}
+            changed = self._set_fields(peer, hostname, listen_port, capabilities)
+            peer['last_seen'] = now
+            if not peer['manual']:
+                heapq.heappush(self.expiry_heap, (now, ip))
+                self._compact_heap()
+            snapshot = dict(peer)
+        if is_new:
+            self._notify('joined', snapshot)
+        elif changed:
+            self._notify('updated', snapshot)
+        return is_new
+        
+    def add_manual(self, ip, hostname, listen_port=None):
+        """手动添加一个不会过期的对端，已存在时返回 False"""
+        with self.lock:
+            if ip in self.peers:
+                return False
+            peer = self.peers[ip] = {'ip': ip, 'hostname': None, 'listen_port': 50002, 'capabilities': [],
+                                     'manual': True, 'last_seen': time.monotonic()}
+            self._set_fields(peer, hostname, listen_port, None)
+            snapshot = dict(peer)
+        self._notify('joined', snapshot)
+        return True
+        
+    def remove(self, ip):
+        """移除一个对端（堆中的记录在出堆时丢弃）"""
+        with self.lock:
+            peer = self._pop(ip)
+        if peer:
+            self._notify('left', peer)
+        return peer is not None
+        
+    def expire(self, max_age):
+        """移除超过 max_age 秒未出现的对端，返回被移除的IP列表"""
+        deadline = time.monotonic() - max_age
+        expired = []
+        with self.lock:
+            heap = self.expiry_heap
+            while heap and heap[0][0] < deadline:
+                last_seen, ip = heapq.heappop(heap)
+                peer = self.peers.get(ip)
+                if peer and not peer['manual'] and peer['last_seen'] == last_seen:
+                    expired.append(self._pop(ip))
+        for peer in expired:
+            self._notify('left', peer)
+        return [peer['ip'] for peer in expired]
+        
+    def next_expiry(self, max_age):
+        """距离最早一个对端过期还有多少秒，没有会过期的对端时返回 None"""
+        with self.lock:
+            heap = self.expiry_heap
+            # 丢弃堆顶的旧记录，保证堆顶是一个有效的设备
+            while heap:
+                last_seen, ip = heap[0]
+                peer = self.peers.get(ip)
+                if peer and not peer['manual'] and peer['last_seen'] == last_seen:
+                    break
+                heapq.heappop(heap)
+            else:
+                return None
+            oldest = heap[0][0]
+        return max(0.0, oldest + max_age - time.monotonic())
+        
+    def get_peers(self):
+        """获取所有对端信息的副本"""
+        with self.lock:
+            return [dict(peer) for peer in self.peers.values()]
+        
+    def get_peer(self, ip):
+        """获取指定IP的对端信息"""
+        with self.lock:
+            peer = self.peers.get(ip)
+            return dict(peer) if peer else None
+        
+    def find_by_hostname(self, hostname):
+        """获取指定主机名的所有对端"""
+        with self.lock:
+            return [dict(self.peers[ip]) for ip in self.by_hostname.get(hostname, ())]
+        
+    def find_by_capability(self, capability):
+        """获取支持指定能力（如 'delta'、'codec:zstd'）的所有对端"""
+        with self.lock:
+            return [dict(self.peers[ip]) for ip in self.by_capability.get(capability, ())]
+        
+    def _set_fields(self, peer, hostname, listen_port, capabilities):
+        """更新对端信息并维护索引，返回是否有字段变化（调用方持有锁）"""
+        changed = False
+        if hostname != peer['hostname']:
+            self._unindex(self.by_hostname, peer['hostname'], peer['ip'])
+            self.by_hostname.setdefault(hostname, set()).add(peer['ip'])
+            peer['hostname'] = hostname
+            changed = True
+        if listen_port and listen_port != peer['listen_port']:
+            peer['listen_port'] = listen_port
+            changed = True
+        if capabilities is not None and list(capabilities) != peer['capabilities']:
+            for capability in peer['capabilities']:
+                self._unindex(self.by_capability, capability, peer['ip'])
+            peer['capabilities'] = list(capabilities)
+            for capability in peer['capabilities']:
+                self.by_capability.setdefault(capability, set()).add(peer['ip'])
+            changed = True
+        return changed
+        
+    def _pop(self, ip):
+        """从设备表和索引中移除一个对端（调用方持有锁）"""
+        peer = self.peers.pop(ip, None)
+        if peer:
+            self._unindex(self.by_hostname, peer['hostname'], ip)
+            for capability in peer['capabilities']:
+                self._unindex(self.by_capability, capability, ip)
+        return peer
+        
+    def _unindex(self, index, key, ip):
+        """从索引中删除一项，集合为空时删除键"""
+        ips = index.get(key)
+        if ips is not None:
+            ips.discard(ip)
+            if not ips:
+                del index[key]
+        
+    def _compact_heap(self):
+        """旧记录过多时重建堆，避免频繁刷新的设备让堆无限增长（调用方持有锁）"""
+        if len(self.expiry_heap) > 2 * len(self.peers) + 64:
+            self.expiry_heap = [(peer['last_seen'], ip) for ip, peer in self.peers.items() if not peer['manual']]
+            heapq.heapify(self.expiry_heap)
+        
+    def _notify(self, event, peer):
+        """调用回调，单个回调出错不影响其他回调"""
+        for callback in list(self.listeners):
+            try:
+                callback(event, peer)
+            except Exception as e:
+                print(f"设备变化回调出错: {e}")
\ No newline at end of file
@@ -0,0 +1,163 @@
+# utils/tuning.py
+import socket
+import struct
+import threading
+
+from config import (CHUNK_SIZE, TUNING_ENABLED, TCP_NODELAY_ENABLED, SOCKET_BUFFER_MAX, CHUNK_SIZE_MIN,
+                    CHUNK_SIZE_MAX, TUNING_CHUNK_TIME, TUNING_DEFAULT_BANDWIDTH, TUNING_SMOOTHING,
+                    TUNING_MIN_SAMPLE)
+from utils.metrics import registry
+
+# Linux struct tcp_info 的前 168 字节（内核 4.9 起）：8 个单字节字段，24 个 u32，
+# pacing_rate/max_pacing_rate/bytes_acked/bytes_received，6 个 u32，delivery_rate
+_TCP_INFO = struct.Struct('=8B24I4Q6IQ')
+_U32_BASE = 8  # 第一个 u32 字段（tcpi_rto）在解包结果中的下标
+
+# 内核自动调整缓冲区时的上限 {'send': 字节, 'receive': 字节}，首次使用时读取
+_autotune_limits = {}
+
+
+def read_tcp_info(sock):
+    """读取 TCP_INFO，返回 {'rtt', 'rttvar', 'min_rtt'（秒）, 'snd_mss', 'snd_cwnd', 'delivery_rate'（字节/秒）,
+    'total_retrans'}；不是 Linux 或读取失败时返回 None。旧内核缺少的字段为 0
+    """
+    if not hasattr(socket, 'TCP_INFO'):
+        return None
+    try:
+        data = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, _TCP_INFO.size)
+    except OSError:
+        return None
+    if len(data) < _U32_BASE + 24 * 4:
+        return None
+    fields = _TCP_INFO.unpack(data.ljust(_TCP_INFO.size, b'\0'))
+    u32 = fields[_U32_BASE:_U32_BASE + 24]
+    return {
+        'rtt': u32[15] / 1e6,
+        'rttvar': u32[16] / 1e6,
+        'snd_mss': u32[2],
+        'snd_cwnd': u32[18],
+        'total_retrans': u32[23],
+        'min_rtt': fields[_U32_BASE + 24 + 4 + 3] / 1e6,
+        'delivery_rate': fields[-1],
+    }
+
+
+def _autotune_limit(direction):
+    """Linux 的 tcp_wmem/tcp_rmem 上限；其他平台返回 None"""
+    if direction not in _autotune_limits:
+        path = '/proc/sys/net/ipv4/tcp_wmem' if direction == 'send' else '/proc/sys/net/ipv4/tcp_rmem'
+        try:
+            with open(path, 'r') as f:
+                _autotune_limits[direction] = int(f.read().split()[2])
+        except (OSError, ValueError, IndexError):
+            _autotune_limits[direction] = None
+    return _autotune_limits[direction]
+
+
+class LinkEstimator:
+    """按对端记录测得的往返时间和吞吐量（指数平滑），新连接据此选择块大小和缓冲区大小"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.links = {}
+        
+    def observe(self, peer, rtt=None, throughput=None):
+        """记录一次测量结果，None 表示没有测到"""
+        with self.lock:
+            old_rtt, old_throughput = self.links.get(peer, (None, None))
+            self.links[peer] = (_smooth(old_rtt, rtt), _smooth(old_throughput, throughput))
+        if rtt:
+            registry.gauge('lanshare_peer_rtt_seconds', "对端的平滑往返时间（秒）", peer=peer).set(rtt)
+        if throughput:
+            registry.gauge('lanshare_peer_throughput_bytes', "对端最近传输的平滑吞吐量（字节/秒）",
+                           peer=peer).set(self.links[peer][1])
+    
+    def estimate(self, peer):
+        """返回 (往返时间, 吞吐量)，没有记录时为 (None, None)"""
+        with self.lock:
+            return self.links.get(peer, (None, None))
+
+
+def _smooth(old, new):
+    """指数平滑，任一方缺失时取另一方"""
+    if new is None or new <= 0:
+        return old
+    if old is None:
+        return new
+    return old + (new - old) * TUNING_SMOOTHING
+
+
+# 进程内共用的链路估计，收发两个方向共用同一个对端的记录
+links = LinkEstimator()
+
+
+def configure_socket(sock):
+    """新建或新接受的TCP连接的通用设置：关闭 Nagle 算法，使控制消息和小文件不等待合并"""
+    if not TCP_NODELAY_ENABLED:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+
+def tune_connection(sock, size, direction):
+    """为即将传输 size 字节的连接选择块大小，必要时按带宽时延积放大套接字缓冲区，返回块大小
+    
+    往返时间优先取 TCP_INFO（连接建立时内核就已测得），吞吐量取该对端以往传输的测量值，
+    没有记录时按 TUNING_DEFAULT_BANDWIDTH 估计。Linux 上显式设置缓冲区会关闭内核的自动调整，
+    所以只在带宽时延积超出自动调整上限时才设置；缓冲区不超过 SOCKET_BUFFER_MAX。
+    """
+    if not TUNING_ENABLED:
+        return CHUNK_SIZE
+    peer = _peer_of(sock)
+    rtt, throughput = links.estimate(peer)
+    info = read_tcp_info(sock)
+    if info and info['rtt']:
+        rtt = info['rtt']
+    throughput = throughput or TUNING_DEFAULT_BANDWIDTH
+    
+    if rtt and size > CHUNK_SIZE_MIN:
+        _ensure_buffer(sock, direction, min(SOCKET_BUFFER_MAX, int(2 * throughput * rtt), max(size, CHUNK_SIZE_MIN)))
+    return choose_chunk_size(throughput, size)
+
+
+def choose_chunk_size(throughput, size):
+    """每块约为 TUNING_CHUNK_TIME 秒的数据，向上取2的幂，限制在 [CHUNK_SIZE_MIN, CHUNK_SIZE_MAX]；
+    小文件的块不超过文件本身
+    """
+    chunk = CHUNK_SIZE_MIN
+    while chunk < throughput * TUNING_CHUNK_TIME and chunk < CHUNK_SIZE_MAX:
+        chunk *= 2
+    return max(1, min(chunk, size))
+
+
+def record_transfer(sock, size, elapsed):
+    """传输结束后记录该对端的往返时间和吞吐量，数据量太小时只记录往返时间"""
+    if not TUNING_ENABLED:
+        return
+    info = read_tcp_info(sock)
+    rtt = info['rtt'] if info else None
+    throughput = size / elapsed if size >= TUNING_MIN_SAMPLE and elapsed > 0 else None
+    links.observe(_peer_of(sock), rtt, throughput)
+
+
+def _ensure_buffer(sock, direction, wanted):
+    """缓冲区小于 wanted 且超出内核自动调整范围时显式设置"""
+    option = socket.SO_SNDBUF if direction == 'send' else socket.SO_RCVBUF
+    limit = _autotune_limit(direction)
+    try:
+        current = sock.getsockopt(socket.SOL_SOCKET, option)
+        if wanted <= current or (limit is not None and wanted <= limit):
+            return
+        sock.setsockopt(socket.SOL_SOCKET, option, wanted)
+    except OSError:
+        pass
+
+
+def _peer_of(sock):
+    """连接对端的IP地址"""
+    try:
+        return sock.getpeername()[0]
+    except (OSError, IndexError):
+        return 'unknown'
\ No newline at end of file
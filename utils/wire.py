@@ -0,0 +1,391 @@
+# utils/wire.py
+import json
+import struct
+
+# 二进制帧: 魔数(2字节) + 版本(1字节) + 消息类型(1字节) + 载荷长度(4字节) + 载荷
+# 载荷: 布局ID(1字节) + 固定布局部分 + TLV扩展字段；布局ID为0时没有固定布局部分
+# 旧的JSON消息以4字节长度开头，魔数对应的长度超过1GB，不会是合法的JSON消息，接收方据此自动识别两种格式
+MAGIC = b'LS'
+WIRE_VERSION = 1
+WIRE_CAPABILITY = f"wire:{WIRE_VERSION}"
+FRAME = struct.Struct('>2sBBI')
+JSON_PREFIX = struct.Struct('>I')
+
+# 消息类型
+MSG_DISCOVERY = 1  # 发现请求
+MSG_RESPONSE = 2   # 发现应答
+MSG_HEADER = 3     # 传输头和会话/目录帧的元数据
+MSG_REPLY = 4      # 接收方的协商回复和汇总
+MSG_ACK = 5        # 会话帧确认
+
+# 发现消息在JSON中用 'type' 字段区分，二进制帧中由消息类型表示
+_TYPE_NAMES = {MSG_DISCOVERY: 'discovery', MSG_RESPONSE: 'response'}
+_NAME_TYPES = {name: msg_type for msg_type, name in _TYPE_NAMES.items()}
+
+# TLV字段: 标签(1字节) + 值类型(1字节) + 长度(2字节，0xFFFF 表示后面还有4字节的实际长度) + 值
+TLV = struct.Struct('>BBH')
+LONG_LENGTH = struct.Struct('>I')
+
+# 字段名与标签的对应关系只能追加，不能修改；不认识的标签在解码时跳过，
+# 不在表中的字段放进 TAG_EXTENSION 中以JSON编码
+TAG_EXTENSION = 0
+FIELD_TAGS = {
+    'mode': 1, 'name': 2, 'size': 3, 'resume': 4, 'fingerprint': 5, 'codecs': 6, 'offset': 7, 'codec': 8,
+    'transfer_id': 9, 'streams': 10, 'range_index': 11, 'length': 12, 'block_size': 13, 'blocks': 14,
+    'window': 15, 'id': 16, 'results': 17, 'files': 18, 'dirs': 19, 'path': 20, 'mtime': 21, 'root': 22,
+    'failed': 23, 'bytes': 24, 'hostname': 25, 'ip': 26, 'listen_port': 27, 'capabilities': 28,
+    'addresses': 29, 'instance': 30, 'wire': 31, 'retry': 32, 'digest': 33, 'integrity': 34, 'ok': 35,
+}
+TAG_FIELDS = {tag: name for name, tag in FIELD_TAGS.items()}
+
+# 值类型
+KIND_NONE = 0
+KIND_INT = 1        # 有符号整数，大端，最短字节数
+KIND_STR = 2        # UTF-8 字符串
+KIND_BYTES = 3
+KIND_BOOL = 4
+KIND_FLOAT = 5      # 8字节双精度
+KIND_STRS = 6       # 字符串列表，以 \0 分隔
+KIND_BOOLS = 7      # 布尔列表，每项1字节
+KIND_INTS = 8       # 整数列表，每项8字节
+KIND_ROWS = 9       # 表格（如文件清单），按列存储: 列数 + 行数 + 每列(类型 + 长度 + 数据)
+KIND_JSON = 10      # 其他值以JSON编码
+
+ROWS_HEADER = struct.Struct('>BI')
+COLUMN_HEADER = struct.Struct('>cI')
+
+
+class WireVersionError(ValueError):
+    """对端的二进制帧版本高于本机支持的版本"""
+    
+    def __init__(self, version):
+        super().__init__(f"不支持的二进制帧版本: {version}，本机支持的最高版本为 {WIRE_VERSION}")
+        self.version = version
+
+
+class WireMessage(dict):
+    """从二进制帧解码出的消息，回复时使用同样的格式"""
+    __slots__ = ()
+    binary = True
+
+
+def _encode_value(value):
+    """按值的类型编码，返回 (值类型, 数据)"""
+    if value is None:
+        return KIND_NONE, b''
+    if isinstance(value, bool):
+        return KIND_BOOL, b'\1' if value else b'\0'
+    if isinstance(value, int):
+        return KIND_INT, value.to_bytes(value.bit_length() // 8 + 1, 'big', signed=True)
+    if isinstance(value, str):
+        return KIND_STR, value.encode('utf-8')
+    if isinstance(value, (bytes, bytearray)):
+        return KIND_BYTES, bytes(value)
+    if isinstance(value, float):
+        return KIND_FLOAT, struct.pack('>d', value)
+    if isinstance(value, (list, tuple)):
+        if not value:
+            return KIND_STRS, b''
+        first = value[0]
+        # 空字符串无法和分隔符区分（[''] 会被解码为 []），含有空字符串的列表以JSON编码
+        if isinstance(first, str) and all(isinstance(item, str) and item and '\0' not in item for item in value):
+            return KIND_STRS, '\0'.join(value).encode('utf-8')
+        if isinstance(first, bool) and all(isinstance(item, bool) for item in value):
+            return KIND_BOOLS, bytes(value)
+        if type(first) is int and all(type(item) is int for item in value):
+            try:
+                return KIND_INTS, struct.pack(f'>{len(value)}q', *value)
+            except struct.error:
+                pass
+        if isinstance(first, (list, tuple)):
+            rows = _encode_rows(value)
+            if rows is not None:
+                return KIND_ROWS, rows
+    return KIND_JSON, json.dumps(value).encode('utf-8')
+
+
+def _encode_rows(rows):
+    """列式编码等长且每列类型一致（字符串或整数）的表格，不满足条件时返回 None"""
+    width = len(rows[0])
+    if not 0 < width < 256 or any(len(row) != width for row in rows):
+        return None
+    parts = [ROWS_HEADER.pack(width, len(rows))]
+    for column in zip(*rows):
+        if all(isinstance(item, str) and '\0' not in item for item in column):
+            data = '\0'.join(column).encode('utf-8')
+            parts.append(COLUMN_HEADER.pack(b's', len(data)))
+        elif all(type(item) is int for item in column):
+            try:
+                data = struct.pack(f'>{len(column)}q', *column)
+            except struct.error:
+                return None
+            parts.append(COLUMN_HEADER.pack(b'q', len(data)))
+        else:
+            return None
+        parts.append(data)
+    return b''.join(parts)
+
+
+def _decode_rows(data):
+    """解码列式表格为 [(...), ...]"""
+    width, count = ROWS_HEADER.unpack_from(data)
+    pos = ROWS_HEADER.size
+    columns = []
+    for _ in range(width):
+        column_type, length = COLUMN_HEADER.unpack_from(data, pos)
+        pos += COLUMN_HEADER.size
+        chunk = data[pos:pos + length]
+        pos += length
+        if column_type == b's':
+            column = chunk.decode('utf-8').split('\0') if count else []
+        elif column_type == b'q':
+            column = struct.unpack(f'>{count}q', chunk)
+        else:
+            raise ValueError(f"未知的列类型: {column_type!r}")
+        if len(column) != count:
+            raise ValueError("表格列长度不一致")
+        columns.append(column)
+    return list(zip(*columns))
+
+
+_DECODERS = {
+    KIND_NONE: lambda data: None,
+    KIND_INT: lambda data: int.from_bytes(data, 'big', signed=True),
+    KIND_STR: lambda data: data.decode('utf-8'),
+    KIND_BYTES: bytes,
+    KIND_BOOL: lambda data: data != b'\0',
+    KIND_FLOAT: lambda data: struct.unpack('>d', data)[0],
+    KIND_STRS: lambda data: data.decode('utf-8').split('\0') if data else [],
+    KIND_BOOLS: lambda data: [byte != 0 for byte in data],
+    KIND_INTS: lambda data: list(struct.unpack(f'>{len(data) // 8}q', data)),
+    KIND_ROWS: _decode_rows,
+    KIND_JSON: lambda data: json.loads(data.decode('utf-8')),
+}
+
+
+# 固定布局：常用消息（发现请求/应答、单文件传输头和回复、会话和目录的单文件帧）的字段
+# 整数和布尔值打包为定长结构，字符串以 \0 分隔（'z' 为可以是 None 的字符串，'S' 为以 \x1f 分隔的字符串列表），
+# 解码只需一次 struct 解包和一次字符串分割；消息中的其他字段作为TLV扩展字段跟在后面
+_STRUCT_CODES = 'BHIQq?'
+
+
+class _Layout:
+    """一种固定布局"""
+    
+    def __init__(self, layout_id, fields):
+        self.layout_id = layout_id
+        self.names = frozenset(name for name, _ in fields)
+        self.fixed_names = tuple(name for name, code in fields if code in _STRUCT_CODES)
+        self.text_fields = tuple((name, code) for name, code in fields if code not in _STRUCT_CODES)
+        self.text_names = tuple(name for name, _ in self.text_fields)
+        # 需要转换的字符串字段（'z' 和 'S'），普通字符串直接放入消息
+        self.converted = tuple((name, code) for name, code in self.text_fields if code != 's')
+        # 定长结构最后是字符串部分的长度（2字节）
+        self.struct = struct.Struct('>' + ''.join(code for _, code in fields if code in _STRUCT_CODES) + 'H')
+        
+    def pack(self, message):
+        """按布局打包消息中的对应字段，值不符合布局时返回 None"""
+        texts = []
+        for name, code in self.text_fields:
+            value = message[name]
+            if code == 'z' and value is None:
+                value = ''
+            elif code == 'S':
+                if not isinstance(value, (list, tuple)) or not all(isinstance(item, str) and item and '\x1f' not in item
+                                                                    for item in value):
+                    return None
+                value = '\x1f'.join(value)
+            elif not isinstance(value, str) or (code == 'z' and not value):
+                return None
+            if '\0' in value:
+                return None
+            texts.append(value)
+        text = '\0'.join(texts).encode('utf-8')
+        try:
+            fixed = self.struct.pack(*[message[name] for name in self.fixed_names], len(text))
+        except struct.error:
+            return None
+        return bytes((self.layout_id,)) + fixed + text
+        
+    def unpack(self, payload, pos):
+        """从 pos 开始解包，返回 (消息字典, 固定布局之后的位置)"""
+        values = self.struct.unpack_from(payload, pos)
+        message = dict(zip(self.fixed_names, values))
+        pos += self.struct.size
+        length = values[-1]
+        if self.text_fields:
+            texts = payload[pos:pos + length].decode('utf-8').split('\0')
+            if len(texts) != len(self.text_names):
+                raise ValueError("固定布局的字符串字段数不一致")
+            message.update(zip(self.text_names, texts))
+            for name, code in self.converted:
+                text = message[name]
+                if code == 'z':
+                    message[name] = text or None
+                else:
+                    message[name] = text.split('\x1f') if text else []
+        return message, pos + length
+
+
+# 布局ID只能追加，不能修改；编码时选用字段最多、且消息中都有这些字段的布局
+LAYOUTS = {layout.layout_id: layout for layout in (
+    _Layout(1, [('listen_port', 'H'), ('hostname', 's'), ('ip', 's'), ('instance', 's')]),
+    _Layout(2, [('hostname', 's'), ('ip', 's'), ('instance', 's')]),
+    _Layout(3, [('listen_port', 'H'), ('hostname', 's'), ('ip', 's'), ('instance', 's'), ('capabilities', 'S'),
+                ('addresses', 'S')]),
+    _Layout(4, [('size', 'Q'), ('resume', '?'), ('name', 's'), ('fingerprint', 's'), ('codecs', 'S')]),
+    _Layout(5, [('size', 'Q'), ('name', 's')]),
+    _Layout(6, [('offset', 'Q'), ('codec', 'z')]),
+    _Layout(7, [('id', 'Q'), ('size', 'Q'), ('name', 's')]),
+    _Layout(8, [('size', 'Q'), ('mode', 'I'), ('mtime', 'q'), ('path', 's')]),
+)}
+_LAYOUT_ORDER = sorted(LAYOUTS.values(), key=lambda layout: -len(layout.names))
+
+
+def _encode_field(tag, value):
+    """编码一个TLV字段"""
+    kind, data = _encode_value(value)
+    if len(data) < 0xFFFF:
+        return TLV.pack(tag, kind, len(data)) + data
+    return TLV.pack(tag, kind, 0xFFFF) + LONG_LENGTH.pack(len(data)) + data
+
+
+def encode_fields(message):
+    """把消息字典编码为载荷：能匹配固定布局的字段按布局打包，其余字段编码为TLV"""
+    keys = message.keys()
+    head = b'\0'
+    rest = message
+    for layout in _LAYOUT_ORDER:
+        if layout.names <= keys:
+            packed = layout.pack(message)
+            if packed is not None:
+                head = packed
+                rest = {name: value for name, value in message.items() if name not in layout.names}
+                break
+        
+    parts = [head]
+    extension = {}
+    for name, value in rest.items():
+        tag = FIELD_TAGS.get(name)
+        if tag is None:
+            extension[name] = value
+        else:
+            parts.append(_encode_field(tag, value))
+    if extension:
+        parts.append(_encode_field(TAG_EXTENSION, extension))
+    return b''.join(parts)
+
+
+def decode_fields(payload):
+    """把载荷解码为 WireMessage，跳过不认识的TLV标签和值类型"""
+    if not isinstance(payload, bytes):
+        payload = bytes(payload)
+    if not payload:
+        raise ValueError("空的二进制消息")
+    layout_id = payload[0]
+    if layout_id:
+        layout = LAYOUTS.get(layout_id)
+        if layout is None:
+            raise ValueError(f"未知的固定布局: {layout_id}")
+        fields, pos = layout.unpack(payload, 1)
+        message = WireMessage(fields)
+    else:
+        message = WireMessage()
+        pos = 1
+        
+    end = len(payload)
+    while pos < end:
+        tag, kind, length = TLV.unpack_from(payload, pos)
+        pos += TLV.size
+        if length == 0xFFFF:
+            length = LONG_LENGTH.unpack_from(payload, pos)[0]
+            pos += LONG_LENGTH.size
+        if pos + length > end:
+            raise ValueError("TLV字段长度超出消息范围")
+        decoder = _DECODERS.get(kind)
+        if decoder is not None:
+            value = decoder(payload[pos:pos + length])
+            if tag == TAG_EXTENSION:
+                if isinstance(value, dict):
+                    message.update(value)
+            elif tag in TAG_FIELDS:
+                message[TAG_FIELDS[tag]] = value
+        pos += length
+    return message
+
+
+def encode_message(message, binary, msg_type=MSG_HEADER):
+    """编码一条完整的消息：binary 为 True 时为二进制帧，否则为带4字节长度前缀的JSON"""
+    if not binary:
+        payload = json.dumps(message).encode('utf-8')
+        return JSON_PREFIX.pack(len(payload)) + payload
+    if message.get('type') in _NAME_TYPES:
+        msg_type = _NAME_TYPES[message['type']]
+        message = {name: value for name, value in message.items() if name != 'type'}
+    payload = encode_fields(message)
+    return FRAME.pack(MAGIC, WIRE_VERSION, msg_type, len(payload)) + payload
+
+
+def encode_reply(request, reply, msg_type=MSG_REPLY):
+    """按请求的格式编码回复；请求以JSON发送但声明支持二进制帧时，在回复中告知本机的版本"""
+    binary = getattr(request, 'binary', False)
+    if not binary and request.get('wire'):
+        reply = dict(reply, wire=WIRE_VERSION)
+    return encode_message(reply, binary, msg_type)
+
+
+def negotiated(request):
+    """接收方：请求以二进制帧发送，或以JSON发送但声明了支持二进制帧时，后续帧元数据和确认都使用二进制"""
+    return getattr(request, 'binary', False) or bool(request.get('wire'))
+
+
+def encode_datagram(message, binary):
+    """编码一个UDP数据报：二进制帧或不带长度前缀的JSON"""
+    if binary:
+        return encode_message(message, True)
+    return json.dumps(message).encode('utf-8')
+
+
+def parse_frame_header(header):
+    """解析二进制帧头，返回 (版本, 消息类型, 载荷长度)"""
+    magic, version, msg_type, length = FRAME.unpack(header)
+    if magic != MAGIC:
+        raise ValueError("不是二进制帧")
+    if version > WIRE_VERSION:
+        raise WireVersionError(version)
+    return version, msg_type, length
+
+
+def encode_version_error(error):
+    """接收方：对端的帧版本过高时的错误回复，以JSON编码以便任何版本的发送方都能解析"""
+    return encode_message({'error': str(error), 'wire': WIRE_VERSION}, False)
+
+
+def decode_payload(msg_type, payload):
+    """解码二进制帧的载荷，发现消息补上 'type' 字段"""
+    message = decode_fields(payload)
+    if msg_type in _TYPE_NAMES:
+        message['type'] = _TYPE_NAMES[msg_type]
+    return message
+
+
+def decode_datagram(data):
+    """解码一个UDP数据报（二进制帧或JSON），无法解析时返回 None"""
+    try:
+        if data[:2] == MAGIC:
+            _, msg_type, length = parse_frame_header(data[:FRAME.size])
+            return decode_payload(msg_type, data[FRAME.size:FRAME.size + length])
+        message = json.loads(data.decode('utf-8'))
+    except (ValueError, IndexError, struct.error, UnicodeDecodeError):
+        return None
+    return message if isinstance(message, dict) else None
+
+
+def encode_meta(meta, binary):
+    """编码会话/目录帧的元数据"""
+    return encode_fields(meta) if binary else json.dumps(meta).encode('utf-8')
+
+
+def decode_meta(data, binary):
+    """解码会话/目录帧的元数据"""
+    return decode_fields(data) if binary else json.loads(data.decode('utf-8'))
\ No newline at end of file